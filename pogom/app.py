@@ -3,9 +3,13 @@
 
 import calendar
 import logging
+import mimetypes
+import os
+import zlib
 
 from flask import Flask, abort, jsonify, render_template, request,\
-    make_response
+    make_response, Response, stream_with_context, send_from_directory,\
+    safe_join
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
@@ -14,12 +18,16 @@ from s2sphere import LatLng
 from pogom.pgscout import scout_error, pgscout_encounter
 from pogom.utils import get_args, get_pokemon_name
 from datetime import timedelta
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from bisect import bisect_left
+from itertools import chain
+from threading import Lock, Event
+from cachetools import TTLCache
 
 from . import config
 from .models import (Pokemon, Gym, Pokestop, ScannedLocation,
-                     MainWorker, WorkerStatus, Token, HashKeys)
+                     MainWorker, WorkerStatus, Token, HashKeys, change_log,
+                     start_replica_reads, end_replica_reads, MapRow)
 from .utils import now, dottedQuadToNum, get_blacklist
 log = logging.getLogger(__name__)
 compress = Compress()
@@ -47,6 +55,16 @@ class Pogom(Flask):
             self.blacklist = []
             self.blacklist_keys = []
 
+        # Short lived cache of /raw_data responses, if enabled.
+        self.raw_data_cache = None
+        if args.raw_data_cache_ttl > 0:
+            self.raw_data_cache = ResponseCache(args.raw_data_cache_size,
+                                                args.raw_data_cache_ttl)
+
+        # Serve the reads of web requests from the read replica, if any.
+        self.before_request(start_replica_reads)
+        self.teardown_request(end_replica_reads)
+
         # Routes
         self.json_encoder = CustomJSONEncoder
         self.route("/", methods=['GET'])(self.fullmap)
@@ -238,6 +256,11 @@ class Pogom(Flask):
             'fixed_display': not args.fixed_location
         }
 
+        # Columnar sections are built in memory, so they are only asked for
+        # when /raw_data isn't streamed.
+        columnar = (not args.stream_raw_data or
+                    self.raw_data_cache is not None)
+
         map_lat = self.current_location[0]
         map_lng = self.current_location[1]
         if request.args:
@@ -248,65 +271,114 @@ class Pogom(Flask):
                                lat=map_lat,
                                lng=map_lng,
                                showAllZoomLevel=args.show_all_zoom_level,
+                               columnarRawData=str(columnar).lower(),
                                gmaps_key=config['GMAPS_KEY'],
                                lang=config['LOCALE'],
                                show=visibility_flags
                                )
 
+    # Send the gzipped copy made at startup next to a static file, if there
+    # is an up to date one and the client accepts it, instead of compressing
+    # it again. Otherwise Flask sends the file itself.
+    def send_static_file(self, filename):
+        accept = request.headers.get('Accept-Encoding', '').lower()
+        if 'gzip' in accept and is_fresh_copy(
+                safe_join(self.static_folder, filename + '.gz'),
+                safe_join(self.static_folder, filename)):
+            response = send_from_directory(
+                self.static_folder, filename + '.gz',
+                cache_timeout=self.get_send_file_max_age(filename))
+            response.mimetype = (mimetypes.guess_type(filename)[0] or
+                                 'application/octet-stream')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+        return super(Pogom, self).send_static_file(filename)
+
     def raw_data(self):
         self.heartbeat[0] = now()
         args = get_args()
         if args.on_demand_timeout > 0:
             self.search_control.clear()
+
+        if self.raw_data_cache is not None and cacheable(request.args):
+            # Polls of the same area share one encoded response.
+            params = cache_params(request.args, args.raw_data_cache_ttl)
+            body = self.raw_data_cache.get(
+                cache_key(params),
+                lambda: encode_body(''.join(iter_json(
+                    self.get_raw_data(params)))))
+            return encoded_json_response(body)
+
+        # Streamed sections are lazy row iterators instead of lists.
+        if args.stream_raw_data:
+            return stream_json_response(
+                self.get_raw_data(request.args, stream=True))
+
+        return jsonify(self.get_raw_data(request.args))
+
+    def get_raw_data(self, params, stream=False):
+        args = get_args()
         d = {}
 
         # Request time of this request.
         d['timestamp'] = datetime.utcnow()
 
         # Request time of previous request.
-        if request.args.get('timestamp'):
-            timestamp = int(request.args.get('timestamp'))
+        if params.get('timestamp'):
+            timestamp = int(params.get('timestamp'))
             timestamp -= 1000  # Overlap, for rounding errors.
         else:
             timestamp = 0
 
-        swLat = request.args.get('swLat')
-        swLng = request.args.get('swLng')
-        neLat = request.args.get('neLat')
-        neLng = request.args.get('neLng')
+        swLat = params.get('swLat')
+        swLng = params.get('swLng')
+        neLat = params.get('neLat')
+        neLng = params.get('neLng')
+
+        oSwLat = params.get('oSwLat')
+        oSwLng = params.get('oSwLng')
+        oNeLat = params.get('oNeLat')
+        oNeLng = params.get('oNeLng')
 
-        oSwLat = request.args.get('oSwLat')
-        oSwLng = request.args.get('oSwLng')
-        oNeLat = request.args.get('oNeLat')
-        oNeLng = request.args.get('oNeLng')
+        # With the change log enabled, clients that send back the sequence
+        # id of their last response only get the rows written since.
+        changes = None
+        if change_log.enabled:
+            seq = params.get('seq')
+            d['seq'], changes = change_log.since(int(seq) if seq else None)
+
+        def changed(model):
+            return None if changes is None else changes.get(model, ())
 
         # Previous switch settings.
-        lastgyms = request.args.get('lastgyms')
-        lastpokestops = request.args.get('lastpokestops')
-        lastpokemon = request.args.get('lastpokemon')
-        lastslocs = request.args.get('lastslocs')
-        lastspawns = request.args.get('lastspawns')
+        lastgyms = params.get('lastgyms')
+        lastpokestops = params.get('lastpokestops')
+        lastpokemon = params.get('lastpokemon')
+        lastslocs = params.get('lastslocs')
+        lastspawns = params.get('lastspawns')
 
-        if request.args.get('luredonly', 'true') == 'true':
+        if params.get('luredonly', 'true') == 'true':
             luredonly = True
         else:
             luredonly = False
 
         # Current switch settings saved for next request.
-        if request.args.get('gyms', 'true') == 'true':
-            d['lastgyms'] = request.args.get('gyms', 'true')
+        if params.get('gyms', 'true') == 'true':
+            d['lastgyms'] = params.get('gyms', 'true')
 
-        if request.args.get('pokestops', 'true') == 'true':
-            d['lastpokestops'] = request.args.get('pokestops', 'true')
+        if params.get('pokestops', 'true') == 'true':
+            d['lastpokestops'] = params.get('pokestops', 'true')
 
-        if request.args.get('pokemon', 'true') == 'true':
-            d['lastpokemon'] = request.args.get('pokemon', 'true')
+        if params.get('pokemon', 'true') == 'true':
+            d['lastpokemon'] = params.get('pokemon', 'true')
 
-        if request.args.get('scanned', 'true') == 'true':
-            d['lastslocs'] = request.args.get('scanned', 'true')
+        if params.get('scanned', 'true') == 'true':
+            d['lastslocs'] = params.get('scanned', 'true')
 
-        if request.args.get('spawnpoints', 'false') == 'true':
-            d['lastspawns'] = request.args.get('spawnpoints', 'false')
+        if params.get('spawnpoints', 'false') == 'true':
+            d['lastspawns'] = params.get('spawnpoints', 'false')
 
         # If old coords are not equal to current coords we have moved/zoomed!
         if (oSwLng < swLng and oSwLat < swLat and
@@ -324,81 +396,95 @@ class Pogom(Flask):
         d['oNeLat'] = neLat
         d['oNeLng'] = neLng
 
-        if (request.args.get('pokemon', 'true') == 'true' and
+        if (params.get('pokemon', 'true') == 'true' and
                 not args.no_pokemon):
-            if request.args.get('ids'):
-                ids = [int(x) for x in request.args.get('ids').split(',')]
+            if params.get('ids'):
+                ids = [int(x) for x in params.get('ids').split(',')]
                 d['pokemons'] = Pokemon.get_active_by_id(ids, swLat, swLng,
-                                                         neLat, neLng)
+                                                         neLat, neLng,
+                                                         stream=stream)
             elif lastpokemon != 'true':
                 # If this is first request since switch on, load
                 # all pokemon on screen.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng,
+                                                   stream=stream)
             else:
                 # If map is already populated only request modified Pokemon
                 # since last request time.
                 d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng,
-                                                   timestamp=timestamp)
+                                                   timestamp=timestamp,
+                                                   keys=changed(Pokemon),
+                                                   stream=stream)
                 if newArea:
                     # If screen is moved add newly uncovered Pokemon to the
                     # ones that were modified since last request time.
-                    d['pokemons'] = d['pokemons'] + (
+                    d['pokemons'] = concat(d['pokemons'], (
                         Pokemon.get_active(swLat, swLng, neLat, neLng,
                                            oSwLat=oSwLat, oSwLng=oSwLng,
-                                           oNeLat=oNeLat, oNeLng=oNeLng))
+                                           oNeLat=oNeLat, oNeLng=oNeLng,
+                                           stream=stream)))
 
-            if request.args.get('eids'):
+            if params.get('eids'):
                 # Exclude id's of pokemon that are hidden.
-                eids = [int(x) for x in request.args.get('eids').split(',')]
-                d['pokemons'] = [
-                    x for x in d['pokemons'] if x['pokemon_id'] not in eids]
-
-            if request.args.get('reids'):
-                reids = [int(x) for x in request.args.get('reids').split(',')]
-                d['pokemons'] = d['pokemons'] + (
+                eids = [int(x) for x in params.get('eids').split(',')]
+                d['pokemons'] = (
+                    x for x in d['pokemons'] if x['pokemon_id'] not in eids)
+                if not stream:
+                    d['pokemons'] = list(d['pokemons'])
+
+            if params.get('reids'):
+                reids = [int(x) for x in params.get('reids').split(',')]
+                d['pokemons'] = concat(d['pokemons'], (
                     Pokemon.get_active_by_id(reids, swLat, swLng,
-                                             neLat, neLng))
+                                             neLat, neLng, stream=stream)))
                 d['reids'] = reids
 
-        if (request.args.get('pokestops', 'true') == 'true' and
+        if (params.get('pokestops', 'true') == 'true' and
                 not args.no_pokestops):
             if lastpokestops != 'true':
                 d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                                    lured=luredonly)
+                                                    lured=luredonly,
+                                                    stream=stream)
             else:
                 d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                                    timestamp=timestamp)
+                                                    timestamp=timestamp,
+                                                    keys=changed(Pokestop),
+                                                    stream=stream)
                 if newArea:
-                    d['pokestops'] = d['pokestops'] + (
+                    d['pokestops'] = concat(d['pokestops'], (
                         Pokestop.get_stops(swLat, swLng, neLat, neLng,
                                            oSwLat=oSwLat, oSwLng=oSwLng,
                                            oNeLat=oNeLat, oNeLng=oNeLng,
-                                           lured=luredonly))
+                                           lured=luredonly, stream=stream)))
 
-        if request.args.get('gyms', 'true') == 'true' and not args.no_gyms:
+        if params.get('gyms', 'true') == 'true' and not args.no_gyms:
             if lastgyms != 'true':
                 d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
             else:
                 d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng,
-                                         timestamp=timestamp)
+                                         timestamp=timestamp,
+                                         keys=changed(Gym))
                 if newArea:
                     d['gyms'].update(
                         Gym.get_gyms(swLat, swLng, neLat, neLng,
                                      oSwLat=oSwLat, oSwLng=oSwLng,
                                      oNeLat=oNeLat, oNeLng=oNeLng))
 
-        if request.args.get('scanned', 'true') == 'true':
+        if params.get('scanned', 'true') == 'true':
             if lastslocs != 'true':
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng,
-                                                          neLat, neLng)
-            else:
                 d['scanned'] = ScannedLocation.get_recent(swLat, swLng,
                                                           neLat, neLng,
-                                                          timestamp=timestamp)
+                                                          stream=stream)
+            else:
+                d['scanned'] = ScannedLocation.get_recent(
+                    swLat, swLng, neLat, neLng, timestamp=timestamp,
+                    keys=changed(ScannedLocation), stream=stream)
                 if newArea:
-                    d['scanned'] = d['scanned'] + ScannedLocation.get_recent(
-                        swLat, swLng, neLat, neLng, oSwLat=oSwLat,
-                        oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng)
+                    d['scanned'] = concat(
+                        d['scanned'], ScannedLocation.get_recent(
+                            swLat, swLng, neLat, neLng, oSwLat=oSwLat,
+                            oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
+                            stream=stream))
 
         selected_duration = None
 
@@ -409,21 +495,21 @@ class Pogom(Flask):
                 selected_duration = duration["value"]
                 break
 
-        if request.args.get('seen', 'false') == 'true':
+        if params.get('seen', 'false') == 'true':
             d['seen'] = Pokemon.get_seen(selected_duration)
 
-        if request.args.get('appearances', 'false') == 'true':
+        if params.get('appearances', 'false') == 'true':
             d['appearances'] = Pokemon.get_appearances(
-                request.args.get('pokemonid'), selected_duration)
+                params.get('pokemonid'), selected_duration)
 
-        if request.args.get('appearancesDetails', 'false') == 'true':
+        if params.get('appearancesDetails', 'false') == 'true':
             d['appearancesTimes'] = (
                 Pokemon.get_appearances_times_by_spawnpoint(
-                    request.args.get('pokemonid'),
-                    request.args.get('spawnpoint_id'),
+                    params.get('pokemonid'),
+                    params.get('spawnpoint_id'),
                     selected_duration))
 
-        if request.args.get('spawnpoints', 'false') == 'true':
+        if params.get('spawnpoints', 'false') == 'true':
             if lastspawns != 'true':
                 d['spawnpoints'] = Pokemon.get_spawnpoints(
                     swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
@@ -438,16 +524,24 @@ class Pogom(Flask):
                             oSwLat=oSwLat, oSwLng=oSwLng,
                             oNeLat=oNeLat, oNeLng=oNeLng))
 
-        if request.args.get('status', 'false') == 'true':
+        if params.get('status', 'false') == 'true':
             args = get_args()
             d = {}
             if args.status_page_password is None:
                 d['error'] = 'Access denied'
-            elif (request.args.get('password', None) ==
+            elif (params.get('password', None) ==
                   args.status_page_password):
                 d['main_workers'] = MainWorker.get_all()
                 d['workers'] = WorkerStatus.get_all()
-        return jsonify(d)
+
+        # Clients that can decode them get the row sections as columns.
+        if params.get('format') == 'columnar':
+            for section in ('pokemons', 'pokestops', 'scanned',
+                            'spawnpoints'):
+                if section in d:
+                    d[section] = to_columns(d[section])
+
+        return d
 
     def loc(self):
         d = {}
@@ -673,6 +767,9 @@ class CustomJSONEncoder(JSONEncoder):
 
     def default(self, obj):
         try:
+            # Map rows are encoded as objects.
+            if isinstance(obj, MapRow):
+                return dict(obj.iteritems())
             if isinstance(obj, datetime):
                 if obj.utcoffset() is not None:
                     obj = obj - obj.utcoffset()
@@ -687,3 +784,231 @@ class CustomJSONEncoder(JSONEncoder):
         else:
             return list(iterable)
         return JSONEncoder.default(self, obj)
+
+
+# Joins two /raw_data sections, keeping lists as lists and streamed row
+# iterators lazy.
+def concat(first, second):
+    if isinstance(first, list) and isinstance(second, list):
+        return first + second
+    return chain(first, second)
+
+
+# Coordinates in columnar sections are sent as integer deltas between rows,
+# in millionths of a degree.
+COORDINATE_COLUMNS = ('latitude', 'longitude')
+COORDINATE_SCALE = 1000000
+
+
+# Turns rows into a columnar /raw_data section: one array per field, only
+# the names of fields that are always null, parallel index and value arrays
+# for fields that are mostly null, and delta-encoded coordinates. Decoded
+# by decodeColumns() in map.js.
+def to_columns(rows):
+    rows = list(rows)
+    keys = OrderedDict()
+    for row in rows:
+        for key in row:
+            keys[key] = True
+
+    section = {'n': len(rows), 'scale': COORDINATE_SCALE, 'columns': {},
+               'sparse': {}, 'nulls': [], 'deltas': {}}
+    for key in keys:
+        values = [row.get(key) for row in rows]
+        present = [i for i, value in enumerate(values) if value is not None]
+        if not present:
+            section['nulls'].append(key)
+        elif key in COORDINATE_COLUMNS and len(present) == len(values):
+            last = 0
+            deltas = []
+            for value in values:
+                value = int(round(value * COORDINATE_SCALE))
+                deltas.append(value - last)
+                last = value
+            section['deltas'][key] = deltas
+        elif len(present) * 2 < len(values):
+            section['sparse'][key] = [present, [values[i] for i in present]]
+        else:
+            section['columns'][key] = values
+
+    return section
+
+
+# Encodes a /raw_data dict one row at a time. Dicts (gyms) and iterables
+# (lists and row iterators) are written element by element, so rows are
+# only held in memory while they are being encoded.
+def iter_json(d):
+    encode = CustomJSONEncoder().encode
+    yield '{'
+    for i, (key, value) in enumerate(d.iteritems()):
+        yield '{}{}:'.format(',' if i else '', encode(key))
+        if isinstance(value, dict):
+            yield '{'
+            for j, (k, v) in enumerate(value.iteritems()):
+                yield '{}{}:{}'.format(',' if j else '', encode(k), encode(v))
+            yield '}'
+        elif hasattr(value, '__iter__'):
+            yield '['
+            for j, row in enumerate(value):
+                yield '{}{}'.format(',' if j else '', encode(row))
+            yield ']'
+        else:
+            yield encode(value)
+    yield '}'
+
+
+# Gzips a stream of chunks on the fly. Compressing here instead of in
+# flask_compress avoids it buffering the whole body first.
+def iter_gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_json_response(d):
+    chunks = iter_json(d)
+    gzip = 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+    if gzip:
+        chunks = iter_gzip(chunks)
+
+    response = Response(stream_with_context(chunks),
+                        mimetype='application/json')
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+
+    return response
+
+
+# A copy of a file that exists and isn't older than the file. grunt watch
+# rebuilds bundles while the server runs.
+def is_fresh_copy(copy_path, file_path):
+    try:
+        return os.path.getmtime(copy_path) >= os.path.getmtime(file_path)
+    except OSError:
+        return False
+
+
+# A JSON response body with its gzipped copy, so a cached body is
+# compressed once for all the requests it is sent to.
+EncodedBody = namedtuple('EncodedBody', ['data', 'gzip'])
+
+
+def encode_body(data):
+    # Compressed once, so spend more CPU than flask_compress does.
+    return EncodedBody(data, ''.join(iter_gzip([data], level=9)))
+
+
+# Sends the gzipped body if the client accepts it.
+def encoded_json_response(body):
+    gzip = 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+    response = Response(body.gzip if gzip else body.data,
+                        mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+# The map switches of /raw_data, with the parameter that says the client
+# already has the rows of the section, and the default of the switch.
+RAW_DATA_SWITCHES = (('pokemon', 'lastpokemon', 'true'),
+                     ('pokestops', 'lastpokestops', 'true'),
+                     ('gyms', 'lastgyms', 'true'),
+                     ('scanned', 'lastslocs', 'true'),
+                     ('spawnpoints', 'lastspawns', 'false'))
+RAW_DATA_BOUNDS = ('swLat', 'swLng', 'neLat', 'neLng',
+                   'oSwLat', 'oSwLng', 'oNeLat', 'oNeLng')
+
+
+# Only the polls of clients that already have all the sections they show
+# are cached. First loads and requests for particular Pokemon ids depend on
+# the client.
+def cacheable(params):
+    if (params.get('status', 'false') == 'true' or params.get('ids') or
+            params.get('reids')):
+        return False
+
+    return all(params.get(last) == 'true'
+               for switch, last, default in RAW_DATA_SWITCHES
+               if params.get(switch, default) == 'true')
+
+
+# The /raw_data parameters to compute a cached response from: the previous
+# request time rounded down to the cache TTL, so the response has all the
+# changes the clients that share it need, and without the parameters of a
+# single client. The change log sequence id, jQuery's cache buster and the
+# excluded Pokemon are dropped, the map hides excluded Pokemon itself.
+def cache_params(params, ttl):
+    params = params.copy()
+    for key in ('_', 'seq', 'eids'):
+        params.pop(key, None)
+
+    if params.get('timestamp'):
+        step = int(ttl * 1000) or 1
+        params['timestamp'] = str(int(params['timestamp']) // step * step)
+
+    return params
+
+
+# Key a cached response by its parameters, with the bounds rounded to
+# about 100 m so that clients polling near-identical areas share it. The
+# response is computed from and sent back the bounds of the first of them.
+def cache_key(params):
+    key = []
+    for name, value in params.iteritems(multi=True):
+        if name in RAW_DATA_BOUNDS and value:
+            value = '{:.3f}'.format(float(value))
+        elif name.startswith('last'):
+            continue
+        key.append((name, value))
+
+    return tuple(sorted(key))
+
+
+class ResponseCache(object):
+    '''
+    Size-bounded LRU cache of encoded responses that expire after ttl
+    seconds. Concurrent requests for a key that is being computed wait for
+    that computation instead of starting their own.
+    '''
+
+    def __init__(self, maxsize, ttl, wait_timeout=30):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.wait_timeout = wait_timeout
+        self.lock = Lock()
+        self.pending = {}
+
+    def get(self, key, compute):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+            event = self.pending.get(key)
+            if event is None:
+                event = self.pending[key] = Event()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            event.wait(self.wait_timeout)
+            with self.lock:
+                value = self.cache.get(key)
+            # Compute it ourselves if the first request failed or takes too
+            # long.
+            return value if value is not None else compute()
+
+        try:
+            value = compute()
+            with self.lock:
+                self.cache[key] = value
+            return value
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
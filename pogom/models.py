@@ -6,14 +6,19 @@ import itertools
 import calendar
 import sys
 import traceback
-import gc
 import time
 import geopy
 import math
+import json
+import heapq
+import operator
+import copy
+import sqlite3
 from peewee import (InsertQuery, Check, CompositeKey, ForeignKeyField,
                     SmallIntegerField, IntegerField, CharField, DoubleField,
                     BooleanField, DateTimeField, fn, DeleteQuery, FloatField,
-                    SQL, TextField, JOIN, OperationalError)
+                    SQL, TextField, JOIN, OperationalError,
+                    BigIntegerField)
 from playhouse.flask_utils import FlaskDB
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError, case
@@ -21,6 +26,10 @@ from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
 from playhouse.sqlite_ext import SqliteExtDatabase
 from datetime import datetime, timedelta
 from base64 import b64encode
+from collections import OrderedDict, deque
+from bisect import insort
+from queue import Empty, Full
+from threading import Lock, Condition, local
 from cachetools import TTLCache
 from cachetools import cached
 from timeit import default_timer
@@ -29,10 +38,12 @@ from pogom.gainxp import pokestop_spinnable, cleanup_inventory, \
     spin_pokestop_update_inventory, is_ditto
 from pogom.pgscout import pgscout_encounter
 from . import config
-from .utils import (get_pokemon_name, get_pokemon_rarity, get_pokemon_types,
-                    get_args, cellid, in_radius, date_secs, clock_between,
-                    get_move_name, get_move_damage, get_move_energy,
-                    get_move_type, clear_dict_response, calc_pokemon_level)
+from .utils import (get_pokemon_name, get_pokedex, get_args, cellid,
+                    in_radius, date_secs, clock_between, s2_cell_id,
+                    s2_cell_ranges, add_seen_secs, spawn_kind,
+                    union_clock_ranges, get_move_name, get_move_damage,
+                    get_move_energy, get_move_type, clear_dict_response,
+                    calc_pokemon_level)
 from .transform import transform_from_wgs_to_gcj, get_new_coords
 from .customLog import printPokemon
 
@@ -45,14 +56,23 @@ args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
 
-db_schema_version = 21
+db_schema_version = 27
 
 # These Pokemon could be Dittos
 DITTO_POKEDEX_IDS = [16, 19, 41, 129, 161, 163, 193]
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
-    pass
+
+    # Turn off FOREIGN_KEY_CHECKS for the whole session when the pool opens
+    # a new connection, because apparently MySQL is unable to recognize
+    # strings to update unicode keys for foreign key fields, thus giving
+    # lots of foreign key constraint errors. This holds for every query on
+    # every pooled connection, not just the upserts, so nothing may turn
+    # the checks back on before the connection goes back to the pool.
+    def _connect(self, *args, **kwargs):
+        kwargs.setdefault('init_command', 'SET FOREIGN_KEY_CHECKS=0;')
+        return super(MyRetryDB, self)._connect(*args, **kwargs)
 
 
 # Reduction of CharField to fit max length inside 767 bytes for utf8mb4 charset
@@ -62,7 +82,16 @@ class Utf8mb4CharField(CharField):
         super(CharField, self).__init__(*args, **kwargs)
 
 
+class JsonField(TextField):
+    def db_value(self, value):
+        return json.dumps(value)
+
+    def python_value(self, value):
+        return json.loads(value) if value is not None else None
+
+
 def init_database(app):
+    global read_replica
     if args.db_type == 'mysql':
         log.info('Connecting to MySQL database on %s:%i...',
                  args.db_host, args.db_port)
@@ -78,7 +107,24 @@ def init_database(app):
             max_connections=connections,
             stale_timeout=300,
             charset='utf8mb4')
+
+        if args.db_replica_host:
+            port = args.db_replica_port or args.db_port
+            log.info('Reading web pages from MySQL read replica on %s:%i.',
+                     args.db_replica_host, port)
+            read_replica = MyRetryDB(
+                args.db_name,
+                user=args.db_user,
+                password=args.db_pass,
+                host=args.db_replica_host,
+                port=port,
+                max_connections=connections,
+                stale_timeout=300,
+                charset='utf8mb4')
     else:
+        if args.db_replica_host:
+            log.warning('A read replica is only supported for MySQL, '
+                        'ignoring --db-replica-host.')
         log.info('Connecting to local SQLite database')
         db = SqliteExtDatabase(args.db,
                                pragmas=(
@@ -93,8 +139,34 @@ def init_database(app):
     return db
 
 
+# Optional MySQL read replica, and the threads that read from it.
+read_replica = None
+replica_reads = local()
+
+
+# Send the SELECTs of the current thread (the web request being served) to
+# the read replica, if there is one, until end_replica_reads().
+def start_replica_reads():
+    replica_reads.enabled = read_replica is not None
+
+
+def end_replica_reads(exc=None):
+    replica_reads.enabled = False
+    if read_replica is not None and not read_replica.is_closed():
+        read_replica.close()
+
+
 class BaseModel(flaskDb.Model):
 
+    # Like peewee's ReadSlaveModel, but only for the threads that asked for
+    # it, so the scanner keeps reading its own writes from the primary.
+    @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        if getattr(replica_reads, 'enabled', False):
+            query.database = read_replica
+        return query
+
     @classmethod
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
@@ -106,6 +178,84 @@ class BaseModel(flaskDb.Model):
         return results
 
 
+# Columns of a model to send to the map, leaving out the s2_cell_id that is
+# only used to query by location.
+def map_columns(model):
+    return [field for field in model._meta.sorted_fields
+            if field.name != 's2_cell_id']
+
+
+class MapRow(object):
+    '''
+    Compact row of a map query, wrapping the tuple read from a tuples()
+    cursor instead of building a dict per row. The tuple only holds plain
+    values, so the collector stops tracking it after its first pass.
+
+    Reads like a dict (row[key], get(), keys(), iteration over the keys)
+    for the callers and the JSON encoder. Subclasses set their fields with
+    set_fields() and can add derived keys with derive().
+    '''
+
+    __slots__ = ('values',)
+    derived = ()
+
+    def __init__(self, values):
+        self.values = values
+
+    @classmethod
+    def set_fields(cls, fields):
+        cls.fields = tuple(fields)
+        cls.columns = tuple(f.name for f in fields)
+        cls.index = {name: i for i, name in enumerate(cls.columns)}
+
+    # The values of a row dict, in field order.
+    @classmethod
+    def values_of(cls, row):
+        return tuple(row[name] for name in cls.columns)
+
+    def derive(self, key):
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        i = self.index.get(key)
+        return self.derive(key) if i is None else self.values[i]
+
+    def __setitem__(self, key, value):
+        i = self.index[key]
+        self.values = self.values[:i] + (value,) + self.values[i + 1:]
+
+    def __contains__(self, key):
+        return key in self.index or key in self.derived
+
+    def __iter__(self):
+        return itertools.chain(self.columns, self.derived)
+
+    def __len__(self):
+        return len(self.columns) + len(self.derived)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self)
+
+
+# Match the rows of a model in the s2 cells covering a viewport. The cells
+# cover a bit more than the viewport, so callers still filter on latitude
+# and longitude.
+def in_s2_cells(model, swLat, swLng, neLat, neLng):
+    return reduce(operator.or_, [
+        model.s2_cell_id.between(low, high)
+        for low, high in s2_cell_ranges(float(swLat), float(swLng),
+                                        float(neLat), float(neLng))])
+
+
 class Pokemon(BaseModel):
     # We are base64 encoding the ids delivered by the api
     # because they are too big for sqlite to handle.
@@ -114,6 +264,7 @@ class Pokemon(BaseModel):
     pokemon_id = SmallIntegerField(index=True)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
     disappear_time = DateTimeField(index=True)
     individual_attack = SmallIntegerField(null=True)
     individual_defense = SmallIntegerField(null=True)
@@ -139,13 +290,36 @@ class Pokemon(BaseModel):
 
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                   oSwLng=None, oNeLat=None, oNeLng=None):
+                   oSwLng=None, oNeLat=None, oNeLng=None, keys=None,
+                   stream=False):
+        index = live_indexes.get(Pokemon)
+        if index is not None:
+            rows = Pokemon.iter_rows(
+                PokemonRow.values_of(p) for p in index.query(
+                    swLat, swLng, neLat, neLng, timestamp=timestamp,
+                    oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat,
+                    oNeLng=oNeLng, keys=keys))
+            return rows if stream else list(rows)
+
         now_date = datetime.utcnow()
-        query = Pokemon.select()
+        query = Pokemon.select(*PokemonRow.fields)
         if not (swLat and swLng and neLat and neLng):
             query = (query
                      .where(Pokemon.disappear_time > now_date)
-                     .dicts())
+                     .tuples())
+        elif keys is not None:
+            # Only load the Pokemon written since the client's last
+            # sequence id.
+            query = (query
+                     .where((Pokemon.disappear_time > now_date) &
+                            ((Pokemon.latitude >= swLat) &
+                             (Pokemon.longitude >= swLng) &
+                             (Pokemon.latitude <= neLat) &
+                             (Pokemon.longitude <= neLng)))
+                     .tuples())
+            rows = Pokemon.iter_rows(
+                select_by_keys(query, Pokemon.encounter_id, keys))
+            return rows if stream else list(rows)
         elif timestamp > 0:
             # If timestamp is known only load modified Pokemon.
             query = (query
@@ -156,7 +330,7 @@ class Pokemon(BaseModel):
                              (Pokemon.longitude >= swLng) &
                              (Pokemon.latitude <= neLat) &
                              (Pokemon.longitude <= neLng)))
-                     .dicts())
+                     .tuples())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send Pokemon in view but exclude those within old boundaries.
             # Only send newly uncovered Pokemon.
@@ -171,10 +345,9 @@ class Pokemon(BaseModel):
                                (Pokemon.longitude >= oSwLng) &
                                (Pokemon.latitude <= oNeLat) &
                                (Pokemon.longitude <= oNeLng))))
-                     .dicts())
+                     .tuples())
         else:
-            query = (Pokemon
-                     .select()
+            query = (query
                      # Add 1 hour buffer to include spawnpoints that persist
                      # after tth, like shsh.
                      .where((Pokemon.disappear_time > now_date) &
@@ -182,111 +355,79 @@ class Pokemon(BaseModel):
                               (Pokemon.longitude >= swLng) &
                               (Pokemon.latitude <= neLat) &
                               (Pokemon.longitude <= neLng))))
-                     .dicts())
-
-        # Performance:  disable the garbage collector prior to creating a
-        # (potentially) large dict with append().
-        gc.disable()
-
-        pokemon = []
-        for p in list(query):
-
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemon.append(p)
+                     .tuples())
 
-        # Re-enable the GC.
-        gc.enable()
+        if swLat and swLng and neLat and neLng:
+            # Range scan the s2 cells covering the viewport instead of a
+            # whole latitude band.
+            query = query.where(
+                in_s2_cells(Pokemon, swLat, swLng, neLat, neLng))
 
-        return pokemon
+        # Iterate without filling peewee's result cache, so each row only
+        # exists once.
+        rows = Pokemon.iter_rows(query.iterator())
+        return rows if stream else list(rows)
 
     @staticmethod
-    def get_active_by_id(ids, swLat, swLng, neLat, neLng):
+    def get_active_by_id(ids, swLat, swLng, neLat, neLng, stream=False):
+        index = live_indexes.get(Pokemon)
+        if index is not None:
+            ids = set(ids)
+            rows = Pokemon.iter_rows(
+                PokemonRow.values_of(p) for p in index.query(
+                    swLat, swLng, neLat, neLng,
+                    where=lambda p: p['pokemon_id'] in ids))
+            return rows if stream else list(rows)
+
         if not (swLat and swLng and neLat and neLng):
             query = (Pokemon
-                     .select()
+                     .select(*PokemonRow.fields)
                      .where((Pokemon.pokemon_id << ids) &
                             (Pokemon.disappear_time > datetime.utcnow()))
-                     .dicts())
+                     .tuples())
         else:
             query = (Pokemon
-                     .select()
+                     .select(*PokemonRow.fields)
                      .where((Pokemon.pokemon_id << ids) &
                             (Pokemon.disappear_time > datetime.utcnow()) &
                             (Pokemon.latitude >= swLat) &
                             (Pokemon.longitude >= swLng) &
                             (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
-                     .dicts())
-
-        # Performance:  disable the garbage collector prior to creating a
-        # (potentially) large dict with append().
-        gc.disable()
-
-        pokemon = []
-        for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
+                            (Pokemon.longitude <= neLng) &
+                            in_s2_cells(Pokemon, swLat, swLng, neLat, neLng))
+                     .tuples())
+
+        # Iterate without filling peewee's result cache, so each row only
+        # exists once.
+        rows = Pokemon.iter_rows(query.iterator())
+        return rows if stream else list(rows)
+
+    # Wraps the value tuples of Pokemon rows in records as they are read, so
+    # callers can either stream them or collect them into a list. The
+    # records add the display fields from the pokedex.
+    @staticmethod
+    def iter_rows(rows):
+        for values in rows:
+            p = PokemonRow(values)
             if args.china:
                 p['latitude'], p['longitude'] = \
                     transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemon.append(p)
-
-        # Re-enable the GC.
-        gc.enable()
-
-        return pokemon
+            yield p
 
     @classmethod
     @cached(cache)
     def get_seen(cls, timediff):
         if timediff:
             timediff = datetime.utcnow() - timediff
-        pokemon_count_query = (Pokemon
-                               .select(Pokemon.pokemon_id,
-                                       fn.COUNT(Pokemon.pokemon_id).alias(
-                                           'count'),
-                                       fn.MAX(Pokemon.disappear_time).alias(
-                                           'lastappeared')
-                                       )
-                               .where(Pokemon.disappear_time > timediff)
-                               .group_by(Pokemon.pokemon_id)
-                               .alias('counttable')
-                               )
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id,
-                         Pokemon.disappear_time,
-                         Pokemon.latitude,
-                         Pokemon.longitude,
-                         pokemon_count_query.c.count)
-                 .join(pokemon_count_query,
-                       on=(Pokemon.pokemon_id ==
-                           pokemon_count_query.c.pokemon_id))
-                 .distinct()
-                 .where(Pokemon.disappear_time ==
-                        pokemon_count_query.c.lastappeared)
-                 .dicts()
-                 )
-
-        # Performance:  disable the garbage collector prior to creating a
-        # (potentially) large dict with append().
-        gc.disable()
 
+        pokedex = get_pokedex()
         pokemon = []
         total = 0
-        for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+        for p in PokemonHourlySummary.get_seen(timediff):
+            p['pokemon_name'] = pokedex[p['pokemon_id']].name
             pokemon.append(p)
             total += p['count']
 
-        # Re-enable the GC.
-        gc.enable()
-
         return {'pokemon': pokemon, 'total': total}
 
     @classmethod
@@ -298,20 +439,8 @@ class Pokemon(BaseModel):
         '''
         if timediff:
             timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude,
-                         Pokemon.pokemon_id,
-                         fn.Count(Pokemon.spawnpoint_id).alias('count'),
-                         Pokemon.spawnpoint_id)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .group_by(Pokemon.latitude, Pokemon.longitude,
-                           Pokemon.pokemon_id, Pokemon.spawnpoint_id)
-                 .dicts()
-                 )
 
-        return list(query)
+        return PokemonAppearanceSummary.get_appearances(pokemon_id, timediff)
 
     @classmethod
     def get_appearances_times_by_spawnpoint(cls, pokemon_id,
@@ -324,6 +453,13 @@ class Pokemon(BaseModel):
         '''
         if timediff:
             timediff = datetime.utcnow() - timediff
+
+        times = PokemonAppearanceSummary.get_times(pokemon_id, spawnpoint_id,
+                                                   timediff)
+        if times is not None:
+            return times
+
+        # Older times than the summary keeps are in the window.
         query = (Pokemon
                  .select(Pokemon.disappear_time)
                  .where((Pokemon.pokemon_id == pokemon_id) &
@@ -343,68 +479,56 @@ class Pokemon(BaseModel):
     @classmethod
     def get_spawnpoints(cls, swLat, swLng, neLat, neLng, timestamp=0,
                         oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude,
-                         Pokemon.spawnpoint_id,
-                         (date_secs(Pokemon.disappear_time)).alias('time'),
-                         fn.Count(Pokemon.spawnpoint_id).alias('count')))
+        # Read the per-spawnpoint summaries instead of grouping the whole
+        # Pokemon history.
+        summary = SpawnpointDespawnSummary
+        query = (summary
+                 .select(summary.latitude, summary.longitude,
+                         summary.spawnpoint_id,
+                         summary.despawn_secs.alias('time'),
+                         summary.special))
 
         if timestamp > 0:
             query = (query
-                     .where(((Pokemon.last_modified >
+                     .where(((summary.last_modified >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
-                     .dicts())
+                            ((summary.latitude >= swLat) &
+                             (summary.longitude >= swLng) &
+                             (summary.latitude <= neLat) &
+                             (summary.longitude <= neLng))))
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send spawnpoints in view but exclude those within old boundaries.
             # Only send newly uncovered spawnpoints.
             query = (query
-                     .where((((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))) &
-                            ~((Pokemon.latitude >= oSwLat) &
-                              (Pokemon.longitude >= oSwLng) &
-                              (Pokemon.latitude <= oNeLat) &
-                              (Pokemon.longitude <= oNeLng)))
-                     .dicts())
+                     .where((((summary.latitude >= swLat) &
+                              (summary.longitude >= swLng) &
+                              (summary.latitude <= neLat) &
+                              (summary.longitude <= neLng))) &
+                            ~((summary.latitude >= oSwLat) &
+                              (summary.longitude >= oSwLng) &
+                              (summary.latitude <= oNeLat) &
+                              (summary.longitude <= oNeLng))))
         elif swLat and swLng and neLat and neLng:
             query = (query
-                     .where((Pokemon.latitude <= neLat) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.longitude <= neLng)
+                     .where((summary.latitude <= neLat) &
+                            (summary.latitude >= swLat) &
+                            (summary.longitude >= swLng) &
+                            (summary.longitude <= neLng)
                             ))
 
-        query = query.group_by(Pokemon.latitude, Pokemon.longitude,
-                               Pokemon.spawnpoint_id, SQL('time'))
-
-        queryDict = query.dicts()
-        spawnpoints = {}
+        if swLat and swLng and neLat and neLng:
+            query = query.where(
+                in_s2_cells(summary, swLat, swLng, neLat, neLng))
 
-        for sp in queryDict:
-            key = sp['spawnpoint_id']
-            disappear_time = cls.get_spawn_time(sp.pop('time'))
-            count = int(sp['count'])
+        spawnpoints = []
+        for sp in query.dicts().iterator():
+            sp['time'] = cls.get_spawn_time(sp['time'])
+            # Only spawnpoints with more than one despawn time are flagged.
+            if not sp['special']:
+                del sp['special']
+            spawnpoints.append(sp)
 
-            if key not in spawnpoints:
-                spawnpoints[key] = sp
-            else:
-                spawnpoints[key]['special'] = True
-
-            if ('time' not in spawnpoints[key] or
-                    count >= spawnpoints[key]['count']):
-                spawnpoints[key]['time'] = disappear_time
-                spawnpoints[key]['count'] = count
-
-        # Helping out the GC.
-        for sp in spawnpoints.values():
-            del sp['count']
-
-        return list(spawnpoints.values())
+        return spawnpoints
 
     @classmethod
     def get_spawnpoints_in_hex(cls, center, steps):
@@ -412,22 +536,19 @@ class Pokemon(BaseModel):
 
         n, e, s, w = hex_bounds(center, steps)
 
-        query = (Pokemon
-                 .select(Pokemon.latitude.alias('lat'),
-                         Pokemon.longitude.alias('lng'),
-                         (date_secs(Pokemon.disappear_time)).alias('time'),
-                         Pokemon.spawnpoint_id
+        summary = SpawnpointDespawnSummary
+        query = (summary
+                 .select(summary.latitude.alias('lat'),
+                         summary.longitude.alias('lng'),
+                         summary.despawn_secs.alias('time'),
+                         summary.spawnpoint_id
                          ))
-        query = (query.where((Pokemon.latitude <= n) &
-                             (Pokemon.latitude >= s) &
-                             (Pokemon.longitude >= w) &
-                             (Pokemon.longitude <= e)
+        query = (query.where((summary.latitude <= n) &
+                             (summary.latitude >= s) &
+                             (summary.longitude >= w) &
+                             (summary.longitude <= e) &
+                             in_s2_cells(summary, s, w, n, e)
                              ))
-        # Sqlite doesn't support distinct on columns.
-        if args.db_type == 'mysql':
-            query = query.distinct(Pokemon.spawnpoint_id)
-        else:
-            query = query.group_by(Pokemon.spawnpoint_id)
 
         s = list(query.dicts())
 
@@ -454,11 +575,29 @@ class Pokemon(BaseModel):
         return filtered
 
 
+class PokemonRow(MapRow):
+    __slots__ = ()
+
+    # Display fields, looked up in the pokedex when they are read.
+    derived = ('pokemon_name', 'pokemon_rarity', 'pokemon_types')
+
+    def derive(self, key):
+        if key not in self.derived:
+            raise KeyError(key)
+
+        entry = get_pokedex()[self.values[self.index['pokemon_id']]]
+        return entry[self.derived.index(key)]
+
+
+PokemonRow.set_fields(map_columns(Pokemon))
+
+
 class Pokestop(BaseModel):
     pokestop_id = Utf8mb4CharField(primary_key=True, max_length=50)
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     lure_expiration = DateTimeField(null=True, index=True)
     active_fort_modifier = Utf8mb4CharField(max_length=50,
@@ -471,16 +610,37 @@ class Pokestop(BaseModel):
 
     @staticmethod
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                  oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
-
-        query = Pokestop.select(Pokestop.active_fort_modifier,
-                                Pokestop.enabled, Pokestop.latitude,
-                                Pokestop.longitude, Pokestop.last_modified,
-                                Pokestop.lure_expiration, Pokestop.pokestop_id)
+                  oSwLng=None, oNeLat=None, oNeLng=None, lured=False,
+                  keys=None, stream=False):
+        index = live_indexes.get(Pokestop)
+        if index is not None:
+            # Lured only applies to full loads of the viewport.
+            lured = lured and swLat and swLng and neLat and neLng and (
+                timestamp <= 0 and keys is None)
+            rows = Pokestop.iter_rows(
+                PokestopRow.values_of(p) for p in index.query(
+                    swLat, swLng, neLat, neLng, timestamp=timestamp,
+                    oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat,
+                    oNeLng=oNeLng, keys=keys,
+                    where=(lambda p: p['active_fort_modifier'] is not None)
+                    if lured else None))
+            return rows if stream else list(rows)
+
+        query = Pokestop.select(*PokestopRow.fields)
 
         if not (swLat and swLng and neLat and neLng):
             query = (query
-                     .dicts())
+                     .tuples())
+        elif keys is not None:
+            query = (query
+                     .where((Pokestop.latitude >= swLat) &
+                            (Pokestop.longitude >= swLng) &
+                            (Pokestop.latitude <= neLat) &
+                            (Pokestop.longitude <= neLng))
+                     .tuples())
+            rows = Pokestop.iter_rows(
+                select_by_keys(query, Pokestop.pokestop_id, keys))
+            return rows if stream else list(rows)
         elif timestamp > 0:
             query = (query
                      .where(((Pokestop.last_updated >
@@ -489,7 +649,7 @@ class Pokestop(BaseModel):
                             (Pokestop.longitude >= swLng) &
                             (Pokestop.latitude <= neLat) &
                             (Pokestop.longitude <= neLng))
-                     .dicts())
+                     .tuples())
         elif oSwLat and oSwLng and oNeLat and oNeLng and lured:
             query = (query
                      .where((((Pokestop.latitude >= swLat) &
@@ -502,7 +662,7 @@ class Pokestop(BaseModel):
                               (Pokestop.latitude <= oNeLat) &
                               (Pokestop.longitude <= oNeLng)) &
                              (Pokestop.active_fort_modifier.is_null(False)))
-                     .dicts())
+                     .tuples())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send stops in view but exclude those within old boundaries. Only
             # send newly uncovered stops.
@@ -515,7 +675,7 @@ class Pokestop(BaseModel):
                               (Pokestop.longitude >= oSwLng) &
                               (Pokestop.latitude <= oNeLat) &
                               (Pokestop.longitude <= oNeLng)))
-                     .dicts())
+                     .tuples())
         elif lured:
             query = (query
                      .where(((Pokestop.last_updated >
@@ -525,7 +685,7 @@ class Pokestop(BaseModel):
                              (Pokestop.latitude <= neLat) &
                              (Pokestop.longitude <= neLng)) &
                             (Pokestop.active_fort_modifier.is_null(False)))
-                     .dicts())
+                     .tuples())
 
         else:
             query = (query
@@ -533,23 +693,38 @@ class Pokestop(BaseModel):
                             (Pokestop.longitude >= swLng) &
                             (Pokestop.latitude <= neLat) &
                             (Pokestop.longitude <= neLng))
-                     .dicts())
+                     .tuples())
+
+        if swLat and swLng and neLat and neLng:
+            # Range scan the s2 cells covering the viewport instead of a
+            # whole latitude band.
+            query = query.where(
+                in_s2_cells(Pokestop, swLat, swLng, neLat, neLng))
 
-        # Performance:  disable the garbage collector prior to creating a
-        # (potentially) large dict with append().
-        gc.disable()
+        # Iterate without filling peewee's result cache, so each row only
+        # exists once.
+        rows = Pokestop.iter_rows(query.iterator())
+        return rows if stream else list(rows)
 
-        pokestops = []
-        for p in query:
+    # Wraps the value tuples of Pokestop rows in records as they are read.
+    @staticmethod
+    def iter_rows(rows):
+        for values in rows:
+            p = PokestopRow(values)
             if args.china:
                 p['latitude'], p['longitude'] = \
                     transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokestops.append(p)
+            yield p
 
-        # Re-enable the GC.
-        gc.enable()
 
-        return pokestops
+class PokestopRow(MapRow):
+    __slots__ = ()
+
+
+PokestopRow.set_fields((Pokestop.active_fort_modifier, Pokestop.enabled,
+                        Pokestop.latitude, Pokestop.longitude,
+                        Pokestop.last_modified, Pokestop.lure_expiration,
+                        Pokestop.pokestop_id))
 
 
 class Gym(BaseModel):
@@ -561,6 +736,7 @@ class Gym(BaseModel):
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     last_scanned = DateTimeField(default=datetime.utcnow, index=True)
 
@@ -569,31 +745,50 @@ class Gym(BaseModel):
 
     @staticmethod
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                 oSwLng=None, oNeLat=None, oNeLng=None):
-        if not (swLat and swLng and neLat and neLng):
+                 oSwLng=None, oNeLat=None, oNeLng=None, keys=None):
+        index = live_indexes.get(Gym)
+        if index is not None:
+            results = index.query(swLat, swLng, neLat, neLng,
+                                  timestamp=timestamp, oSwLat=oSwLat,
+                                  oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
+                                  keys=keys)
+        elif not (swLat and swLng and neLat and neLng):
             results = (Gym
-                       .select()
+                       .select(*map_columns(Gym))
                        .dicts())
+        elif keys is not None:
+            # Only send the gyms written since the client's last sequence
+            # id.
+            results = select_by_keys(
+                Gym.select(*map_columns(Gym))
+                   .where((Gym.latitude >= swLat) &
+                          (Gym.longitude >= swLng) &
+                          (Gym.latitude <= neLat) &
+                          (Gym.longitude <= neLng))
+                   .dicts(),
+                Gym.gym_id, keys)
         elif timestamp > 0:
             # If timestamp is known only send last scanned Gyms.
             results = (Gym
-                       .select()
+                       .select(*map_columns(Gym))
                        .where(((Gym.last_scanned >
                                 datetime.utcfromtimestamp(timestamp / 1000)) &
                                (Gym.latitude >= swLat) &
                                (Gym.longitude >= swLng) &
                                (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)))
+                               (Gym.longitude <= neLng) &
+                               in_s2_cells(Gym, swLat, swLng, neLat, neLng)))
                        .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send gyms in view but exclude those within old boundaries. Only
             # send newly uncovered gyms.
             results = (Gym
-                       .select()
+                       .select(*map_columns(Gym))
                        .where(((Gym.latitude >= swLat) &
                                (Gym.longitude >= swLng) &
                                (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)) &
+                               (Gym.longitude <= neLng) &
+                               in_s2_cells(Gym, swLat, swLng, neLat, neLng)) &
                               ~((Gym.latitude >= oSwLat) &
                                 (Gym.longitude >= oSwLng) &
                                 (Gym.latitude <= oNeLat) &
@@ -602,17 +797,14 @@ class Gym(BaseModel):
 
         else:
             results = (Gym
-                       .select()
+                       .select(*map_columns(Gym))
                        .where((Gym.latitude >= swLat) &
                               (Gym.longitude >= swLng) &
                               (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng))
+                              (Gym.longitude <= neLng) &
+                              in_s2_cells(Gym, swLat, swLng, neLat, neLng))
                        .dicts())
 
-        # Performance:  disable the garbage collector prior to creating a
-        # (potentially) large dict with append().
-        gc.disable()
-
         gyms = {}
         gym_ids = []
         for g in results:
@@ -640,8 +832,9 @@ class Gym(BaseModel):
                        .distinct()
                        .dicts())
 
+            pokedex = get_pokedex()
             for p in pokemon:
-                p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+                p['pokemon_name'] = pokedex[p['pokemon_id']].name
                 gyms[p['gym_id']]['pokemon'].append(p)
 
             details = (GymDetails
@@ -654,9 +847,6 @@ class Gym(BaseModel):
             for d in details:
                 gyms[d['gym_id']]['name'] = d['name']
 
-        # Re-enable the GC.
-        gc.enable()
-
         return gyms
 
     @staticmethod
@@ -725,6 +915,7 @@ class LocationAltitude(BaseModel):
     cellid = Utf8mb4CharField(primary_key=True, max_length=50)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True, default=datetime.utcnow,
                                   null=True)
     altitude = DoubleField()
@@ -738,6 +929,7 @@ class LocationAltitude(BaseModel):
         return {'cellid': cellid(loc),
                 'latitude': loc[0],
                 'longitude': loc[1],
+                's2_cell_id': s2_cell_id(loc[0], loc[1]),
                 'altitude': altitude}
 
     # find a nearby altitude from the db
@@ -752,7 +944,8 @@ class LocationAltitude(BaseModel):
                  .where((cls.latitude <= n) &
                         (cls.latitude >= s) &
                         (cls.longitude >= w) &
-                        (cls.longitude <= e))
+                        (cls.longitude <= e) &
+                        in_s2_cells(cls, s, w, n, e))
                  .dicts())
 
         altitude = None
@@ -770,6 +963,7 @@ class ScannedLocation(BaseModel):
     cellid = Utf8mb4CharField(primary_key=True, max_length=50)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(
         index=True, default=datetime.utcnow, null=True)
     # Marked true when all five bands have been completed.
@@ -809,11 +1003,35 @@ class ScannedLocation(BaseModel):
 
     @staticmethod
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                   oSwLng=None, oNeLat=None, oNeLng=None):
+                   oSwLng=None, oNeLat=None, oNeLng=None, keys=None,
+                   stream=False):
         activeTime = (datetime.utcnow() - timedelta(minutes=15))
-        if timestamp > 0:
+        index = live_indexes.get(ScannedLocation)
+        if index is not None:
+            rows = index.query(swLat, swLng, neLat, neLng,
+                               timestamp=timestamp, oSwLat=oSwLat,
+                               oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
+                               keys=keys)
+            if not timestamp > 0 and keys is None and not (
+                    oSwLat and oSwLng and oNeLat and oNeLng):
+                rows.sort(key=lambda loc: loc['last_modified'])
+            return iter(rows) if stream else rows
+
+        if keys is not None:
+            # Only send the locations written since the client's last
+            # sequence id.
             query = (ScannedLocation
-                     .select()
+                     .select(*map_columns(ScannedLocation))
+                     .where((ScannedLocation.latitude >= swLat) &
+                            (ScannedLocation.longitude >= swLng) &
+                            (ScannedLocation.latitude <= neLat) &
+                            (ScannedLocation.longitude <= neLng))
+                     .dicts())
+            rows = select_by_keys(query, ScannedLocation.cellid, keys)
+            return rows if stream else list(rows)
+        elif timestamp > 0:
+            query = (ScannedLocation
+                     .select(*map_columns(ScannedLocation))
                      .where(((ScannedLocation.last_modified >=
                               datetime.utcfromtimestamp(timestamp / 1000))) &
                             (ScannedLocation.latitude >= swLat) &
@@ -825,7 +1043,7 @@ class ScannedLocation(BaseModel):
             # Send scannedlocations in view but exclude those within old
             # boundaries. Only send newly uncovered scannedlocations.
             query = (ScannedLocation
-                     .select()
+                     .select(*map_columns(ScannedLocation))
                      .where((((ScannedLocation.last_modified >= activeTime)) &
                              (ScannedLocation.latitude >= swLat) &
                              (ScannedLocation.longitude >= swLng) &
@@ -839,7 +1057,7 @@ class ScannedLocation(BaseModel):
                      .dicts())
         else:
             query = (ScannedLocation
-                     .select()
+                     .select(*map_columns(ScannedLocation))
                      .where((ScannedLocation.last_modified >= activeTime) &
                             (ScannedLocation.latitude >= swLat) &
                             (ScannedLocation.longitude >= swLng) &
@@ -848,6 +1066,15 @@ class ScannedLocation(BaseModel):
                      .order_by(ScannedLocation.last_modified.asc())
                      .dicts())
 
+        if swLat and swLng and neLat and neLng:
+            # Range scan the s2 cells covering the viewport instead of a
+            # whole latitude band.
+            query = query.where(
+                in_s2_cells(ScannedLocation, swLat, swLng, neLat, neLng))
+
+        if stream:
+            return query.iterator()
+
         return list(query)
 
     # DB format of a new location.
@@ -907,7 +1134,9 @@ class ScannedLocation(BaseModel):
                  .where(cls.cellid == cellid(loc))
                  .dicts())
 
-        return query[0] if len(list(query)) else cls.new_loc(loc)
+        rows = list(query)
+
+        return rows[0] if rows else cls.new_loc(loc)
 
     # Check if spawnpoints in a list are in any of the existing
     # spannedlocation records.  Otherwise, search through the spawnpoint list
@@ -947,6 +1176,21 @@ class ScannedLocation(BaseModel):
 
         return list(query)
 
+    # Return a dict of cellid -> set of ids of the spawnpoints linked to it.
+    @classmethod
+    def get_cell_to_linked_spawn_point_ids(cls, cellids):
+        query = (ScanSpawnPoint
+                 .select(ScanSpawnPoint.scannedlocation,
+                         ScanSpawnPoint.spawnpoint)
+                 .where(ScanSpawnPoint.scannedlocation << cellids)
+                 .tuples())
+
+        d = {}
+        for cell, sp_id in query:
+            d.setdefault(cell, set()).add(sp_id)
+
+        return d
+
     # Return list of dicts for upcoming valid band times.
     @classmethod
     def get_cell_to_linked_spawn_points(cls, cellids, location_change_date):
@@ -1211,6 +1455,7 @@ class SpawnPoint(BaseModel):
     id = Utf8mb4CharField(primary_key=True, max_length=50)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
     last_scanned = DateTimeField(index=True)
     # kind gives the four quartiles of the spawn, as 's' for seen
     # or 'h' for hidden.  For example, a 30 minute spawn is 'hhss'.
@@ -1246,15 +1491,10 @@ class SpawnPoint(BaseModel):
                        Check('earliest_unseen < 3600'),
                        Check('latest_seen >= 0'), Check('latest_seen < 3600')]
 
-    # Returns the spawnpoint dict from ID, or a new dict if not found.
-    @classmethod
-    def get_by_id(cls, id, latitude=0, longitude=0):
-        query = (cls
-                 .select()
-                 .where(cls.id == id)
-                 .dicts())
-
-        return query[0] if query else {
+    # Returns a new spawnpoint dict.
+    @staticmethod
+    def new_sp(id, latitude=0, longitude=0):
+        return {
             'id': id,
             'latitude': latitude,
             'longitude': longitude,
@@ -1409,7 +1649,8 @@ class SpawnPoint(BaseModel):
                   .where((cls.latitude <= n) &
                          (cls.latitude >= s) &
                          (cls.longitude >= w) &
-                         (cls.longitude <= e))
+                         (cls.longitude <= e) &
+                         in_s2_cells(cls, s, w, n, e))
                   .dicts())
 
         # For each spawn work out if it is in the hex (clipping the diagonals).
@@ -1454,23 +1695,140 @@ class SpawnpointDetectionData(BaseModel):
     def set_default_earliest_unseen(sp):
         sp['earliest_unseen'] = (sp['latest_seen'] + 15 * 60) % 3600
 
+    # Return the summaries of the sightings of spawnpoints by id. The ones
+    # that aren't cached or in the DB yet are built from the detection data,
+    # all in one query.
+    @classmethod
+    def get_summaries(cls, spawnpoint_ids):
+        summaries = sighting_summary_cache.get_many(spawnpoint_ids)
+        missing = set(spawnpoint_ids) - set(summaries)
+        if not missing:
+            return summaries
+
+        built = {}
+        for spawnpoint_id in missing:
+            built[spawnpoint_id] = SpawnpointDetectionSummary.new_summary(
+                spawnpoint_id)
+        query = (cls
+                 .select()
+                 .order_by(cls.scan_time.asc())
+                 .dicts())
+        for s in select_by_keys(query, cls.spawnpoint_id, missing):
+            cls.add_sighting(built[s['spawnpoint_id']], s)
+        sighting_summary_cache.update(built)
+        summaries.update(built)
+
+        return summaries
+
+    # Add a sighting to the summary of its spawnpoint. The sightings of the
+    # last hour are kept in the order they were made, so the ones that are
+    # parsed out of order are paired with the right neighbours. Older
+    # sightings are folded into the union of the same encounter id ranges,
+    # the latest TTH and the latest folded sighting.
     @classmethod
-    def classify(cls, sp, scan_loc, now_secs, sighting=None):
+    def add_sighting(cls, summary, sighting):
+        summary['seen_secs'] = add_seen_secs(
+            summary['seen_secs'], date_secs(sighting['scan_time']))
+
+        last_scan_time = summary['scan_time']
+        if last_scan_time and sighting['scan_time'] <= last_scan_time:
+            # More than an hour older than the latest sighting, too late to
+            # pair it with the sightings around it.
+            if summary['tth_secs'] is None:
+                summary['tth_secs'] = sighting['tth_secs']
+            return
+
+        recent = summary['recent'] = summary['recent'] or []
+        scan_secs = (sighting['scan_time'] -
+                     datetime(1970, 1, 1)).total_seconds()
+        insort(recent, [scan_secs, sighting['encounter_id'],
+                        sighting['tth_secs']])
+
+        while recent[0][0] < recent[-1][0] - 3600:
+            scan_secs, encounter_id, tth_secs = recent.pop(0)
+            scan_time = datetime.utcfromtimestamp(scan_secs)
+            if last_scan_time:
+                same_range = cls.same_range(
+                    last_scan_time, summary['encounter_id'],
+                    scan_time, encounter_id)
+                if same_range:
+                    summary['same_ranges'] = union_clock_ranges(
+                        summary['same_ranges'] + [same_range])
+
+            if tth_secs is not None:
+                summary['tth_secs'] = tth_secs
+            summary['scan_time'] = last_scan_time = scan_time
+            summary['encounter_id'] = encounter_id
+
+    # The clock range between two sightings, if close enough, where the
+    # encounter id was the same. If a different encounter ID was seen, then
+    # the complement of that range was the same ID.
+    @staticmethod
+    def same_range(scan_time, encounter_id, next_scan_time,
+                   next_encounter_id):
+        delta = next_scan_time - scan_time
+        if delta >= timedelta(hours=1):
+            return None
+
+        if next_encounter_id == encounter_id:
+            # Get the seconds past the hour for start and end times.
+            start = date_secs(scan_time)
+            end = (start + int(delta.total_seconds())) % 3600
+        else:
+            # Convert diff range to same range by taking the clock
+            # complement.
+            start = date_secs(next_scan_time)
+            end = date_secs(scan_time)
+
+        return [start, end]
+
+    # The TTH of the latest sighting that had one, in seconds after the hour.
+    @staticmethod
+    def summary_tth_secs(summary):
+        for __, __, tth_secs in reversed(summary['recent'] or []):
+            if tth_secs is not None:
+                return tth_secs
+
+        return summary['tth_secs']
+
+    # The union of the clock ranges over which the same encounter id was
+    # seen, of all the sightings of a summary.
+    @classmethod
+    def summary_same_ranges(cls, summary):
+        ranges = list(summary['same_ranges'])
+        scan_time = summary['scan_time']
+        encounter_id = summary['encounter_id']
+        for scan_secs, next_encounter_id, __ in summary['recent'] or []:
+            next_scan_time = datetime.utcfromtimestamp(scan_secs)
+            if scan_time:
+                same_range = cls.same_range(scan_time, encounter_id,
+                                            next_scan_time, next_encounter_id)
+                if same_range:
+                    ranges.append(same_range)
+            scan_time = next_scan_time
+            encounter_id = next_encounter_id
+
+        return union_clock_ranges(ranges)
+
+    # Classify a spawnpoint from the summary of its sightings. Callers that
+    # classify many spawnpoints pass the summaries from get_summaries().
+    @classmethod
+    def classify(cls, sp, scan_loc, now_secs, sighting=None,
+                 summaries=None):
 
-        # Get past sightings.
-        query = list(cls.select()
-                        .where(cls.spawnpoint_id == sp['id'])
-                        .order_by(cls.scan_time.asc())
-                        .dicts())
+        # Get the summary of past sightings.
+        if summaries is None or sp['id'] not in summaries:
+            summaries = cls.get_summaries([sp['id']])
+        summary = summaries[sp['id']]
 
         if sighting:
-            query.append(sighting)
+            cls.add_sighting(summary, sighting)
+            sighting_summary_cache.update({sp['id']: summary})
 
-        tth_found = False
-        for s in query:
-            if s['tth_secs'] is not None:
-                tth_found = True
-                tth_secs = (s['tth_secs'] - 1) % 3600
+        tth_secs = cls.summary_tth_secs(summary)
+        tth_found = tth_secs is not None
+        if tth_found:
+            tth_secs = (tth_secs - 1) % 3600
 
         # To reduce CPU usage, give an intial reading of 15 minute spawns if
         # not done with initial scan of location.
@@ -1492,37 +1850,12 @@ class SpawnpointDetectionData(BaseModel):
         # if it changes.
         old_kind = str(sp['kind'])
         # Make a sorted list of the seconds after the hour.
-        seen_secs = sorted(map(lambda x: date_secs(x['scan_time']), query))
+        seen_secs = list(summary['seen_secs'])
         # Include and entry for the TTH if it found
         if tth_found:
-            seen_secs.append(tth_secs)
-            seen_secs.sort()
-        # Add the first seen_secs to the end as a clock wrap around.
-        if seen_secs:
-            seen_secs.append(seen_secs[0] + 3600)
-
-        # Make a list of gaps between sightings.
-        gap_list = [seen_secs[i + 1] - seen_secs[i]
-                    for i in range(len(seen_secs) - 1)]
-
-        max_gap = max(gap_list)
+            insort(seen_secs, tth_secs)
 
-        # An hour minus the largest gap in minutes gives us the duration the
-        # spawn was there.  Round up to the nearest 15 minute interval for our
-        # current best guess duration.
-        duration = (int((60 - max_gap / 60.0) / 15) + 1) * 15
-
-        # If the second largest gap is larger than 15 minutes, then there are
-        # two gaps greater than 15 minutes.  It must be a double spawn.
-        if len(gap_list) > 4 and sorted(gap_list)[-2] > 900:
-            sp['kind'] = 'hshs'
-            sp['links'] = 'h?h?'
-
-        else:
-            # Convert the duration into a 'hhhs', 'hhss', 'hsss', 'ssss' string
-            # accordingly.  's' is for seen, 'h' is for hidden.
-            sp['kind'] = ''.join(
-                ['s' if i > (3 - duration / 15) else 'h' for i in range(0, 4)])
+        sp['kind'], latest_seen = spawn_kind(seen_secs)
 
         # Assume no hidden times.
         sp['links'] = sp['kind'].replace('s', '?')
@@ -1534,7 +1867,7 @@ class SpawnpointDetectionData(BaseModel):
                     not tth_found):
 
                 # New latest_seen will be just before max_gap.
-                sp['latest_seen'] = seen_secs[gap_list.index(max_gap)]
+                sp['latest_seen'] = latest_seen
 
                 # if we don't have a earliest_unseen yet or if the kind of
                 # spawn has changed, reset to latest_seen + 14 minutes.
@@ -1548,69 +1881,11 @@ class SpawnpointDetectionData(BaseModel):
         if sp['earliest_unseen'] == sp['latest_seen']:
             return
 
-        # Make a sight_list of dicts:
-        # {date: first seen time,
-        # delta: duration of sighting,
-        # same: whether encounter ID was same or different over that time}
-        #
         # For 60 minute spawns ('ssss'), the largest gap doesn't give the
         # earliest spawnpoint because a Pokemon is always there.  Use the union
         # of all intervals where the same encounter ID was seen to find the
-        # latest_seen.  If a different encounter ID was seen, then the
-        # complement of that interval was the same ID, so union that
-        # complement as well.
-
-        sight_list = [{'date': query[i]['scan_time'],
-                       'delta': query[i + 1]['scan_time'] -
-                       query[i]['scan_time'],
-                       'same': query[i + 1]['encounter_id'] ==
-                       query[i]['encounter_id']
-                       }
-                      for i in range(len(query) - 1)
-                      if query[i + 1]['scan_time'] - query[i]['scan_time'] <
-                      timedelta(hours=1)
-                      ]
-
-        start_end_list = []
-        for s in sight_list:
-            if s['same']:
-                # Get the seconds past the hour for start and end times.
-                start = date_secs(s['date'])
-                end = (start + int(s['delta'].total_seconds())) % 3600
-
-            else:
-                # Convert diff range to same range by taking the clock
-                # complement.
-                start = date_secs(s['date'] + s['delta']) % 3600
-                end = date_secs(s['date'])
-
-            start_end_list.append([start, end])
-
-        # Take the union of all the ranges.
-        while True:
-            # union is list of unions of ranges with the same encounter id.
-            union = []
-            for start, end in start_end_list:
-                if not union:
-                    union.append([start, end])
-                    continue
-                # Cycle through all ranges in union, since it might overlap
-                # with any of them.
-                for u in union:
-                    if clock_between(u[0], start, u[1]):
-                        u[1] = end if not(clock_between(
-                            u[0], end, u[1])) else u[1]
-                    elif clock_between(u[0], end, u[1]):
-                        u[0] = start if not(clock_between(
-                            u[0], start, u[1])) else u[0]
-                    elif union.count([start, end]) == 0:
-                        union.append([start, end])
-
-            # Are no more unions possible?
-            if union == start_end_list:
-                break
-
-            start_end_list = union  # Make another pass looking for unions.
+        # latest_seen.
+        union = cls.summary_same_ranges(summary)
 
         # If more than one disparate union, take the largest as our starting
         # point.
@@ -1640,6 +1915,820 @@ class SpawnpointDetectionData(BaseModel):
         return True
 
 
+class SpawnpointDetectionSummary(BaseModel):
+    spawnpoint_id = Utf8mb4CharField(primary_key=True, max_length=54)
+    # Sorted seconds after the hour at which the spawnpoint was seen.
+    seen_secs = JsonField()
+    # Union of the [start, end] clock ranges over which the same encounter
+    # id was seen, between the sightings older than the recent ones.
+    same_ranges = JsonField()
+    # Latest TTH seen before the recent sightings, in seconds after the hour.
+    tth_secs = SmallIntegerField(null=True)
+    # Latest sighting before the recent ones, to get the range to the next
+    # one.
+    scan_time = DateTimeField(null=True)
+    encounter_id = Utf8mb4CharField(max_length=54, null=True)
+    # [scan time in seconds since the epoch, encounter id, TTH seconds] of
+    # the sightings of the hour before the latest one, oldest first.
+    recent = JsonField(null=True)
+
+    @staticmethod
+    def new_summary(spawnpoint_id):
+        return {
+            'spawnpoint_id': spawnpoint_id,
+            'seen_secs': [],
+            'same_ranges': [],
+            'tth_secs': None,
+            'scan_time': None,
+            'encounter_id': None,
+            'recent': []
+        }
+
+
+class SpawnpointDespawnSummary(BaseModel):
+    spawnpoint_id = Utf8mb4CharField(primary_key=True, max_length=54)
+    latitude = DoubleField()
+    longitude = DoubleField()
+    s2_cell_id = BigIntegerField(null=True, index=True)
+    # Number of Pokemon stored per despawn time, in seconds after the hour.
+    despawn_counts = JsonField()
+    # Most common despawn time and its number of Pokemon.
+    despawn_secs = SmallIntegerField()
+    count = IntegerField()
+    # Pokemon were seen despawning at more than one time.
+    special = BooleanField(default=False)
+    last_modified = DateTimeField(index=True, default=datetime.utcnow)
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
+
+    @staticmethod
+    def new_summary(p):
+        return {
+            'spawnpoint_id': p['spawnpoint_id'],
+            'latitude': p['latitude'],
+            'longitude': p['longitude'],
+            'despawn_counts': {},
+            'despawn_secs': 0,
+            'count': 0,
+            'special': False
+        }
+
+    @staticmethod
+    def add_count(summary, despawn_secs, count=1):
+        counts = summary['despawn_counts']
+        key = str(despawn_secs)
+        counts[key] = counts.get(key, 0) + count
+        # Counts only grow, so only the changed time can take over.
+        if counts[key] > summary['count']:
+            summary['despawn_secs'] = despawn_secs
+            summary['count'] = counts[key]
+        summary['special'] = len(counts) > 1
+
+    # Count the despawn times of Pokemon newly written to the DB.
+    @classmethod
+    def add_pokemon(cls, pokemon, db):
+        now_date = datetime.utcnow()
+        with summary_lock:
+            summaries = {s['spawnpoint_id']: s for s in select_by_keys(
+                cls.select().dicts(), cls.spawnpoint_id,
+                set(p['spawnpoint_id'] for p in pokemon))}
+
+            for p in pokemon:
+                summary = summaries.get(p['spawnpoint_id'])
+                if summary is None:
+                    summary = summaries[p['spawnpoint_id']] = \
+                        cls.new_summary(p)
+
+                cls.add_count(summary, date_secs(p['disappear_time']))
+                summary['last_modified'] = now_date
+
+            if summaries:
+                bulk_upsert(cls, summaries, db)
+
+    # Build the summaries from the Pokemon already in the DB.
+    @classmethod
+    def backfill(cls, db):
+        query = (Pokemon
+                 .select(Pokemon.spawnpoint_id, Pokemon.latitude,
+                         Pokemon.longitude,
+                         (date_secs(Pokemon.disappear_time)).alias('time'),
+                         fn.Count(Pokemon.spawnpoint_id).alias('count'))
+                 .group_by(Pokemon.latitude, Pokemon.longitude,
+                           Pokemon.spawnpoint_id, SQL('time'))
+                 .dicts())
+
+        summaries = {}
+        for p in query.iterator():
+            summary = summaries.get(p['spawnpoint_id'])
+            if summary is None:
+                summary = summaries[p['spawnpoint_id']] = cls.new_summary(p)
+            cls.add_count(summary, p['time'], int(p['count']))
+
+        log.info('Summarizing the despawn times of %d spawnpoints.',
+                 len(summaries))
+        if summaries:
+            bulk_upsert(cls, summaries, db)
+
+
+class PokemonHourlySummary(BaseModel):
+    pokemon_id = SmallIntegerField()
+    # Hour the counted Pokemon disappeared in.
+    hour = DateTimeField(index=True)
+    count = IntegerField()
+    # Latest disappear time in the hour, and where.
+    last_appeared = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'hour')
+
+    @staticmethod
+    def add_count(summaries, pokemon_id, disappear_time, latitude,
+                  longitude):
+        hour = disappear_time.replace(minute=0, second=0, microsecond=0)
+        summary = summaries.get((pokemon_id, hour))
+        if summary is None:
+            summary = summaries[(pokemon_id, hour)] = {
+                'pokemon_id': pokemon_id,
+                'hour': hour,
+                'count': 0,
+                'last_appeared': disappear_time,
+                'latitude': latitude,
+                'longitude': longitude
+            }
+
+        summary['count'] += 1
+        if disappear_time > summary['last_appeared']:
+            summary['last_appeared'] = disappear_time
+            summary['latitude'] = latitude
+            summary['longitude'] = longitude
+
+        return (pokemon_id, hour)
+
+    # Count Pokemon newly written to the DB in their hourly buckets.
+    @classmethod
+    def add_pokemon(cls, pokemon, db):
+        hours = set(p['disappear_time'].replace(
+            minute=0, second=0, microsecond=0) for p in pokemon)
+        with summary_lock:
+            summaries = {(s['pokemon_id'], s['hour']): s for s in cls
+                         .select()
+                         .where(cls.hour << list(hours))
+                         .dicts()}
+            changed = {}
+            for p in pokemon:
+                key = cls.add_count(summaries, p['pokemon_id'],
+                                    p['disappear_time'], p['latitude'],
+                                    p['longitude'])
+                changed[key] = summaries[key]
+
+            if changed:
+                bulk_upsert(cls, changed, db)
+
+    # Build the hourly buckets from the Pokemon already in the DB.
+    @classmethod
+    def backfill(cls, db):
+        query = (Pokemon
+                 .select(Pokemon.pokemon_id, Pokemon.disappear_time,
+                         Pokemon.latitude, Pokemon.longitude)
+                 .tuples())
+
+        summaries = {}
+        for p in query.iterator():
+            cls.add_count(summaries, *p)
+
+        log.info('Summarizing %d hours of Pokemon sightings.',
+                 len(set(hour for __, hour in summaries)))
+        if summaries:
+            bulk_upsert(cls, summaries, db)
+
+    # Number of Pokemon per species that disappeared after a time (or
+    # ever), with the latest disappear time and where. Whole hours are
+    # summed from the buckets, the partial first hour is read from the
+    # Pokemon themselves.
+    @classmethod
+    def get_seen(cls, since=None):
+        summaries = {}
+        query = cls.select().dicts()
+        if since:
+            next_hour = since.replace(
+                minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            query = query.where(cls.hour >= next_hour)
+            first_hour = (Pokemon
+                          .select(Pokemon.pokemon_id,
+                                  Pokemon.disappear_time,
+                                  Pokemon.latitude, Pokemon.longitude)
+                          .where((Pokemon.disappear_time > since) &
+                                 (Pokemon.disappear_time < next_hour))
+                          .tuples())
+            for p in first_hour.iterator():
+                cls.add_count(summaries, *p)
+
+        seen = {}
+        for s in itertools.chain(query.iterator(), summaries.itervalues()):
+            p = seen.get(s['pokemon_id'])
+            if p is None:
+                seen[s['pokemon_id']] = {
+                    'pokemon_id': s['pokemon_id'],
+                    'count': s['count'],
+                    'disappear_time': s['last_appeared'],
+                    'latitude': s['latitude'],
+                    'longitude': s['longitude']
+                }
+                continue
+
+            p['count'] += s['count']
+            if s['last_appeared'] > p['disappear_time']:
+                p['disappear_time'] = s['last_appeared']
+                p['latitude'] = s['latitude']
+                p['longitude'] = s['longitude']
+
+        return seen.values()
+
+
+class PokemonAppearanceSummary(BaseModel):
+    pokemon_id = SmallIntegerField()
+    spawnpoint_id = Utf8mb4CharField(max_length=54)
+    latitude = DoubleField()
+    longitude = DoubleField()
+    # Number of appearances per UTC day of the disappear time.
+    day_counts = JsonField()
+    # Latest disappear times, as sorted Unix timestamps.
+    recent_times = JsonField()
+
+    # Number of disappear times kept per species and spawnpoint.
+    times_kept = 100
+    # Days counted one by one, for the longest period of the statistics
+    # page (a year). The counts of older days are summed under older_days,
+    # which sorts before all days.
+    days_kept = 366
+    older_days = '0000-00-00'
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'spawnpoint_id')
+
+    @classmethod
+    def add_count(cls, summaries, pokemon_id, spawnpoint_id, latitude,
+                  longitude, disappear_time):
+        summary = summaries.get((pokemon_id, spawnpoint_id))
+        if summary is None:
+            summary = summaries[(pokemon_id, spawnpoint_id)] = {
+                'pokemon_id': pokemon_id,
+                'spawnpoint_id': spawnpoint_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'day_counts': {},
+                'recent_times': []
+            }
+
+        day = disappear_time.date().isoformat()
+        summary['day_counts'][day] = summary['day_counts'].get(day, 0) + 1
+        times = summary['recent_times']
+        insort(times, calendar.timegm(disappear_time.timetuple()))
+        # Trim in batches, backfills add many times per summary.
+        if len(times) > 2 * cls.times_kept:
+            del times[:-cls.times_kept]
+
+        return (pokemon_id, spawnpoint_id)
+
+    # Sum the counts of the days before days_kept under older_days.
+    @classmethod
+    def trim_days(cls, summary, now_date):
+        first_day = (now_date - timedelta(days=cls.days_kept)).date()
+        day_counts = summary['day_counts']
+        for day in [day for day in day_counts
+                    if cls.older_days < day < first_day.isoformat()]:
+            day_counts[cls.older_days] = (day_counts.get(cls.older_days, 0) +
+                                          day_counts.pop(day))
+
+    # Count the appearances of Pokemon newly written to the DB.
+    @classmethod
+    def add_pokemon(cls, pokemon, db):
+        with summary_lock:
+            # Read the summaries of all species of the batch at once. The
+            # query also matches species at spawnpoints where only others
+            # were seen, those are left out.
+            keys = set((p['pokemon_id'], p['spawnpoint_id'])
+                       for p in pokemon)
+            query = (cls
+                     .select()
+                     .where(cls.pokemon_id << list(set(
+                         pokemon_id for pokemon_id, __ in keys)))
+                     .dicts())
+            summaries = {}
+            for s in select_by_keys(query, cls.spawnpoint_id, set(
+                    spawnpoint_id for __, spawnpoint_id in keys)):
+                key = (s['pokemon_id'], s['spawnpoint_id'])
+                if key in keys:
+                    summaries[key] = s
+
+            changed = {}
+            for p in pokemon:
+                key = cls.add_count(summaries, p['pokemon_id'],
+                                    p['spawnpoint_id'], p['latitude'],
+                                    p['longitude'], p['disappear_time'])
+                changed[key] = summaries[key]
+
+            now_date = datetime.utcnow()
+            for summary in changed.itervalues():
+                del summary['recent_times'][:-cls.times_kept]
+                cls.trim_days(summary, now_date)
+            if changed:
+                bulk_upsert(cls, changed, db)
+
+    # Build the summaries from the Pokemon already in the DB.
+    @classmethod
+    def backfill(cls, db):
+        query = (Pokemon
+                 .select(Pokemon.pokemon_id, Pokemon.spawnpoint_id,
+                         Pokemon.latitude, Pokemon.longitude,
+                         Pokemon.disappear_time)
+                 .tuples())
+
+        summaries = {}
+        for p in query.iterator():
+            cls.add_count(summaries, *p)
+
+        log.info('Summarizing the appearances of %d Pokemon at '
+                 'spawnpoints.', len(summaries))
+        now_date = datetime.utcnow()
+        for summary in summaries.itervalues():
+            del summary['recent_times'][:-cls.times_kept]
+            cls.trim_days(summary, now_date)
+        if summaries:
+            bulk_upsert(cls, summaries, db)
+
+    # Number of appearances of a species per spawnpoint after a time (or
+    # ever). Whole days are summed from the summaries, the partial first
+    # day is read from the Pokemon themselves.
+    @classmethod
+    def get_appearances(cls, pokemon_id, since=None):
+        first_day = {}
+        if since:
+            next_day = datetime.combine(since.date() + timedelta(days=1),
+                                        datetime.min.time())
+            query = (Pokemon
+                     .select(Pokemon.spawnpoint_id,
+                             fn.Count(Pokemon.spawnpoint_id).alias('count'))
+                     .where((Pokemon.pokemon_id == pokemon_id) &
+                            (Pokemon.disappear_time > since) &
+                            (Pokemon.disappear_time < next_day))
+                     .group_by(Pokemon.spawnpoint_id)
+                     .tuples())
+            first_day = {spawnpoint_id: int(count)
+                         for spawnpoint_id, count in query}
+
+        query = (cls
+                 .select()
+                 .where(cls.pokemon_id == pokemon_id)
+                 .dicts())
+        appearances = []
+        for s in query.iterator():
+            day_counts = s.pop('day_counts')
+            del s['recent_times']
+            if since:
+                after = next_day.date().isoformat()
+                s['count'] = first_day.get(s['spawnpoint_id'], 0) + sum(
+                    count for day, count in day_counts.iteritems()
+                    if day >= after)
+            else:
+                s['count'] = sum(day_counts.itervalues())
+
+            if s['count']:
+                appearances.append(s)
+
+        return appearances
+
+    # Disappear times of a species at a spawnpoint after a time (or ever),
+    # or None if they aren't all kept in the summary.
+    @classmethod
+    def get_times(cls, pokemon_id, spawnpoint_id, since=None):
+        summary = (cls
+                   .select(cls.day_counts, cls.recent_times)
+                   .where((cls.pokemon_id == pokemon_id) &
+                          (cls.spawnpoint_id == spawnpoint_id))
+                   .dicts()
+                   .first())
+        if summary is None:
+            return []
+
+        times = summary['recent_times']
+        since = calendar.timegm(since.timetuple()) if since else None
+        if len(times) < sum(summary['day_counts'].itervalues()) and (
+                not since or times[0] > since):
+            return None
+
+        return [datetime.utcfromtimestamp(t) for t in times
+                if not since or t > since]
+
+
+# Serializes the read-modify-write of the summaries between DB threads.
+summary_lock = Lock()
+# Serializes finding the new Pokemon of a batch and writing them.
+pokemon_write_lock = Lock()
+
+
+class WriteBehindCache(object):
+    '''
+    In-process copy of rows of a model, keyed by primary key, so parsing a
+    scan doesn't have to read the rows it needs from the DB.
+
+    Callers get copies of the cached dicts and hand their changes back with
+    update(). Changed rows are written to the DB in batches by flush(), at
+    most once every flush_interval seconds, or right away once the cache
+    holds more than max_rows. The least recently changed rows whose writes
+    the DB threads confirmed with written() are then dropped, and read from
+    the DB again when needed. Fields holding lists or dicts are named in
+    nested_fields, so the copies don't share them with the cache.
+    '''
+
+    def __init__(self, model, flush_interval=5, max_rows=100000,
+                 nested_fields=()):
+        self.model = model
+        self.key = model._meta.primary_key.name
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.nested_fields = nested_fields
+        self.lock = Lock()
+        self.rows = OrderedDict()
+        self.dirty = set()
+        # Rows taken for a write that wasn't confirmed yet, by key.
+        self.flushing = {}
+        self.last_flush = default_timer()
+
+    def copy(self, row):
+        row = dict(row)
+        for field in self.nested_fields:
+            row[field] = copy.deepcopy(row[field])
+
+        return row
+
+    # Cache rows read from the DB and return copies of the cached versions.
+    # Rows we already have are kept, as they may have changes that weren't
+    # flushed yet.
+    def load(self, rows):
+        with self.lock:
+            for row in rows:
+                if row[self.key] not in self.rows:
+                    self.rows[row[self.key]] = self.copy(row)
+
+            copies = [self.copy(self.rows[row[self.key]]) for row in rows]
+            self.evict()
+
+            return copies
+
+    # Return a dict of copies of the rows by key, reading the ones we don't
+    # have yet from the DB. Unknown keys are left out.
+    def get_many(self, keys):
+        with self.lock:
+            found = {key: self.copy(self.rows[key]) for key in keys
+                     if key in self.rows}
+
+        missing = [key for key in set(keys) if key not in found]
+        if missing:
+            field = getattr(self.model, self.key)
+            for row in self.load(list(self.model
+                                      .select()
+                                      .where(field << missing)
+                                      .dicts())):
+                found[row[self.key]] = row
+
+        return found
+
+    def update(self, rows):
+        with self.lock:
+            for row in rows.itervalues():
+                # Re-insert, so the rows stay ordered by last change.
+                self.rows.pop(row[self.key], None)
+                self.rows[row[self.key]] = self.copy(row)
+                self.dirty.add(row[self.key])
+
+    # Drop the least recently changed rows above max_rows. Rows that
+    # weren't written yet are kept. Called with the lock held.
+    def evict(self):
+        excess = len(self.rows) - self.max_rows
+        if excess <= 0:
+            return
+
+        stale = []
+        for key in self.rows:
+            if len(stale) >= excess:
+                break
+            if key not in self.dirty and key not in self.flushing:
+                stale.append(key)
+        for key in stale:
+            del self.rows[key]
+
+    # Take the changed rows to write out. Called with the lock held.
+    def take_dirty(self):
+        rows = {key: self.copy(self.rows[key]) for key in self.dirty}
+        self.dirty.clear()
+        self.flushing.update(rows)
+        self.last_flush = default_timer()
+
+        return rows
+
+    # The rows were written to the DB, so they can be dropped. Rows taken
+    # again for a later write stay until that one is written too.
+    def written(self, rows):
+        with self.lock:
+            for key, row in rows.iteritems():
+                if self.flushing.get(key) is row:
+                    del self.flushing[key]
+            self.evict()
+
+    # Queue the changed rows for the DB.
+    def flush(self, db_update_queue, force=False):
+        with self.lock:
+            full = len(self.rows) > self.max_rows
+            if not self.dirty or not (force or full) and (
+                    default_timer() - self.last_flush < self.flush_interval):
+                return
+
+            rows = self.take_dirty()
+
+        db_update_queue.put((self.model, rows))
+
+    # Write the changed rows to the DB directly, for when the DB threads
+    # won't be around to do it.
+    def write(self, db):
+        with self.lock:
+            rows = self.take_dirty()
+
+        if rows:
+            log.info('Writing %d cached %s rows.', len(rows),
+                     self.model.__name__)
+            bulk_upsert(self.model, rows, db)
+            self.written(rows)
+
+
+spawnpoint_cache = WriteBehindCache(SpawnPoint)
+sighting_summary_cache = WriteBehindCache(
+    SpawnpointDetectionSummary,
+    nested_fields=('seen_secs', 'same_ranges', 'recent'))
+write_behind_caches = {SpawnPoint: spawnpoint_cache,
+                       SpawnpointDetectionSummary: sighting_summary_cache}
+
+
+# Write out what the write-behind caches still hold, on exit.
+def write_behind_caches_flush(db):
+    for cache in write_behind_caches.itervalues():
+        try:
+            cache.write(db)
+        except Exception as e:
+            log.exception('Failed to write cached %s rows: %s',
+                          cache.model.__name__, repr(e))
+
+
+class LiveObjectIndex(object):
+    '''
+    In-memory copy of the rows of a model that the map shows, bucketed on a
+    lat/lng grid so viewport queries can be answered without SQL.
+
+    Rows are fed from db_updater once they have been written. Like the
+    upserts, rows with only some of the fields update those fields of the
+    row we have. If expires is set, it returns the time after which a row
+    is no longer shown (or None if it never is) and the row is dropped at
+    that time.
+    '''
+
+    def __init__(self, model, modified_field, expires=None, cell_size=0.01,
+                 modified_since=operator.gt):
+        self.model = model
+        self.key = model._meta.primary_key.name
+        self.modified_field = modified_field
+        self.modified_since = modified_since
+        self.expires = expires
+        self.cell_size = cell_size
+        self.defaults = [(f.name, f.default)
+                         for f in model._meta.sorted_fields
+                         if f.default is not None]
+        self.lock = Lock()
+        self.rows = {}
+        self.buckets = {}
+        self.expiry = []
+
+    def cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def update(self, rows):
+        now_date = datetime.utcnow()
+        with self.lock:
+            for row in rows:
+                key = row[self.key]
+                if key in self.rows:
+                    row = dict(self.rows[key], **row)
+                else:
+                    row = dict(row)
+                    # Fill in the same defaults the insert did.
+                    for name, default in self.defaults:
+                        if name not in row:
+                            row[name] = (default() if callable(default)
+                                         else default)
+                    # Updates of rows we don't have can't be placed.
+                    if 'latitude' not in row or 'longitude' not in row:
+                        continue
+
+                row.pop('s2_cell_id', None)
+
+                self._remove(key)
+                if self.expires:
+                    expire_time = self.expires(row)
+                    if expire_time is None or expire_time <= now_date:
+                        continue
+                    heapq.heappush(self.expiry, (expire_time, key))
+
+                self.rows[key] = row
+                self.buckets.setdefault(
+                    self.cell(row['latitude'], row['longitude']),
+                    set()).add(key)
+
+    # Apply an UPDATE that was made in the DB directly to the rows it
+    # matches.
+    def update_where(self, where, fields):
+        with self.lock:
+            for row in self.rows.itervalues():
+                if where(row):
+                    row.update(fields)
+
+    def _remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            cell = self.cell(row['latitude'], row['longitude'])
+            self.buckets[cell].discard(key)
+            if not self.buckets[cell]:
+                del self.buckets[cell]
+
+    def _expire(self, now_date):
+        while self.expiry and self.expiry[0][0] <= now_date:
+            expire_time, key = heapq.heappop(self.expiry)
+            # Rows that were updated since have a newer entry in the heap.
+            row = self.rows.get(key)
+            if row is not None and self.expires(row) <= now_date:
+                self._remove(key)
+
+    def _in_view(self, swLat, swLng, neLat, neLng):
+        swLat, swLng, neLat, neLng = map(float, (swLat, swLng, neLat, neLng))
+        (south, west) = self.cell(swLat, swLng)
+        (north, east) = self.cell(neLat, neLng)
+        # Zoomed out far enough, walking the occupied cells is cheaper than
+        # walking every cell of the viewport.
+        if (north - south + 1) * (east - west + 1) > len(self.buckets):
+            cells = [cell for cell in self.buckets
+                     if south <= cell[0] <= north and west <= cell[1] <= east]
+        else:
+            cells = [(lat, lng)
+                     for lat in range(south, north + 1)
+                     for lng in range(west, east + 1)
+                     if (lat, lng) in self.buckets]
+
+        for cell in cells:
+            for key in self.buckets[cell]:
+                row = self.rows[key]
+                if (swLat <= row['latitude'] <= neLat and
+                        swLng <= row['longitude'] <= neLng):
+                    yield row
+
+    # Same viewport semantics as the get_* queries of the models: all rows
+    # without a viewport, the given rows in view, rows modified since
+    # timestamp, or rows in view but outside of the old viewport.
+    def query(self, swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
+              oSwLng=None, oNeLat=None, oNeLng=None, keys=None, where=None):
+        with self.lock:
+            self._expire(datetime.utcnow())
+
+            if not (swLat and swLng and neLat and neLng):
+                rows = self.rows.itervalues()
+            elif keys is not None:
+                swLat, swLng, neLat, neLng = map(
+                    float, (swLat, swLng, neLat, neLng))
+                rows = (self.rows[key] for key in keys if key in self.rows)
+                rows = (r for r in rows
+                        if swLat <= r['latitude'] <= neLat and
+                        swLng <= r['longitude'] <= neLng)
+            elif timestamp > 0:
+                modified = datetime.utcfromtimestamp(timestamp / 1000)
+                rows = (r for r in self._in_view(swLat, swLng, neLat, neLng)
+                        if self.modified_since(r[self.modified_field],
+                                               modified))
+            elif oSwLat and oSwLng and oNeLat and oNeLng:
+                rows = (r for r in self._in_view(swLat, swLng, neLat, neLng)
+                        if not (float(oSwLat) <= r['latitude'] <=
+                                float(oNeLat) and
+                                float(oSwLng) <= r['longitude'] <=
+                                float(oNeLng)))
+            else:
+                rows = self._in_view(swLat, swLng, neLat, neLng)
+
+            if where is not None:
+                rows = (r for r in rows if where(r))
+
+            return [dict(row) for row in rows]
+
+
+# Live indexes by model, only set up with --live-index.
+live_indexes = {}
+
+
+def init_live_indexes():
+    recent = timedelta(minutes=15)
+    live_indexes[Pokemon] = LiveObjectIndex(
+        Pokemon, 'last_modified', expires=lambda p: p['disappear_time'])
+    live_indexes[Pokestop] = LiveObjectIndex(Pokestop, 'last_updated')
+    live_indexes[Gym] = LiveObjectIndex(Gym, 'last_scanned')
+    live_indexes[ScannedLocation] = LiveObjectIndex(
+        ScannedLocation, 'last_modified', modified_since=operator.ge,
+        expires=lambda loc: (loc['last_modified'] and
+                             loc['last_modified'] + recent))
+
+    now_date = datetime.utcnow()
+    live_indexes[Pokemon].update(
+        Pokemon.select().where(Pokemon.disappear_time > now_date).dicts())
+    live_indexes[Pokestop].update(Pokestop.select().dicts())
+    live_indexes[Gym].update(Gym.select().dicts())
+    live_indexes[ScannedLocation].update(
+        ScannedLocation.select()
+        .where(ScannedLocation.last_modified >= now_date - recent)
+        .dicts())
+
+    log.info('Loaded %s into the live index.', ', '.join(
+        '{} {}'.format(len(index.rows), model.__name__)
+        for model, index in live_indexes.iteritems()))
+
+
+class ChangeLog(object):
+    '''
+    Ring buffer of the keys of the map rows written by db_updater, numbered
+    with a monotonically increasing sequence id. Clients send the last
+    sequence id they got to only receive the rows written since, without
+    scanning for rows by last_modified time.
+    '''
+
+    models = (Pokemon, Pokestop, Gym, ScannedLocation)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.size = 0
+        self.entries = []
+        self.seq = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def enable(self, size):
+        with self.lock:
+            self.size = size
+            self.entries = [None] * size
+
+    def append(self, model, keys):
+        if not self.enabled or model not in self.models:
+            return
+
+        with self.lock:
+            for key in keys:
+                self.seq += 1
+                self.entries[self.seq % self.size] = (model, key)
+
+    # Return the latest sequence id and a dict of the keys by model written
+    # after seq, or None instead of the dict if those already fell out of
+    # the buffer.
+    def since(self, seq):
+        with self.lock:
+            if seq is None or seq > self.seq or self.seq - seq > self.size:
+                return self.seq, None
+
+            changes = {}
+            for i in range(seq + 1, self.seq + 1):
+                model, key = self.entries[i % self.size]
+                changes.setdefault(model, set()).add(key)
+
+            return self.seq, changes
+
+
+change_log = ChangeLog()
+
+
+# Select the rows of a query by primary key, in chunks small enough for
+# SQLite's limit on query parameters.
+def select_by_keys(query, field, keys):
+    keys = list(keys)
+    step = 500
+    for i in range(0, len(keys), step):
+        for row in query.where(field << keys[i:i + step]).iterator():
+            yield row
+
+
+# The subset of primary keys of a model that are already in the DB.
+def stored_keys(model, keys):
+    field = model._meta.primary_key
+    return set(key for key, in select_by_keys(
+        model.select(field).tuples(), field, keys))
+
+
 class Versions(flaskDb.Model):
     key = Utf8mb4CharField()
     val = SmallIntegerField()
@@ -1854,7 +2943,8 @@ def perform_pgscout(p):
 
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e.
 def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
-              key_scheduler, api, status, now_date, account, account_sets):
+              key_scheduler, api, status, now_date, account, account_sets,
+              scheduler=None):
     pokemon = {}
     pokestops = {}
     gyms = {}
@@ -1868,6 +2958,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
     spawn_points = {}
     scan_spawn_points = {}
     sightings = {}
+    # Sighting summaries of the spawnpoints to classify, by id.
+    summaries = {}
     new_spawn_points = []
     sp_id_list = []
     captcha_url = ''
@@ -1932,7 +3024,10 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
             log.warning('No nearby or wild Pokemon but there are visible gyms '
                         'or pokestops. Possible speed violation.')
 
-    scan_loc = ScannedLocation.get_by_loc(step_location)
+    # Use the scheduler's state of the location if it has it.
+    scan_loc = scheduler and scheduler.get_scanned_location(step_location)
+    if not scan_loc:
+        scan_loc = ScannedLocation.get_by_loc(step_location)
     done_already = scan_loc['done']
     ScannedLocation.update_band(scan_loc, now_date)
     just_completed = not done_already and scan_loc['done']
@@ -1953,10 +3048,16 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
         encountered_pokemon = [
             (p['encounter_id'], p['spawnpoint_id']) for p in query]
 
+        known_spawn_points = spawnpoint_cache.get_many(
+            [p['spawn_point_id'] for p in wild_pokemon])
+        summaries = SpawnpointDetectionData.get_summaries(
+            [p['spawn_point_id'] for p in wild_pokemon])
+
         for p in wild_pokemon:
 
-            sp = SpawnPoint.get_by_id(p['spawn_point_id'], p[
-                                      'latitude'], p['longitude'])
+            sp = known_spawn_points.get(p['spawn_point_id']) or \
+                SpawnPoint.new_sp(p['spawn_point_id'], p['latitude'],
+                                  p['longitude'])
             spawn_points[p['spawn_point_id']] = sp
             sp['missed_count'] = 0
 
@@ -2009,7 +3110,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
             if (not SpawnPoint.tth_found(sp) or sighting['tth_secs'] or
                     not scan_loc['done'] or just_completed):
                 SpawnpointDetectionData.classify(sp, scan_loc, now_secs,
-                                                 sighting)
+                                                 sighting, summaries)
                 sightings[p['encounter_id']] = sighting
 
             sp['last_scanned'] = datetime.utcfromtimestamp(
@@ -2421,7 +3522,21 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
 
     # Look for spawnpoints within scan_loc that are not here to see if we
     # can narrow down tth window.
-    for sp in ScannedLocation.linked_spawn_points(scan_loc['cellid']):
+    # The cached spawnpoints may have changes that aren't in the DB yet.
+    linked_sp_ids = scheduler and scheduler.get_linked_spawn_point_ids(
+        scan_loc['cellid'])
+    if linked_sp_ids is None:
+        linked_spawn_points = spawnpoint_cache.load(
+            ScannedLocation.linked_spawn_points(scan_loc['cellid']))
+    else:
+        linked_spawn_points = spawnpoint_cache.get_many(
+            linked_sp_ids).values()
+    if just_completed:
+        summaries.update(SpawnpointDetectionData.get_summaries(
+            [linked['id'] for linked in linked_spawn_points
+             if linked['id'] not in summaries]))
+
+    for sp in linked_spawn_points:
         if sp['id'] in sp_id_list:
             # Don't overwrite changes from this parse with DB version.
             sp = spawn_points[sp['id']]
@@ -2429,7 +3544,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
             # If the cell has completed, we need to classify all
             # the SPs that were not picked up in the scan
             if just_completed:
-                SpawnpointDetectionData.classify(sp, scan_loc, now_secs)
+                SpawnpointDetectionData.classify(sp, scan_loc, now_secs,
+                                                 summaries=summaries)
                 spawn_points[sp['id']] = sp
             if SpawnpointDetectionData.unseen(sp, now_secs):
                 spawn_points[sp['id']] = sp
@@ -2453,13 +3569,16 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                         (now_secs - sp['latest_seen']) % 3600)
             log.info('Restarting current 15 minute search for TTH.')
             if sp['id'] not in sp_id_list:
-                SpawnpointDetectionData.classify(sp, scan_loc, now_secs)
+                SpawnpointDetectionData.classify(sp, scan_loc, now_secs,
+                                                 summaries=summaries)
             sp['latest_seen'] = (sp['latest_seen'] - 60) % 3600
             sp['earliest_unseen'] = (
                 sp['earliest_unseen'] + 14 * 60) % 3600
             spawn_points[sp['id']] = sp
 
     db_update_queue.put((ScannedLocation, {0: scan_loc}))
+    if scheduler:
+        scheduler.scanned_location_updated(scan_loc, sp_id_list)
 
     if pokemon:
         db_update_queue.put((Pokemon, pokemon))
@@ -2468,11 +3587,14 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
     if gyms:
         db_update_queue.put((Gym, gyms))
     if spawn_points:
-        db_update_queue.put((SpawnPoint, spawn_points))
+        spawnpoint_cache.update(spawn_points)
         db_update_queue.put((ScanSpawnPoint, scan_spawn_points))
         if sightings:
             db_update_queue.put((SpawnpointDetectionData, sightings))
 
+    spawnpoint_cache.flush(db_update_queue)
+    sighting_summary_cache.flush(db_update_queue)
+
     if not nearby_pokemon and not wild_pokemon:
         # After parsing the forts, we'll mark this scan as bad due to
         # a possible speed violation.
@@ -2626,6 +3748,126 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
              len(gym_members))
 
 
+class DbUpdateQueue(object):
+    '''
+    Queue of (model, rows) database updates, split into prioritized lanes
+    so worker telemetry can't hold up the map data.
+
+    The map lane holds everything but worker telemetry and never drops an
+    update. Once it holds max_size items, put() blocks until the db
+    threads catch up. The telemetry lane merges its rows by primary key
+    and is only drained when the map lane is empty. Once it holds more
+    than max_telemetry_size rows, the oldest rows are dropped.
+    '''
+
+    lanes = ('map', 'telemetry')
+    telemetry_models = (MainWorker, WorkerStatus)
+
+    def __init__(self, max_size=0, max_telemetry_size=0):
+        self.max_size = max_size
+        self.max_telemetry_size = max_telemetry_size
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+        self.map_items = deque()
+        # Telemetry rows, keyed by (model, primary key).
+        self.telemetry_rows = OrderedDict()
+        self.in_progress = 0
+        self.stats = {lane: {'queued': 0, 'dropped': 0, 'peak': 0}
+                      for lane in self.lanes}
+
+    def put(self, item, block=True, timeout=None):
+        model, data = item
+        with self.lock:
+            if model in self.telemetry_models:
+                self._put_telemetry(model, data)
+            else:
+                self._put_map(item, block, timeout)
+            self.not_empty.notify()
+
+    def _put_map(self, item, block, timeout):
+        if self.max_size > 0:
+            deadline = None if timeout is None else time.time() + timeout
+            while len(self.map_items) >= self.max_size:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Full
+                self.not_full.wait(remaining)
+
+        self.map_items.append(item)
+        self._count('map', 1, len(self.map_items))
+
+    def _put_telemetry(self, model, data):
+        for row in data.itervalues():
+            self.telemetry_rows[(model, db_row_key(model, row, 0))] = row
+
+        dropped = 0
+        while (self.max_telemetry_size > 0 and
+               len(self.telemetry_rows) > self.max_telemetry_size):
+            self.telemetry_rows.popitem(last=False)
+            dropped += 1
+        self.stats['telemetry']['dropped'] += dropped
+        self._count('telemetry', len(data), len(self.telemetry_rows))
+
+    def _count(self, lane, num_queued, depth):
+        stats = self.stats[lane]
+        stats['queued'] += num_queued
+        stats['peak'] = max(stats['peak'], depth)
+
+    def get(self, block=True, timeout=None):
+        with self.lock:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.map_items and not self.telemetry_rows:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Empty
+                self.not_empty.wait(remaining)
+
+            if self.map_items:
+                item = self.map_items.popleft()
+                self.not_full.notify()
+            else:
+                item = self._get_telemetry()
+            self.in_progress += 1
+
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    # Pop all queued telemetry rows of the oldest model in the lane.
+    def _get_telemetry(self):
+        model = next(iter(self.telemetry_rows))[0]
+        data = {}
+        for key in [key for key in self.telemetry_rows if key[0] is model]:
+            data[key[1]] = self.telemetry_rows.pop(key)
+
+        return model, data
+
+    def task_done(self):
+        with self.lock:
+            self.in_progress -= 1
+
+    def qsize(self, lane=None):
+        with self.lock:
+            if lane == 'map':
+                return len(self.map_items)
+            if lane == 'telemetry':
+                return len(self.telemetry_rows)
+            return len(self.map_items) + len(self.telemetry_rows)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {lane: dict(self.stats[lane]) for lane in self.lanes}
+            stats['map']['depth'] = len(self.map_items)
+            stats['telemetry']['depth'] = len(self.telemetry_rows)
+            stats['in_progress'] = self.in_progress
+
+            return stats
+
+
 def db_updater(args, q, db):
     # The forever loop.
     while True:
@@ -2642,32 +3884,98 @@ def db_updater(args, q, db):
             # Loop the queue.
             while True:
                 last_upsert = default_timer()
-                model, data = q.get()
-
-                bulk_upsert(model, data, db)
-                q.task_done()
-
-                log.debug('Upserted to %s, %d records (upsert queue '
-                          'remaining: %d) in %.2f seconds.',
-                          model.__name__,
-                          len(data),
+                updates, num_items = coalesce_db_updates(args, q)
+
+                for model, data in updates.iteritems():
+                    if model is Pokemon:
+                        # Rewrites of stored Pokemon, like scout results,
+                        # aren't counted again in the summaries. Checking
+                        # and writing under one lock keeps threads with
+                        # overlapping batches from both counting a Pokemon.
+                        with pokemon_write_lock:
+                            stored = stored_keys(Pokemon, data.iterkeys())
+                            new_pokemon = [p for key, p in data.iteritems()
+                                           if key not in stored]
+                            bulk_upsert(model, data, db)
+                    else:
+                        bulk_upsert(model, data, db)
+                    if model in write_behind_caches:
+                        write_behind_caches[model].written(data)
+                    if model is Pokemon and new_pokemon:
+                        SpawnpointDespawnSummary.add_pokemon(new_pokemon, db)
+                        PokemonHourlySummary.add_pokemon(new_pokemon, db)
+                        PokemonAppearanceSummary.add_pokemon(new_pokemon, db)
+                    if model in live_indexes:
+                        live_indexes[model].update(data.itervalues())
+                    change_log.append(model, data.iterkeys())
+
+                for __ in range(num_items):
+                    q.task_done()
+
+                log.debug('Upserted %d queued items to %s, %d records '
+                          '(upsert queue remaining: %d) in %.2f seconds.',
+                          num_items,
+                          ', '.join(m.__name__ for m in updates),
+                          sum(len(data) for data in updates.itervalues()),
                           q.qsize(),
                           default_timer() - last_upsert)
 
                 # Helping out the GC.
-                del model
-                del data
+                del updates
 
-                if q.qsize() > 50:
+                if q.qsize('map') > 50:
                     log.warning(
                         "DB queue is > 50 (@%d); try increasing --db-threads.",
-                        q.qsize())
+                        q.qsize('map'))
 
         except Exception as e:
             log.exception('Exception in db_updater: %s', repr(e))
             time.sleep(5)
 
 
+# Drain the DB update queue for up to --db-batch-window seconds or until
+# --db-batch-size rows have been collected, merging the rows per model by
+# primary key. Repeated writes to the same row (worker status, re-seen
+# spawnpoints, scanned locations) only hit the database once, with the
+# last write winning.
+def coalesce_db_updates(args, q):
+    updates = OrderedDict()
+    num_items = 0
+    num_rows = 0
+    deadline = default_timer() + args.db_batch_window
+
+    model, data = q.get()
+    while True:
+        num_items += 1
+        num_rows += len(data)
+        rows = updates.setdefault(model, OrderedDict())
+        for row in data.itervalues():
+            rows[db_row_key(model, row, len(rows))] = row
+
+        timeout = deadline - default_timer()
+        if num_rows >= args.db_batch_size or timeout <= 0:
+            break
+
+        try:
+            model, data = q.get(timeout=timeout)
+        except Empty:
+            break
+
+    return updates, num_items
+
+
+# Key a queued row by its primary key value(s). Models without a primary
+# key can't be merged, so their rows are kept in order of arrival.
+def db_row_key(model, row, index):
+    pk = model._meta.primary_key
+    if not pk:
+        return index
+    if isinstance(pk, CompositeKey):
+        return tuple(row.get(name) for name in pk.field_names)
+
+    return row.get(pk.name)
+
+
 def clean_db_loop(args):
     while True:
         try:
@@ -2684,10 +3992,16 @@ def clean_db_loop(args):
             query.execute()
 
             # Remove active modifier from expired lured pokestops.
+            now_date = datetime.utcnow()
             query = (Pokestop
                      .update(lure_expiration=None, active_fort_modifier=None)
-                     .where(Pokestop.lure_expiration < datetime.utcnow()))
+                     .where(Pokestop.lure_expiration < now_date))
             query.execute()
+            if Pokestop in live_indexes:
+                live_indexes[Pokestop].update_where(
+                    lambda p: (p['lure_expiration'] is not None and
+                               p['lure_expiration'] < now_date),
+                    {'lure_expiration': None, 'active_fort_modifier': None})
 
             # Remove old (unusable) captcha tokens
             query = (Token
@@ -2707,15 +4021,55 @@ def clean_db_loop(args):
             if args.purge_data > 0:
                 log.info("Beginning purge of old Pokemon spawns.")
                 start = datetime.utcnow()
+                purge_before = start - timedelta(hours=args.purge_data)
                 query = (Pokemon
                          .delete()
-                         .where((Pokemon.disappear_time <
-                                 (datetime.utcnow() -
-                                  timedelta(hours=args.purge_data)))))
+                         .where((Pokemon.disappear_time < purge_before)))
                 rows = query.execute()
+
+                # Along with the summaries of the purged Pokemon: the hours
+                # that ended before, and the spawnpoints where no Pokemon
+                # was seen since.
+                query = (PokemonHourlySummary
+                         .delete()
+                         .where(PokemonHourlySummary.hour <=
+                                purge_before - timedelta(hours=1)))
+                summary_rows = query.execute()
+                query = (SpawnpointDespawnSummary
+                         .delete()
+                         .where(SpawnpointDespawnSummary.last_modified <
+                                purge_before))
+                summary_rows += query.execute()
                 end = datetime.utcnow()
                 diff = end - start
                 log.info("Completed purge of old Pokemon spawns. "
+                         "%i deleted, with %i summary rows, in %f seconds.",
+                         rows, summary_rows, diff.total_seconds())
+
+            # If desired, clear the detection data of spawnpoints with a
+            # confirmed TTH. Their sightings are kept in their summary.
+            if args.purge_detection_data > 0:
+                log.info("Beginning purge of old spawnpoint detection data.")
+                start = datetime.utcnow()
+                tth_found = (SpawnpointDetectionSummary
+                             .select(SpawnpointDetectionSummary.spawnpoint_id)
+                             .join(SpawnPoint, on=(
+                                 SpawnPoint.id ==
+                                 SpawnpointDetectionSummary.spawnpoint_id))
+                             .where(SpawnPoint.latest_seen ==
+                                    SpawnPoint.earliest_unseen))
+                purge_before = datetime.utcnow() - timedelta(
+                    hours=args.purge_detection_data)
+                query = (SpawnpointDetectionData
+                         .delete()
+                         .where((SpawnpointDetectionData.scan_time <
+                                 purge_before) &
+                                (SpawnpointDetectionData.spawnpoint_id <<
+                                 tth_found)))
+                rows = query.execute()
+                end = datetime.utcnow()
+                diff = end - start
+                log.info("Completed purge of old spawnpoint detection data. "
                          "%i deleted in %f seconds.",
                          rows, diff.total_seconds())
 
@@ -2726,34 +4080,21 @@ def clean_db_loop(args):
 
 
 def bulk_upsert(cls, data, db):
-    num_rows = len(data.values())
-    i = 0
+    rows = data.values()
+    num_rows = len(rows)
 
-    if args.db_type == 'mysql':
-        step = 250
-    else:
-        # SQLite has a default max number of parameters of 999,
-        # so we need to limit how many rows we insert for it.
-        step = 50
+    # Rows of located models are queried by s2 cell.
+    if 's2_cell_id' in cls._meta.fields:
+        for row in rows:
+            row['s2_cell_id'] = s2_cell_id(row['latitude'], row['longitude'])
+    i = 0
+    step = upsert_chunk_size(cls)
 
     with db.atomic():
         while i < num_rows:
             log.debug('Inserting items %d to %d.', i, min(i + step, num_rows))
             try:
-                # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
-                # unable to recognize strings to update unicode keys for
-                # foreign key fields, thus giving lots of foreign key
-                # constraint errors.
-                if args.db_type == 'mysql':
-                    db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
-
-                # Use peewee's own implementation of the insert_many() method.
-                InsertQuery(cls, rows=data.values()[
-                            i:min(i + step, num_rows)]).upsert().execute()
-
-                if args.db_type == 'mysql':
-                    db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
-
+                upsert(cls, rows[i:min(i + step, num_rows)], db)
             except Exception as e:
                 # If there is a DB table constraint error, dump the data and
                 # don't retry.
@@ -2774,12 +4115,66 @@ def bulk_upsert(cls, data, db):
             i += step
 
 
+def upsert_chunk_size(cls):
+    if cls.__name__ in args.db_chunk_sizes:
+        return args.db_chunk_sizes[cls.__name__]
+
+    if args.db_type == 'mysql':
+        return 250
+
+    # SQLite has a default max number of parameters of 999,
+    # so we need to limit how many rows we insert for it.
+    return 50
+
+
+# Insert the rows, updating existing rows in place. Peewee's upsert() is
+# REPLACE INTO, which deletes and re-inserts every existing row and so
+# rewrites all of its indexes. Instead, use MySQL's ON DUPLICATE KEY UPDATE
+# (which leaves rows with unchanged values alone) or SQLite's ON CONFLICT
+# DO UPDATE, limited to the rows with changed values.
+def upsert(cls, rows, db):
+    query = InsertQuery(cls, rows=rows)
+    pk_fields = cls._meta.get_primary_key_fields() if cls._meta.primary_key \
+        else []
+    if not pk_fields or (args.db_type != 'mysql' and
+                         sqlite3.sqlite_version_info < (3, 24, 0)):
+        return query.upsert().execute()
+
+    quote = db.compiler().quote
+    table = quote(cls._meta.db_table)
+    # Peewee adds the field defaults to the rows, so the columns of the
+    # insert are those of the first full row.
+    pk_columns = [field.db_column for field in pk_fields]
+    columns = [quote(field.db_column) for field in next(query._iter_rows())
+               if field.db_column not in pk_columns]
+    sql, params = query.sql()
+
+    if args.db_type == 'mysql':
+        if not columns:
+            columns = [quote(pk_columns[0])]
+        sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+            '{0}=VALUES({0})'.format(column) for column in columns)
+    elif not columns:
+        sql += ' ON CONFLICT DO NOTHING'
+    else:
+        sql += ' ON CONFLICT ({}) DO UPDATE SET {} WHERE {}'.format(
+            ', '.join(quote(column) for column in pk_columns),
+            ', '.join('{0}=excluded.{0}'.format(column)
+                      for column in columns),
+            ' OR '.join('{0}.{1} IS NOT excluded.{1}'.format(table, column)
+                        for column in columns))
+
+    return db.execute_sql(sql, params)
+
+
 def create_tables(db):
     db.connect()
     tables = [Pokemon, Pokestop, Gym, ScannedLocation, GymDetails,
               GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus,
               SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData,
-              Token, LocationAltitude, HashKeys, Account]
+              SpawnpointDetectionSummary, SpawnpointDespawnSummary,
+              PokemonHourlySummary, PokemonAppearanceSummary, Token,
+              LocationAltitude, HashKeys, Account]
     for table in tables:
         if not table.table_exists():
             log.info('Creating table: %s', table.__name__)
@@ -2793,8 +4188,10 @@ def drop_tables(db):
     tables = [Pokemon, Pokestop, Gym, ScannedLocation, Versions,
               GymDetails, GymMember, GymPokemon, Trainer, MainWorker,
               WorkerStatus, SpawnPoint, ScanSpawnPoint,
-              SpawnpointDetectionData, LocationAltitude,
-              Token, HashKeys, Account]
+              SpawnpointDetectionData, SpawnpointDetectionSummary,
+              SpawnpointDespawnSummary, PokemonHourlySummary,
+              PokemonAppearanceSummary, LocationAltitude, Token, HashKeys,
+              Account]
     db.connect()
     db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
     for table in tables:
@@ -2802,7 +4199,6 @@ def drop_tables(db):
             log.info('Dropping table: %s', table.__name__)
             db.drop_tables([table], safe=True)
 
-    db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
     db.close()
 
 
@@ -2834,7 +4230,6 @@ def verify_table_encoding(db):
                     cmd_sql = '''ALTER TABLE %s CONVERT TO CHARACTER SET utf8mb4
                                 COLLATE utf8mb4_unicode_ci;''' % str(table[0])
                     db.execute_sql(cmd_sql)
-                db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
         db.close()
 
 
@@ -2869,6 +4264,30 @@ def verify_database_schema(db):
     db.close()
 
 
+# Set the s2_cell_id of existing rows of a model, in batches.
+def backfill_s2_cell_ids(db, model, where=None):
+    key = model._meta.primary_key
+    query = (model
+             .select(key, model.latitude, model.longitude)
+             .where(model.s2_cell_id.is_null()))
+    if where is not None:
+        query = query.where(where)
+
+    rows = list(query.tuples())
+    log.info('Setting the s2 cell of %d %s rows.', len(rows),
+             model.__name__)
+    # One UPDATE per chunk, with a CASE on the primary key. Each row takes
+    # three query parameters, within SQLite's limit of 999.
+    step = 250
+    for i in range(0, len(rows), step):
+        chunk = rows[i:i + step]
+        (model
+         .update(s2_cell_id=case(key, [
+             (row[0], s2_cell_id(row[1], row[2])) for row in chunk]))
+         .where(key << [row[0] for row in chunk])
+         .execute())
+
+
 def database_migrate(db, old_ver):
     # Update database schema version.
     Versions.update(val=db_schema_version).where(
@@ -3115,5 +4534,60 @@ def database_migrate(db, old_ver):
                                 BooleanField(null=True))
         )
 
+    if old_ver < 22:
+        log.info('This DB schema update can take some time. '
+                 'Please be patient.')
+
+        # Index locations by s2 cell for viewport queries. Only active
+        # Pokemon are looked up by location.
+        for model, where in (
+                (Pokemon, Pokemon.disappear_time > datetime.utcnow()),
+                (Pokestop, None), (Gym, None), (SpawnPoint, None),
+                (ScannedLocation, None), (LocationAltitude, None)):
+            table = model._meta.db_table
+            migrate(
+                migrator.add_column(table, 's2_cell_id',
+                                    BigIntegerField(null=True)),
+                migrator.add_index(table, ('s2_cell_id',), False)
+            )
+            backfill_s2_cell_ids(db, model, where)
+
+    if old_ver < 23:
+        # Spawnpoints are read from a summary of the Pokemon seen there,
+        # kept up to date as Pokemon are written.
+        db.create_tables([SpawnpointDespawnSummary], safe=True)
+        SpawnpointDespawnSummary.backfill(db)
+
+    if old_ver < 24:
+        # The statistics page sums hourly per-species buckets of the
+        # Pokemon seen, kept up to date as Pokemon are written.
+        db.create_tables([PokemonHourlySummary], safe=True)
+        PokemonHourlySummary.backfill(db)
+
+    if old_ver < 25:
+        # The statistics page drill-downs read per species and spawnpoint
+        # summaries of the appearances, kept up to date as Pokemon are
+        # written.
+        db.create_tables([PokemonAppearanceSummary], safe=True)
+        PokemonAppearanceSummary.backfill(db)
+
+    if old_ver < 26 and SpawnpointDetectionSummary.table_exists():
+        # Sightings of the last hour are kept apart, to pair the ones that
+        # were parsed out of order with the right neighbours.
+        migrate(
+            migrator.add_column('spawnpointdetectionsummary', 'recent',
+                                JsonField(null=True))
+        )
+
+    if old_ver < 27 and SpawnpointDespawnSummary.table_exists() and (
+            'encounter_id' in [column.name for column in db.get_columns(
+                'spawnpointdespawnsummary')]):
+        # Only DBs that were on version 23 have the latest Pokemon counted
+        # per spawnpoint. Pokemon are only counted when they're first
+        # written now.
+        migrate(
+            migrator.drop_column('spawnpointdespawnsummary', 'encounter_id')
+        )
+
     # Always log that we're done.
     log.info('Schema upgrade complete.')
@@ -44,6 +44,7 @@ If implementing a new scheduler, place it before SchedulerFactory, and
 add it to __scheduler_classes
 '''
 
+import heapq
 import itertools
 import logging
 import math
@@ -53,7 +54,6 @@ import time
 import sys
 from timeit import default_timer
 from threading import Lock
-from copy import deepcopy
 import traceback
 from collections import Counter
 from queue import Empty
@@ -61,8 +61,9 @@ from operator import itemgetter
 from datetime import datetime, timedelta
 from .transform import get_new_coords
 from .models import (hex_bounds, Pokemon, SpawnPoint, ScannedLocation,
-                     ScanSpawnPoint, HashKeys)
-from .utils import now, cur_sec, cellid, equi_rect_distance
+                     ScanSpawnPoint, HashKeys, spawnpoint_cache)
+from .utils import (now, cur_sec, cellid, equi_rect_distance, date_secs,
+                    secs_near, min_cost_assignment)
 from .altitude import get_altitude
 from .geofence import Geofences
 
@@ -99,6 +100,28 @@ class BaseScheduler(object):
     def scanning_paused(self):
         self.empty_queues()
 
+    # Return a copy of the ScannedLocation dict of a location, if the
+    # scheduler keeps track of them, so parsing a scan doesn't have to read
+    # it from the DB. Otherwise, return None.
+    def get_scanned_location(self, loc):
+        return None
+
+    # Return the ids of the spawnpoints linked to a cell, if the scheduler
+    # keeps track of them. Otherwise, return None.
+    def get_linked_spawn_point_ids(self, cell):
+        return None
+
+    # scanned_location_updated function is called after parsing a scan, with
+    # the updated ScannedLocation dict and the ids of the spawnpoints seen.
+    def scanned_location_updated(self, scan_loc, sp_ids):
+        pass
+
+    # plan function is called by the overseer on each pass of its loop that
+    # doesn't refresh the queue, for schedulers that plan ahead for their
+    # workers.
+    def plan(self):
+        pass
+
     def get_overseer_message(self):
         nextitem = self.queues[0].queue[0]
         message = 'Processing search queue, next item is {:6f},{:6f}'.format(
@@ -482,6 +505,270 @@ class SpawnScan(BaseScheduler):
 # search in each scan location by scanning five two-minute bands within
 # an hour and ten minute intervals between bands.
 
+# Kinds of SpeedScan items, in the order next_item prefers them. Their score
+# weights are so far apart that any item of a kind in the hive beats all
+# items of the next kinds, and within a kind the nearest item wins.
+ITEM_KINDS = ('band', 'TTH', 'spawn')
+
+
+# What a 'done' value of a SpeedScan item counts as in the stats: 'Missed',
+# 'Scanned', 'Timed' for a scan of the item that returned data, or None.
+def done_outcome(done):
+    if done in ('Missed', 'Scanned'):
+        return done
+    if done is None or isinstance(done, basestring):
+        return None
+    return 'Timed'
+
+
+class QueueIndex(object):
+    '''
+    Index of the items of a SpeedScan queue by time window and location, so
+    next_item doesn't have to score the whole queue for every worker.
+
+    Items are activated in order of start time, once a worker could get to
+    them before they start, and retired in order of end time, marking the
+    ones that weren't done as 'Missed'. Active items are kept per kind in a
+    grid of cell_km sized cells, which is searched in rings around the
+    worker until no nearer item can exist.
+
+    SpeedScan keeps an index per spatial shard of the hive, covering the
+    area within bounds, each guarded by its own lock. Items are marked
+    through set_done, which counts their outcomes for the stats once they're
+    final, so the counts taken for a report don't change afterwards.
+    '''
+
+    def __init__(self, queue, bounds, cell_km=0.5):
+        self.queue = queue
+        self.bounds = bounds
+        self.cell_km = cell_km
+        self.lock = Lock()
+        self.pending = []
+        self.ends = []
+        # Items with an entry in ends, so re-added ones aren't retired twice.
+        self.ending = set()
+        self.cells = {kind: {} for kind in ITEM_KINDS}
+        self.counts = Counter()
+
+        # Project locations on a flat grid in km, around the hive.
+        min_lat, min_lng, max_lat, max_lng = bounds
+        self.km_per_lat = math.radians(1) * 6371
+        self.km_per_lng = self.km_per_lat * math.cos(
+            math.radians((min_lat + max_lat) / 2))
+        self.corners = [(lat, lng) for lat in (min_lat, max_lat)
+                        for lng in (min_lng, max_lng)]
+        self.min_cell = self.grid_cell((min_lat, min_lng))
+        self.max_cell = self.grid_cell((max_lat, max_lng))
+
+    def grid_cell(self, loc):
+        return (int(math.floor(loc[1] * self.km_per_lng / self.cell_km)),
+                int(math.floor(loc[0] * self.km_per_lat / self.cell_km)))
+
+    # Grid cell of a location, or the nearest one within bounds. Points
+    # within bounds are at least as far from a location as from its cell.
+    def cell(self, loc):
+        x, y = self.grid_cell(loc)
+        return (min(max(x, self.min_cell[0]), self.max_cell[0]),
+                min(max(y, self.min_cell[1]), self.max_cell[1]))
+
+    # Distance in km from a location to the nearest point within bounds.
+    def distance(self, loc):
+        lat = min(max(loc[0], self.bounds[0]), self.bounds[2])
+        lng = min(max(loc[1], self.bounds[1]), self.bounds[3])
+        return equi_rect_distance(loc, (lat, lng))
+
+    # Distance in km from a location to the farthest corner of bounds.
+    def farthest(self, loc):
+        return max(equi_rect_distance(loc, corner) for corner in self.corners)
+
+    # Queue an item to be activated once a worker could get to it in time.
+    def push(self, i):
+        heapq.heappush(self.pending, (self.queue[i]['start'], i))
+
+    def add(self, i):
+        item = self.queue[i]
+        self.cells[item['kind']].setdefault(
+            self.cell(item['loc']), set()).add(i)
+        if i not in self.ending:
+            self.ending.add(i)
+            heapq.heappush(self.ends, (item['end'], i))
+
+    def discard(self, i):
+        item = self.queue[i]
+        self.cells[item['kind']].get(self.cell(item['loc']), set()).discard(i)
+
+    # Set the 'done' value of an item, and count its outcome by kind if it's
+    # final. Also sums the delays of the timed spawns.
+    def set_done(self, i, done, final=False):
+        item = self.queue[i]
+        item['done'] = done
+        outcome = done_outcome(done)
+        if final and outcome:
+            self.counts[(item['kind'], outcome)] += 1
+            if outcome == 'Timed' and item['kind'] == 'spawn':
+                self.counts[('spawn', 'delay')] += done
+
+    # Activate the items starting up to horizon seconds after ms, and retire
+    # the ones that ended before ms. Return how many of those were missed.
+    def advance(self, ms, horizon):
+        while self.pending and self.pending[0][0] <= ms + horizon:
+            __, i = heapq.heappop(self.pending)
+            self.add(i)
+
+        missed = 0
+        while self.ends and self.ends[0][0] < ms:
+            __, i = heapq.heappop(self.ends)
+            self.ending.discard(i)
+            self.discard(i)
+            item = self.queue[i]
+            if not item.get('done', False):
+                self.set_done(i, 'Missed', final=True)
+                missed += 1
+
+        return missed
+
+    # Grid cells at Chebyshev distance r from a cell, within bounds.
+    def ring(self, cx, cy, r):
+        (x0, y0), (x1, y1) = self.min_cell, self.max_cell
+        if r == 0:
+            yield cx, cy
+            return
+
+        for x in range(max(cx - r, x0), min(cx + r, x1) + 1):
+            for y in (cy - r, cy + r):
+                if y0 <= y <= y1:
+                    yield x, y
+        for y in range(max(cy - r + 1, y0), min(cy + r - 1, y1) + 1):
+            for x in (cx - r, cx + r):
+                if x0 <= x <= x1:
+                    yield x, y
+
+    # Return (distance, index) of the nearest active item of a kind that
+    # eligible(item, distance) accepts, the first in the queue on ties, or
+    # None.
+    def nearest(self, kind, loc, eligible):
+        cells = self.cells[kind]
+        cx, cy = self.cell(loc)
+        rings = max(cx - self.min_cell[0], self.max_cell[0] - cx,
+                    cy - self.min_cell[1], self.max_cell[1] - cy)
+        best = None
+        for r in range(rings + 1):
+            # Items in ring r are at least r - 1 cells away. Leave some room
+            # for the grid projection differing from equi_rect_distance.
+            if best and (r - 1) * self.cell_km * 0.9 > best[0]:
+                break
+
+            for cell in self.ring(cx, cy, r):
+                for i in list(cells.get(cell, ())):
+                    item = self.queue[i]
+                    if item.get('done', False):
+                        cells[cell].discard(i)
+                        continue
+
+                    distance = equi_rect_distance(item['loc'], loc)
+                    if best and (distance, i) >= best:
+                        continue
+                    if eligible(item, distance):
+                        best = (distance, i)
+
+        return best
+
+
+class QueueShards(object):
+    '''
+    SpeedScan queue split in spatial shards of at least min_km a side, about
+    one per worker, each indexed by a QueueIndex with its own lock. Workers
+    claim items from their nearest shard and steal from the others when it
+    has nothing for them, so they only wait on workers nearby.
+
+    The shards cover the scan locations of the hive, so items can be
+    appended to the queue while workers use it. Item times are in seconds
+    from the start of the hour of date. Also indexes the items by spawnpoint
+    id, for task_done.
+    '''
+
+    def __init__(self, locations, workers, version, date, min_km=1.0):
+        self.queue = []
+        self.version = version
+        self.hour = date - timedelta(seconds=date_secs(date))
+        self.item_shards = []
+        self.sp_items = {}
+
+        lats = [loc[0] for loc in locations] or [0]
+        lngs = [loc[1] for loc in locations] or [0]
+        self.min_lat, self.min_lng = min(lats), min(lngs)
+        height = equi_rect_distance((self.min_lat, self.min_lng),
+                                    (max(lats), self.min_lng))
+        width = equi_rect_distance((self.min_lat, self.min_lng),
+                                   (self.min_lat, max(lngs)))
+        side = math.ceil(math.sqrt(max(workers, 1)))
+        self.rows = int(max(min(side, height / min_km), 1))
+        self.cols = int(max(min(side, width / min_km), 1))
+        self.lat_step = (max(lats) - self.min_lat) / self.rows
+        self.lng_step = (max(lngs) - self.min_lng) / self.cols
+
+        self.shards = {}
+        for row in range(self.rows):
+            for col in range(self.cols):
+                self.shards[(row, col)] = QueueIndex(self.queue, (
+                    self.min_lat + row * self.lat_step,
+                    self.min_lng + col * self.lng_step,
+                    self.min_lat + (row + 1) * self.lat_step,
+                    self.min_lng + (col + 1) * self.lng_step))
+
+    def shard_key(self, loc):
+        row = int((loc[0] - self.min_lat) / (self.lat_step or 1))
+        col = int((loc[1] - self.min_lng) / (self.lng_step or 1))
+        return (min(max(row, 0), self.rows - 1),
+                min(max(col, 0), self.cols - 1))
+
+    def shard(self, loc):
+        return self.shards[self.shard_key(loc)]
+
+    # Keys of the shard of a location and of the shards around it.
+    def nearby_keys(self, loc):
+        row, col = self.shard_key(loc)
+        return [(r, c) for r in range(row - 1, row + 2)
+                for c in range(col - 1, col + 2) if (r, c) in self.shards]
+
+    # Append items to the queue. Only the overseer thread adds items.
+    def extend(self, items):
+        for item in items:
+            i = len(self.queue)
+            shard = self.shard(item['loc'])
+            self.queue.append(item)
+            self.item_shards.append(shard)
+            if item.get('sp'):
+                self.sp_items.setdefault(item['sp'], []).append(i)
+            with shard.lock:
+                shard.push(i)
+
+    # Seconds from the start of the hour of the queue to a date.
+    def ms(self, date):
+        return (date - self.hour).total_seconds()
+
+    # Shards by distance from a location, nearest first.
+    def by_distance(self, loc):
+        return sorted(self.shards.itervalues(),
+                      key=lambda shard: shard.distance(loc))
+
+    # Retire the items of all shards that ended before ms.
+    def advance(self, ms):
+        for shard in self.shards.itervalues():
+            with shard.lock:
+                shard.advance(ms, 0)
+
+    # Return the outcome counts of all shards, and start over.
+    def take_counts(self):
+        counts = Counter()
+        for shard in self.shards.itervalues():
+            with shard.lock:
+                counts.update(shard.counts)
+                shard.counts.clear()
+
+        return counts
+
+
 # After finishing the spawnpoint search or if timing isn't right for any of
 # the remaining search bands, workers will search the nearest scan location
 # that has a new spawn.
@@ -491,10 +778,14 @@ class SpeedScan(HexSearch):
     def __init__(self, queues, status, args):
         super(SpeedScan, self).__init__(queues, status, args)
         self.refresh_date = datetime.utcnow() - timedelta(days=1)
+        self.update_date = self.refresh_date
+        self.report_date = self.refresh_date
         self.next_band_date = self.refresh_date
         self.location_change_date = datetime.utcnow()
-        self.queues = [[]]
         self.queue_version = 0
+        self.queue_shards = QueueShards([], 1, self.queue_version,
+                                        self.refresh_date)
+        self.queues = [self.queue_shards.queue]
         self.ready = False
         self.empty_hive = False
         self.spawns_found = 0
@@ -504,11 +795,33 @@ class SpeedScan(HexSearch):
         # Minutes between queue refreshes. Should be less than 10 to allow for
         # new bands during Initial scan
         self.minutes = 5
+        # Seconds between updates of the items of the cells scanned since
+        # the last one, and minutes between full rebuilds of the queue from
+        # the DB.
+        self.update_seconds = 30
+        self.rebuild_minutes = 60
+        self.changed_cells = set()
+        self.sp_cells = {}
+        # Seconds between route plans, the number of items on a route, of
+        # the cheapest items of each worker the plan chooses from, and of
+        # the workers assigned together.
+        self.plan_seconds = 10
+        self.route_length = 3
+        self.route_candidates = 5
+        self.plan_group_size = 20
+        self.plan_date = self.refresh_date
+        self.routes = {}
+        self.routes_version = None
+        self.worker_states = {}
         self.found_percent = []
         self.scan_percent = []
         self.spawn_percent = []
         self.status_message = []
         self.tth_found = 0
+        # ScannedLocation dicts and ids of linked spawnpoints by cell, kept
+        # up to date by the workers.
+        self.scanned_locations = {}
+        self.cell_to_linked_sp_ids = None
         # Initiate special types.
         self._stat_init()
         self._locks_init()
@@ -520,12 +833,15 @@ class SpeedScan(HexSearch):
         self.scans_missed_list = []
 
     def _locks_init(self):
-        self.lock_next_item = Lock()
+        self.lock_next_band = Lock()
+        self.lock_scan_state = Lock()
+        self.lock_plan = Lock()
 
     # On location change, empty the current queue and the locations list
     def location_changed(self, scan_location, db_update_queue):
         super(SpeedScan, self).location_changed(scan_location, db_update_queue)
         self.location_change_date = datetime.utcnow()
+        self.sp_cells = {}
         self.locations = self._generate_locations()
         scans = {}
         initial = {}
@@ -546,8 +862,9 @@ class SpeedScan(HexSearch):
         log.info('%d steps created', len(scans))
         self.band_spacing = int(10 * 60 / len(scans))
         self.band_status()
-        spawnpoints = SpawnPoint.select_in_hex_by_location(
-            self.scan_location, self.args.step_limit)
+        spawnpoints = spawnpoint_cache.load(
+            SpawnPoint.select_in_hex_by_location(
+                self.scan_location, self.args.step_limit))
         if not spawnpoints:
             log.info('No spawnpoints in hex found in SpawnPoint table. ' +
                      'Doing initial scan.')
@@ -566,6 +883,37 @@ class SpeedScan(HexSearch):
         else:
             log.info('Spawn points assigned')
 
+        cell_to_linked_sp_ids = {}
+        for link in scan_spawn_point.itervalues():
+            cell_to_linked_sp_ids.setdefault(
+                link['scannedlocation'], set()).add(link['spawnpoint'])
+        with self.lock_scan_state:
+            self.scanned_locations = {cell: dict(sl)
+                                      for cell, sl in initial.iteritems()}
+            self.cell_to_linked_sp_ids = cell_to_linked_sp_ids
+            self.changed_cells = set()
+
+    def get_scanned_location(self, loc):
+        with self.lock_scan_state:
+            scan_loc = self.scanned_locations.get(cellid(loc))
+            return dict(scan_loc) if scan_loc else None
+
+    def get_linked_spawn_point_ids(self, cell):
+        with self.lock_scan_state:
+            if self.cell_to_linked_sp_ids is None:
+                return None
+            return list(self.cell_to_linked_sp_ids.get(cell, ()))
+
+    def scanned_location_updated(self, scan_loc, sp_ids):
+        with self.lock_scan_state:
+            if scan_loc['cellid'] not in self.scans:
+                return
+            self.scanned_locations[scan_loc['cellid']] = dict(scan_loc)
+            self.changed_cells.add(scan_loc['cellid'])
+            if self.cell_to_linked_sp_ids is not None:
+                self.cell_to_linked_sp_ids.setdefault(
+                    scan_loc['cellid'], set()).update(sp_ids)
+
     # Generates the list of locations to scan
     # Created a new function, because speed scan requires fixed locations,
     # even when increasing -st. With HexSearch locations, the location of
@@ -613,8 +961,7 @@ class SpeedScan(HexSearch):
 
     def get_overseer_message(self):
         n = 0
-        ms = (datetime.utcnow() - self.refresh_date).total_seconds() + \
-            self.refresh_ms
+        ms = self.queue_shards.ms(datetime.utcnow())
         counter = {
             'TTH': 0,
             'spawn': 0,
@@ -628,7 +975,7 @@ class SpeedScan(HexSearch):
                 continue
 
             if ms < item['start']:
-                break
+                continue
 
             n += 1
             counter[item['kind']] += 1
@@ -641,16 +988,28 @@ class SpeedScan(HexSearch):
 
         return message
 
-    # Refresh queue every 5 minutes
+    # Refresh queue every 5 minutes, or sooner when cells were scanned
     # the first band of a scan is done
     def time_to_refresh_queue(self):
-        return ((datetime.utcnow() - self.refresh_date).total_seconds() >
-                self.minutes * 60 or
+        since_update = (datetime.utcnow() - self.update_date).total_seconds()
+        return (since_update > self.minutes * 60 or
+                (self.changed_cells and since_update > self.update_seconds) or
                 (self.queues == [[]] and not self.empty_hive))
 
+    def time_to_plan_routes(self):
+        return ((datetime.utcnow() - self.plan_date).total_seconds() >
+                self.plan_seconds)
+
+    # Plan the routes of the workers every plan_seconds.
+    def plan(self):
+        if self.time_to_plan_routes():
+            self.plan_routes(self.queue_shards, datetime.utcnow())
+
     # Function to empty all queues in the queues list
     def empty_queues(self):
-        self.queues = [[]]
+        self.queue_shards = QueueShards([], 1, self.queue_version,
+                                        self.refresh_date)
+        self.queues = [self.queue_shards.queue]
 
     # How long to delay since last action
     def delay(self, last_scan_date):
@@ -678,22 +1037,32 @@ class SpeedScan(HexSearch):
                 'Exception in band_status: Exception message: {}'.format(
                     repr(e)))
 
-    # Update the queue, and provide a report on performance of last minutes
-    def schedule(self):
+    # Rebuild the queue from the DB.
+    def build_queue(self, now_date):
         log.info('Refreshing queue')
-        self.ready = False
-        now_date = datetime.utcnow()
         self.refresh_date = now_date
-        self.refresh_ms = now_date.minute * 60 + now_date.second
         self.queue_version += 1
-        old_q = deepcopy(self.queues[0])
         queue = []
 
         # Measure the time it takes to refresh the queue
         start = time.time()
 
-        # prefetch all scanned locations
+        # prefetch all scanned locations and the ids of their linked
+        # spawnpoints. What the workers told us is newer than the DB.
         scanned_locations = ScannedLocation.get_by_cellids(self.scans.keys())
+        cell_to_linked_sp_ids = (
+            ScannedLocation.get_cell_to_linked_spawn_point_ids(
+                self.scans.keys()))
+        with self.lock_scan_state:
+            scanned_locations.update(self.scanned_locations)
+            self.scanned_locations = scanned_locations
+            for cell, sp_ids in (self.cell_to_linked_sp_ids or {}).iteritems():
+                cell_to_linked_sp_ids.setdefault(cell, set()).update(sp_ids)
+            self.cell_to_linked_sp_ids = cell_to_linked_sp_ids
+            scanned_locations = dict(scanned_locations)
+            cell_to_linked_sp_ids = {
+                cell: set(sp_ids)
+                for cell, sp_ids in cell_to_linked_sp_ids.iteritems()}
 
         # extract all spawnpoints into a dict with spawnpoint
         # id -> spawnpoint for easy access later
@@ -705,6 +1074,16 @@ class SpeedScan(HexSearch):
             for sp in sps:
                 sp_by_id[sp['id']] = sp
 
+        # Remember which cell each spawnpoint was given to, and the linked
+        # spawnpoints given to cells of other hives, for update_queue.
+        self.sp_cells = {}
+        for sp_ids in cell_to_linked_sp_ids.itervalues():
+            for sp_id in sp_ids:
+                self.sp_cells[sp_id] = None
+        for cell, sps in cell_to_linked_spawn_points.iteritems():
+            for sp in sps:
+                self.sp_cells[sp['id']] = cell
+
         for cell, scan in self.scans.iteritems():
             queue += ScannedLocation.get_times(scan, now_date,
                                                scanned_locations)
@@ -715,7 +1094,14 @@ class SpeedScan(HexSearch):
         end = time.time()
 
         queue.sort(key=itemgetter('start'))
-        self.queues[0] = queue
+        workers = (self.args.workers_per_hive if self.args.beehive
+                   else self.args.workers)
+        queue_shards = QueueShards(
+            [scan['loc'] for scan in self.scans.itervalues()], workers,
+            self.queue_version, now_date)
+        queue_shards.extend(queue)
+        self.queue_shards = queue_shards
+        self.queues[0] = queue_shards.queue
         self.ready = True
         log.info('New queue created with %d entries in %f seconds', len(queue),
                  (end - start))
@@ -723,30 +1109,142 @@ class SpeedScan(HexSearch):
         # there are no spawnpoints in the hive.
         if len(queue) == 0:
             self.empty_hive = True
-        if old_q:
+
+    # Bring the items of some cells up to date with what the workers told
+    # us, without going to the DB or stopping the workers. Items that became
+    # due are appended to the queue, and the ones that aren't called for
+    # anymore are dropped.
+    def update_queue(self, now_date, cells):
+        start = time.time()
+        queue_shards = self.queue_shards
+        queue = queue_shards.queue
+        cells = [cell for cell in cells if cell in self.scans]
+
+        with self.lock_scan_state:
+            scanned_locations = dict(self.scanned_locations)
+            cell_to_linked_sp_ids = {
+                cell: set((self.cell_to_linked_sp_ids or {}).get(cell, ()))
+                for cell in cells}
+
+        # Spawnpoints found since the queue was built go to the first cell
+        # that links them.
+        sp_ids = set()
+        for cell in cells:
+            for sp_id in cell_to_linked_sp_ids[cell]:
+                if self.sp_cells.setdefault(sp_id, cell) == cell:
+                    sp_ids.add(sp_id)
+        sp_by_id = spawnpoint_cache.get_many(sp_ids)
+        cell_to_linked_spawn_points = {}
+        for sp_id, sp in sp_by_id.iteritems():
+            cell_to_linked_spawn_points.setdefault(
+                self.sp_cells[sp_id], []).append(sp)
+
+        # Times are from the start of the current hour, the queue's are from
+        # the start of the hour it was built.
+        offset = round((queue_shards.ms(now_date) - date_secs(now_date)) /
+                       3600.0) * 3600
+        due = []
+        for cell in cells:
+            scan = self.scans[cell]
+            due += ScannedLocation.get_times(scan, now_date,
+                                             scanned_locations)
+            due += SpawnPoint.get_times(cell, scan, now_date,
+                                        self.args.spawn_delay,
+                                        cell_to_linked_spawn_points,
+                                        sp_by_id)
+        for item in due:
+            item['start'] += offset
+            item['end'] += offset
+
+        # Keep the open items that are still due, with their parking. Items
+        # that were claimed, scanned or missed aren't added again for the
+        # same window: a missed spawn looks due until its window moves.
+        steps = set(self.scans[cell]['step'] for cell in cells)
+        open_items = {}
+        done_windows = set()
+        for i, item in enumerate(queue):
+            if item['step'] not in steps:
+                continue
+            key = (item['kind'], item['step'], item['sp'])
+            done = item.get('done')
+            if done is None:
+                open_items.setdefault(key, []).append(i)
+            elif done != 'Dropped':
+                done_windows.add(key + (item['start'], item['end']))
+
+        new_items = []
+        kept = set()
+        for item in due:
+            key = (item['kind'], item['step'], item['sp'])
+            same = [i for i in open_items.get(key, [])
+                    if queue[i]['start'] <= item['end'] and
+                    item['start'] <= queue[i]['end']]
+            if same:
+                kept.update(same)
+            elif key + (item['start'], item['end']) not in done_windows:
+                new_items.append(item)
+
+        dropped = 0
+        for indices in open_items.itervalues():
+            for i in indices:
+                if i in kept:
+                    continue
+                shard = queue_shards.item_shards[i]
+                with shard.lock:
+                    if queue[i].get('done') is None:
+                        shard.set_done(i, 'Dropped')
+                        shard.discard(i)
+                        dropped += 1
+
+        new_items.sort(key=itemgetter('start'))
+        queue_shards.extend(new_items)
+        log.debug('Queue updated for %d cells in %f seconds, with %d new ' +
+                  'and %d dropped entries', len(cells), time.time() - start,
+                  len(new_items), dropped)
+
+    # Update the queue, and provide a report on performance of last minutes
+    def schedule(self):
+        now_date = datetime.utcnow()
+        # Workers only retire the items of the shards they look at, so mark
+        # the rest of the items that timed out as Missed for the stats.
+        ms = self.queue_shards.ms(now_date)
+        self.queue_shards.advance(ms)
+
+        # Report on what happened to the items since the last report.
+        counts = None
+        report = ((now_date - self.report_date).total_seconds() >
+                  self.minutes * 60)
+        if report:
+            self.report_date = now_date
+            if self.queues[0]:
+                counts = self.queue_shards.take_counts()
+
+        with self.lock_scan_state:
+            changed_cells = self.changed_cells
+            self.changed_cells = set()
+
+        if not self.queues[0] or ((now_date - self.refresh_date)
+                                  .total_seconds() >
+                                  self.rebuild_minutes * 60):
+            self.build_queue(now_date)
+        else:
+            self.update_queue(now_date,
+                              self.scans.keys() if report else changed_cells)
+        self.update_date = now_date
+        if self.time_to_plan_routes():
+            self.plan_routes(self.queue_shards, now_date)
+
+        if counts is not None:
             # Enclosing in try: to avoid divide by zero exceptions from
             # killing overseer
             try:
 
-                # Possible 'done' values are 'Missed', 'Scanned', None, or
-                # number
-                Not_none_list = filter(lambda e: e.get(
-                    'done', None) is not None, old_q)
-                Missed_list = filter(lambda e: e.get(
-                    'done', None) == 'Missed', Not_none_list)
-                Scanned_list = filter(lambda e: e.get(
-                    'done', None) == 'Scanned', Not_none_list)
-                Timed_list = filter(lambda e: type(
-                    e['done']) is not str, Not_none_list)
-                spawns_timed_list = filter(
-                    lambda e: e['kind'] == 'spawn', Timed_list)
-                spawns_timed = len(spawns_timed_list)
-                bands_timed = len(
-                    filter(lambda e: e['kind'] == 'band', Timed_list))
-                spawns_all = spawns_timed + \
-                    len(filter(lambda e: e['kind'] == 'spawn', Scanned_list))
-                spawns_missed = len(
-                    filter(lambda e: e['kind'] == 'spawn', Missed_list))
+                # Counts of items by kind and outcome, kept by the shards as
+                # the items get marked.
+                spawns_timed = counts[('spawn', 'Timed')]
+                bands_timed = counts[('band', 'Timed')]
+                spawns_all = spawns_timed + counts[('spawn', 'Scanned')]
+                spawns_missed = counts[('spawn', 'Missed')]
                 band_percent = self.band_status()
                 kinds = {}
                 tth_ranges = {}
@@ -755,8 +1253,11 @@ class SpeedScan(HexSearch):
                 found_percent = 100.0
                 good_percent = 100.0
                 spawns_reached = 100.0
-                spawnpoints = SpawnPoint.select_in_hex_by_cellids(
-                    self.scans.keys(), self.location_change_date)
+                # The spawnpoints given to the cells of this hive, as the
+                # workers last left them.
+                spawnpoints = spawnpoint_cache.get_many(
+                    [sp_id for sp_id, cell in self.sp_cells.iteritems()
+                     if cell is not None]).values()
                 for sp in spawnpoints:
                     if sp['missed_count'] > 5:
                         continue
@@ -814,10 +1315,7 @@ class SpeedScan(HexSearch):
                              spawns_missed, spawns_reached)
 
                 if spawns_timed:
-                    average = reduce(
-                        lambda x, y: x + y['done'],
-                        spawns_timed_list,
-                        0) / spawns_timed
+                    average = counts[('spawn', 'delay')] / spawns_timed
                     log.info('%d Pokemon found, %d were targeted, with an ' +
                              'average delay of %d sec', spawns_all,
                              spawns_timed, average)
@@ -865,220 +1363,392 @@ class SpeedScan(HexSearch):
                         repr(e)))
                 traceback.print_exc(file=sys.stdout)
 
-    # Find the best item to scan next
-    def next_item(self, status):
-        # Thread safety: don't let multiple threads get the same "best item".
-        with self.lock_next_item:
-            # Score each item in the queue by # of due spawns or scan time
-            # bands can be filled.
-
-            while not self.ready:
-                time.sleep(1)
-
-            now_date = datetime.utcnow()
-            q = self.queues[0]
-            ms = ((now_date - self.refresh_date).total_seconds() +
-                  self.refresh_ms)
-            best = {}
-            worker_loc = [status['latitude'], status['longitude']]
-            last_action = status['last_scan_date']
-
-            # Logging.
-            log.debug('Enumerating %s scan locations in queue.',
-                      len(q))
-
-            # Keep some stats for logging purposes. If something goes wrong,
-            # we can track what happened.
-            count_claimed = 0
-            count_parked = 0
-            count_missed = 0
-            count_fresh_band = 0
-            count_early = 0
-            count_late = 0
-            min_parked_time_remaining = 0
-            min_fresh_band_time_remaining = 0
-
-            # Check all scan locations possible in the queue.
-            for i, item in enumerate(q):
-                # If already claimed by another worker or done, pass.
-                if item.get('done', False):
-                    count_claimed += 1
-                    continue
-
-                # If the item is parked by a different thread (or by a
-                # different account, which should be on that one thread),
-                # pass.
-                our_parked_name = status['username']
-                if 'parked_name' in item:
-                    # We use 'parked_last_update' to determine when the
-                    # last time was since the thread passed the item with the
-                    # same thread name & username. If it's been too long, unset
-                    # the park so another worker can pick it up.
-                    now = default_timer()
-                    max_parking_idle_seconds = 3 * 60
-                    time_passed = now - item.get('parked_last_update', now)
-                    time_remaining = (max_parking_idle_seconds - time_passed)
-
-                    # Update logging stats.
-                    if not min_parked_time_remaining:
-                        min_parked_time_remaining = time_remaining
-                    elif time_remaining < min_parked_time_remaining:
-                        min_parked_time_remaining = time_remaining
-
-                    # Check parked status.
-                    if (time_passed > max_parking_idle_seconds):
-                        # Unpark & don't skip it.
-                        item.pop('parked_name', None)
-                        item.pop('parked_last_update', None)
-                    else:
-                        # Still parked and not our item. Skip it.
-                        if item.get('parked_name') != our_parked_name:
-                            count_parked += 1
-                            continue
-
-                # If already timed out, mark it as Missed and check next.
-                if ms > item['end']:
-                    count_missed += 1
-                    item['done'] = 'Missed' if not item.get(
-                        'done', False) else item['done']
-                    continue
-
-                # If we just did a fresh band recently, wait a few seconds to
-                # space out the band scans.
-                if now_date < self.next_band_date:
-                    count_fresh_band += 1
-
-                    # Update logging stats.
-                    band_time_remaining = (self.next_band_date - now_date)
-                    if not min_fresh_band_time_remaining:
-                        min_fresh_band_time_remaining = band_time_remaining
-                    elif band_time_remaining < min_fresh_band_time_remaining:
-                        min_fresh_band_time_remaining = band_time_remaining
-
-                    continue
-
-                # If we are going to get there before it starts then ignore.
-                loc = item['loc']
-                distance = equi_rect_distance(loc, worker_loc)
-                secs_to_arrival = distance / self.args.kph * 3600
-                secs_waited = (now_date - last_action).total_seconds()
-                secs_to_arrival = max(secs_to_arrival - secs_waited, 0)
-                if ms + secs_to_arrival < item['start']:
-                    count_early += 1
-                    continue
-
-                # If we can't make it there before it disappears, don't bother
-                # trying.
-                if ms + secs_to_arrival > item['end']:
-                    count_late += 1
+    # Plan short routes for all the workers of the hive at once, instead of
+    # giving each worker the best item for it when it asks. Run by the
+    # overseer every plan_seconds. Each worker only plans with the items of
+    # its own shard and the shards around it. The first item of each route
+    # comes from a min-cost assignment of the workers to the items they can
+    # get to while the items are open, bands first, then TTH and spawns,
+    # sooner before later, plan_group_size neighbouring workers at a time to
+    # keep the cost matrices small. Routes are then extended with the items
+    # that are open when the worker would get there, soonest first. The
+    # items on a route are parked for its worker.
+    def plan_routes(self, queue_shards, now_date):
+        q = queue_shards.queue
+        ms = queue_shards.ms(now_date)
+        now = default_timer()
+        max_parking_idle_seconds = 3 * 60
+        workers = [(name, state)
+                   for name, state in self.worker_states.items()
+                   if now - state['seen'] < max_parking_idle_seconds]
+        names = set(name for name, __ in workers)
+        with self.lock_plan:
+            old_routes = (self.routes
+                          if self.routes_version == queue_shards.version
+                          else {})
+        self.plan_date = now_date
+
+        # Open items that aren't parked by workers we don't plan for, of the
+        # shards that have workers around.
+        worker_keys = dict((name, queue_shards.nearby_keys(state['loc']))
+                           for name, state in workers)
+        nearby_locs = {}
+        for name, state in workers:
+            for key in worker_keys[name]:
+                nearby_locs.setdefault(key, []).append(state['loc'])
+        items = {}
+        for key, locs in nearby_locs.iteritems():
+            shard = queue_shards.shards[key]
+            shard_items = items[key] = []
+            with shard.lock:
+                shard.advance(ms, max(shard.farthest(loc) for loc in locs) /
+                              self.args.kph * 3600)
+                for cells in shard.cells.itervalues():
+                    for ids in cells.itervalues():
+                        for i in ids:
+                            item = q[i]
+                            parked_name = item.get('parked_name')
+                            if item.get('done', False) or (
+                                    parked_name and
+                                    parked_name not in names and
+                                    now - item.get('parked_last_update',
+                                                   now) <=
+                                    max_parking_idle_seconds):
+                                continue
+                            shard_items.append(i)
+
+        def travel(loc, i):
+            return equi_rect_distance(loc, q[i]['loc']) / self.args.kph * 3600
+
+        def is_open(secs, i):
+            return q[i]['start'] <= ms + secs <= q[i]['end']
+
+        def cost(secs, i):
+            return ITEM_KINDS.index(q[i]['kind']) * 1e6 + secs
+
+        # The costs of the items around each worker that it can get to in
+        # time.
+        worker_items = {}
+        worker_costs = {}
+        for name, state in workers:
+            waited = (now_date - state['last_scan_date']).total_seconds()
+            worker_items[name] = [i for key in worker_keys[name]
+                                  for i in items[key]]
+            item_costs = worker_costs[name] = {}
+            for i in worker_items[name]:
+                secs = max(travel(state['loc'], i) - waited, 0)
+                if is_open(secs, i):
+                    item_costs[i] = cost(secs, i)
+
+        # Assign the first items, to neighbouring workers together. Each
+        # worker gets a dummy item for when it gets none.
+        workers.sort(key=lambda worker: queue_shards.shard_key(
+            worker[1]['loc']))
+        unassigned = 1e9
+        routes = {}
+        taken = set()
+        for start in range(0, len(workers), self.plan_group_size):
+            group = workers[start:start + self.plan_group_size]
+            candidates = [dict(heapq.nsmallest(
+                self.route_candidates,
+                ((i, c) for i, c in worker_costs[name].iteritems()
+                 if i not in taken),
+                key=itemgetter(1))) for name, __ in group]
+            columns = sorted(set(i for costs in candidates for i in costs))
+            assignment = min_cost_assignment(
+                [[costs.get(i, unassigned) for i in columns] +
+                 [unassigned] * len(group) for costs in candidates])
+            for (name, __), column, costs in zip(group, assignment,
+                                                 candidates):
+                if column < len(columns) and columns[column] in costs:
+                    routes[name] = [columns[column]]
+                    taken.add(columns[column])
+
+        for name, state in workers:
+            route = routes.get(name)
+            if not route:
+                continue
+            waited = (now_date - state['last_scan_date']).total_seconds()
+            secs = max(travel(state['loc'], route[0]) - waited, 0)
+            while len(route) < self.route_length:
+                # The worker has to wait scan_delay between scans, but can
+                # walk in the meantime.
+                loc = q[route[-1]]['loc']
+                best = None
+                for i in worker_items[name]:
+                    if i in taken:
+                        continue
+                    next_secs = secs + max(travel(loc, i),
+                                           self.args.scan_delay)
+                    if not is_open(next_secs, i):
+                        continue
+                    if not best or cost(next_secs, i) < best[0]:
+                        best = (cost(next_secs, i), next_secs, i)
+                if not best:
+                    break
+                __, secs, i = best
+                route.append(i)
+                taken.add(i)
+
+        # Park the items on the new routes, and release the ones that were
+        # parked for the old routes only.
+        for name, route in old_routes.iteritems():
+            for i in route:
+                if i in routes.get(name, ()):
                     continue
+                shard = queue_shards.item_shards[i]
+                with shard.lock:
+                    if q[i].get('parked_name') == name:
+                        q[i].pop('parked_name', None)
+                        q[i].pop('parked_last_update', None)
+        for name, route in routes.iteritems():
+            for i in list(route):
+                shard = queue_shards.item_shards[i]
+                with shard.lock:
+                    parked_name = q[i].get('parked_name')
+                    if q[i].get('done', False) or (
+                            parked_name and parked_name not in names and
+                            now - q[i].get('parked_last_update', now) <=
+                            max_parking_idle_seconds):
+                        route.remove(i)
+                        continue
+                    q[i]['parked_name'] = name
+                    q[i]['parked_last_update'] = now
+
+        # Workers only read the routes, so swap in the new ones whole.
+        with self.lock_plan:
+            self.routes = dict((name, tuple(route))
+                               for name, route in routes.iteritems())
+            self.routes_version = queue_shards.version
+        log.debug('Planned routes for %d of %d workers over %d items.',
+                  len(routes), len(workers),
+                  sum(len(shard_items) for shard_items in items.itervalues()))
 
-                # Bands are top priority to find new spawns first
-                score = 1e12 if item['kind'] == 'band' else (
-                    1e6 if item['kind'] == 'TTH' else 1)
-
-                # For spawns, score is purely based on how close they are to
-                # last worker position
-                score = score / (distance + .01)
-
-                if score > best.get('score', 0):
-                    best = {'score': score, 'i': i,
-                            'secs_to_arrival': secs_to_arrival}
-                    best.update(item)
-
-            # If we didn't find one, log it.
-            if not best:
-                log.debug('Enumerating queue found no best location, with'
-                          + ' %s claimed, %s parked, %s missed, %s fresh band'
-                          + " skips, %s missed because we're early, %s because"
-                          + " we're too late. Minimum %s time remaining on"
-                          + ' parked item, and %s time remaining for next'
-                          + ' fresh band.',
-                          count_claimed,
-                          count_parked,
-                          count_missed,
-                          count_fresh_band,
-                          count_early,
-                          count_late,
-                          min_parked_time_remaining,
-                          min_fresh_band_time_remaining)
-            else:
-                log.debug('Enumerating queue found best location: %s.',
-                          repr(best))
-
-            loc = best.get('loc', [])
-            step = best.get('step', 0)
-            secs_to_arrival = best.get('secs_to_arrival', 0)
-            i = best.get('i', 0)
-            st = best.get('start', 0)
-            end = best.get('end', 0)
-
-            log.debug('step {} start {} end {} secs to arrival {}'.format(
-                step, st, end, secs_to_arrival))
-
-            messages = {
-                'wait': 'Nothing to scan.',
-                'early': 'Early for step {}; waiting a few seconds...'.format(
-                    step),
-                'late': ('API response on step {} delayed by {} seconds. ' +
-                         'Possible causes: slow proxies, internet, or ' +
-                         'Niantic servers.').format(
-                             step,
-                             int((now_date - last_action).total_seconds())),
-                'search': 'Searching at step {}.'.format(step),
-                'invalid': ('Invalid response at step {}, abandoning ' +
-                            'location.').format(step)
-            }
-
-            try:
-                item = q[i]
-            except IndexError:
-                messages['wait'] = ('Search aborting.'
-                                    + ' Overseer refreshing queue.')
-                return -1, 0, 0, 0, messages, 0
+    # Find the best item to scan next
+    def next_item(self, status):
+        # Score each item in the queue by # of due spawns or scan time
+        # bands can be filled.
 
-            if best.get('score', 0) == 0:
-                if count_late > 0:
-                    messages['wait'] = ('Not able to reach any scan'
-                                        + ' under the speed limit.')
-                return -1, 0, 0, 0, messages, 0
+        while not self.ready:
+            time.sleep(1)
 
-            distance = equi_rect_distance(loc, worker_loc)
-            if (distance >
-                    (now_date - last_action).total_seconds() *
-                    self.args.kph / 3600):
-                # Flag item as "parked" by a specific thread, because
-                # we're waiting for it. This will avoid all threads "walking"
-                # to the same item.
-                our_parked_name = status['username']
-                item['parked_name'] = our_parked_name
-
-                # CTRL+F 'parked_last_update' in this file for more info.
-                item['parked_last_update'] = default_timer()
-
-                messages['wait'] = 'Moving {}m to step {} for a {}.'.format(
-                    int(distance * 1000), step,
-                    best['kind'])
-                # So we wait while the worker arrives at the destination
-                # But we don't want to sleep too long or the item might get
-                # taken by another worker
-                if secs_to_arrival > 179 - self.args.scan_delay:
-                    secs_to_arrival = 179 - self.args.scan_delay
-                return -1, 0, 0, 0, messages, max(secs_to_arrival, 0)
-
-            # Check again if another worker heading there.
-            # TODO: Check if this is still necessary. I believe this was
-            # originally a failed attempt at thread safety, which still
-            # resulted in a race condition (multiple workers heading to the
-            # same spot). A thread Lock has since been added.
-            if item.get('done', False):
-                messages['wait'] = ('Skipping step {}. Other worker already ' +
-                                    'scanned.').format(step)
-                return -1, 0, 0, 0, messages, 0
+        now_date = datetime.utcnow()
+        queue_shards = self.queue_shards
+        q = queue_shards.queue
+        ms = queue_shards.ms(now_date)
+        worker_loc = [status['latitude'], status['longitude']]
+        last_action = status['last_scan_date']
+
+        # Logging.
+        log.debug('Enumerating %s scan locations in queue.',
+                  len(q))
+
+        # Keep some stats for logging purposes. If something goes wrong,
+        # we can track what happened.
+        stats = {'parked': 0, 'missed': 0, 'early': 0, 'late': 0,
+                 'min_parked_time_remaining': 0}
+        count_fresh_band = 0
+        min_fresh_band_time_remaining = 0
+        secs_waited = (now_date - last_action).total_seconds()
+
+        def eligible(item, distance):
+            # If the item is parked by a different thread (or by a
+            # different account, which should be on that one thread),
+            # pass.
+            our_parked_name = status['username']
+            if 'parked_name' in item:
+                # We use 'parked_last_update' to determine when the
+                # last time was since the thread passed the item with the
+                # same thread name & username. If it's been too long, unset
+                # the park so another worker can pick it up.
+                now = default_timer()
+                max_parking_idle_seconds = 3 * 60
+                time_passed = now - item.get('parked_last_update', now)
+                time_remaining = (max_parking_idle_seconds - time_passed)
+
+                # Update logging stats.
+                if (not stats['min_parked_time_remaining'] or
+                        time_remaining < stats['min_parked_time_remaining']):
+                    stats['min_parked_time_remaining'] = time_remaining
+
+                # Check parked status.
+                if (time_passed > max_parking_idle_seconds):
+                    # Unpark & don't skip it.
+                    item.pop('parked_name', None)
+                    item.pop('parked_last_update', None)
+                else:
+                    # Still parked and not our item. Skip it.
+                    if item.get('parked_name') != our_parked_name:
+                        stats['parked'] += 1
+                        return False
+
+            # If we are going to get there before it starts then ignore.
+            secs_to_arrival = distance / self.args.kph * 3600
+            secs_to_arrival = max(secs_to_arrival - secs_waited, 0)
+            if ms + secs_to_arrival < item['start']:
+                stats['early'] += 1
+                return False
+
+            # If we can't make it there before it disappears, don't bother
+            # trying.
+            if ms + secs_to_arrival > item['end']:
+                stats['late'] += 1
+                return False
+
+            return True
+
+        # Where the worker is, for the overseer to plan its route.
+        self.worker_states[status['username']] = {
+            'loc': worker_loc, 'last_scan_date': last_action,
+            'seen': default_timer()}
+
+        # If we just did a fresh band recently, wait a few seconds to
+        # space out the band scans.
+        if now_date < self.next_band_date:
+            count_fresh_band += 1
+            min_fresh_band_time_remaining = self.next_band_date - now_date
+        else:
+            # Follow the route planned for this worker, skipping the items
+            # that were done or can't be done anymore.
+            name = status['username']
+            with self.lock_plan:
+                route = (self.routes.get(name, ())
+                         if self.routes_version == queue_shards.version
+                         else ())
+            for i in route:
+                shard = queue_shards.item_shards[i]
+                with shard.lock:
+                    distance = equi_rect_distance(q[i]['loc'], worker_loc)
+                    secs_to_arrival = max(
+                        distance / self.args.kph * 3600 - secs_waited, 0)
+                    if (not q[i].get('done', False) and
+                            ms + secs_to_arrival < q[i]['start']):
+                        # Wait for it, the route depends on it.
+                        messages = self.item_messages(
+                            q[i]['step'], now_date, last_action)
+                        messages['wait'] = 'Waiting for step {}.'.format(
+                            q[i]['step'])
+                        return (-1, 0, 0, 0, messages,
+                                q[i]['start'] - ms - secs_to_arrival)
+                    if not q[i].get('done', False) and eligible(q[i],
+                                                                distance):
+                        best = {'i': i, 'secs_to_arrival': secs_to_arrival}
+                        best.update(q[i])
+                        return self.claim_item(
+                            queue_shards, best, status, now_date)
+
+            # Thread safety: don't let multiple threads get the same "best
+            # item". Claim from the nearest shard first, and steal from the
+            # others, nearest first, when it has nothing for us.
+            for shard in queue_shards.by_distance(worker_loc):
+                with shard.lock:
+                    # Activate the items this worker could get to before they
+                    # start, and mark the ones that timed out as Missed.
+                    stats['missed'] += shard.advance(
+                        ms, shard.farthest(worker_loc) / self.args.kph * 3600)
+
+                    # Bands are top priority to find new spawns first, then
+                    # TTH and spawns. Within a kind, the item closest to the
+                    # last worker position wins.
+                    for kind in ITEM_KINDS:
+                        nearest = shard.nearest(kind, worker_loc, eligible)
+                        if nearest:
+                            distance, i = nearest
+                            best = {'i': i, 'secs_to_arrival': max(
+                                distance / self.args.kph * 3600 -
+                                secs_waited, 0)}
+                            best.update(q[i])
+                            return self.claim_item(
+                                queue_shards, best, status, now_date)
+
+        # We didn't find one, log it.
+        log.debug('Enumerating queue found no best location, with'
+                  + ' %s parked, %s missed, %s fresh band'
+                  + " skips, %s missed because we're early, %s because"
+                  + " we're too late. Minimum %s time remaining on"
+                  + ' parked item, and %s time remaining for next'
+                  + ' fresh band.',
+                  stats['parked'],
+                  stats['missed'],
+                  count_fresh_band,
+                  stats['early'],
+                  stats['late'],
+                  stats['min_parked_time_remaining'],
+                  min_fresh_band_time_remaining)
+
+        messages = self.item_messages(0, now_date, last_action)
+        if stats['late'] > 0:
+            messages['wait'] = ('Not able to reach any scan'
+                                + ' under the speed limit.')
+        return -1, 0, 0, 0, messages, 0
+
+    def item_messages(self, step, now_date, last_action):
+        return {
+            'wait': 'Nothing to scan.',
+            'early': 'Early for step {}; waiting a few seconds...'.format(
+                step),
+            'late': ('API response on step {} delayed by {} seconds. ' +
+                     'Possible causes: slow proxies, internet, or ' +
+                     'Niantic servers.').format(
+                         step,
+                         int((now_date - last_action).total_seconds())),
+            'search': 'Searching at step {}.'.format(step),
+            'invalid': ('Invalid response at step {}, abandoning ' +
+                        'location.').format(step)
+        }
 
-            if not self.ready:
-                messages['wait'] = ('Search aborting.'
-                                    + ' Overseer refreshing queue.')
+    # Park or claim the best item for a worker. Called with the lock of the
+    # item's shard held.
+    def claim_item(self, queue_shards, best, status, now_date):
+        log.debug('Enumerating queue found best location: %s.',
+                  repr(best))
+
+        worker_loc = [status['latitude'], status['longitude']]
+        last_action = status['last_scan_date']
+        loc = best['loc']
+        step = best['step']
+        secs_to_arrival = best['secs_to_arrival']
+        i = best['i']
+        item = queue_shards.queue[i]
+
+        log.debug('step {} start {} end {} secs to arrival {}'.format(
+            step, best['start'], best['end'], secs_to_arrival))
+
+        messages = self.item_messages(step, now_date, last_action)
+
+        distance = equi_rect_distance(loc, worker_loc)
+        if (distance >
+                (now_date - last_action).total_seconds() *
+                self.args.kph / 3600):
+            # Flag item as "parked" by a specific thread, because
+            # we're waiting for it. This will avoid all threads "walking"
+            # to the same item.
+            our_parked_name = status['username']
+            item['parked_name'] = our_parked_name
+
+            # CTRL+F 'parked_last_update' in this file for more info.
+            item['parked_last_update'] = default_timer()
+
+            messages['wait'] = 'Moving {}m to step {} for a {}.'.format(
+                int(distance * 1000), step,
+                best['kind'])
+            # So we wait while the worker arrives at the destination
+            # But we don't want to sleep too long or the item might get
+            # taken by another worker
+            if secs_to_arrival > 179 - self.args.scan_delay:
+                secs_to_arrival = 179 - self.args.scan_delay
+            return -1, 0, 0, 0, messages, max(secs_to_arrival, 0)
+
+        if not self.ready:
+            messages['wait'] = ('Search aborting.'
+                                + ' Overseer refreshing queue.')
+            return -1, 0, 0, 0, messages, 0
+
+        # Workers in other shards may have scanned a fresh band since we
+        # checked.
+        with self.lock_next_band:
+            if datetime.utcnow() < self.next_band_date:
+                messages['wait'] = 'Waiting to space out band scans.'
                 return -1, 0, 0, 0, messages, 0
 
             # If a new band, set the date to wait until for the next band.
@@ -1086,27 +1756,35 @@ class SpeedScan(HexSearch):
                 self.next_band_date = datetime.utcnow() + timedelta(
                     seconds=self.band_spacing)
 
-            # Mark scanned
-            item['done'] = 'Scanned'
-            status['index_of_queue_item'] = i
-            status['queue_version'] = self.queue_version
+        # Mark scanned
+        queue_shards.item_shards[i].set_done(i, 'Scanned')
+        queue_shards.item_shards[i].discard(i)
+        status['index_of_queue_item'] = i
+        status['queue_version'] = queue_shards.version
 
-            messages['search'] = 'Scanning step {} for a {}.'.format(
-                best['step'], best['kind'])
-            return best['step'], best['loc'], 0, 0, messages, 0
+        messages['search'] = 'Scanning step {} for a {}.'.format(
+            best['step'], best['kind'])
+        return best['step'], best['loc'], 0, 0, messages, 0
 
     def task_done(self, status, parsed=False):
         if parsed:
-            # Record delay between spawn time and scanning for statistics
-            # This now holds the actual time of scan in seconds
-            scan_secs = parsed['scan_secs']
-
             # It seems that the best solution is not to interfere with the
             # item if the queue has been refreshed since scanning
-            if status['queue_version'] != self.queue_version:
+            queue_shards = self.queue_shards
+            if status['queue_version'] != queue_shards.version:
                 log.info('Step item has changed since queue refresh')
                 return
-            item = self.queues[0][status['index_of_queue_item']]
+
+            # Record delay between spawn time and scanning for statistics
+            # This now holds the actual time of scan in seconds, from the
+            # start of the hour of the scan. The queue outlives the hour it
+            # was built in, so count them from the start of that hour like
+            # its items.
+            scan_secs = secs_near(parsed['scan_secs'],
+                                  queue_shards.ms(datetime.utcnow()))
+            i = status['index_of_queue_item']
+            item = queue_shards.queue[i]
+            item_shard = queue_shards.item_shards[i]
             safety_buffer = item['end'] - scan_secs
             start_secs = item['start']
             if item['kind'] == 'spawn':
@@ -1116,6 +1794,8 @@ class SpeedScan(HexSearch):
             if safety_buffer < 0:
                 log.warning('Too late by %d sec for a %s at step %d', -
                             safety_buffer, item['kind'], item['step'])
+                with item_shard.lock:
+                    item_shard.set_done(i, 'Scanned', final=True)
 
             # If we had a 0/0/0 scan, then unmark as done so we can retry, and
             # save for Statistics
@@ -1127,13 +1807,17 @@ class SpeedScan(HexSearch):
                         self.args.bad_scan_retry):
                     log.info('Step %d failed scan for %d times! Giving up...',
                              item['step'], self.args.bad_scan_retry + 1)
+                    with item_shard.lock:
+                        item_shard.set_done(i, 'Scanned', final=True)
                 else:
-                    item['done'] = None
+                    with item_shard.lock:
+                        item_shard.set_done(i, None)
+                        item_shard.add(i)
                     log.info('Putting back step %d in queue', item['step'])
             else:
                 # Scan returned data
                 self.scans_done += 1
-                item['done'] = start_delay
+                done = start_delay
 
                 # Were we looking for spawn?
                 if item['kind'] == 'spawn':
@@ -1149,17 +1833,22 @@ class SpeedScan(HexSearch):
                         self.spawns_missed_delay[
                             sp_id] = self.spawns_missed_delay.get(sp_id, [])
                         self.spawns_missed_delay[sp_id].append(start_delay)
-                        item['done'] = 'Scanned'
+                        done = 'Scanned'
+                with item_shard.lock:
+                    item_shard.set_done(i, done, final=True)
 
                 # For existing spawn points, if in any other queue items, mark
                 # 'scanned'
                 for sp_id in parsed['sp_id_list']:
-                    for item in self.queues[0]:
-                        if (sp_id == item.get('sp', None) and
-                                item.get('done', None) is None and
-                                scan_secs > item['start'] and
-                                scan_secs < item['end']):
-                            item['done'] = 'Scanned'
+                    for i in queue_shards.sp_items.get(sp_id, []):
+                        item = queue_shards.queue[i]
+                        shard = queue_shards.item_shards[i]
+                        with shard.lock:
+                            if (item.get('done', None) is None and
+                                    scan_secs > item['start'] and
+                                    scan_secs < item['end']):
+                                shard.set_done(i, 'Scanned', final=True)
+                                shard.discard(i)
 
 
 # The SchedulerFactory returns an instance of the correct type of scheduler.
@@ -44,7 +44,8 @@ from pgoapi import utilities as util
 from pgoapi.hash_server import (HashServer, BadHashRequestException,
                                 HashingOfflineException)
 from .models import (parse_map, GymDetails, parse_gyms, MainWorker,
-                     WorkerStatus, HashKeys, Account)
+                     WorkerStatus, HashKeys, Account, spawnpoint_cache,
+                     sighting_summary_cache)
 from .utils import now, clear_dict_response, get_new_api_timestamp, get_args
 from .transform import get_new_coords, jitter_location
 from .account import (setup_api, check_login, complete_tutorial, AccountSet,
@@ -152,11 +153,15 @@ def status_printer(threadStatus, search_items_queue_array, db_updates_queue,
                 search_items_queue_size += search_items_queue_array[i].qsize()
 
             skip_total = threadStatus['Overseer']['skip_total']
+            db_stats = db_updates_queue.get_stats()
             status_text.append((
-                'Queues: {} search items, {} db updates, {} webhook.  ' +
+                'Queues: {} search items, {} db updates ({} telemetry ' +
+                'rows, {} dropped), {} webhook.  ' +
                 'Total skipped items: {}. Spare accounts available: {}. ' +
                 'Accounts on hold: {}. Accounts with captcha: {}').format(
-                    search_items_queue_size, db_updates_queue.qsize(),
+                    search_items_queue_size, db_stats['map']['depth'],
+                    db_stats['telemetry']['depth'],
+                    db_stats['telemetry']['dropped'],
                     wh_queue.qsize(), skip_total, account_queue.qsize(),
                     len(account_failures), len(account_captchas)))
 
@@ -689,6 +694,12 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
             else:
                 threadStatus['Overseer']['message'] = scheduler_array[
                     i].get_overseer_message()
+                try:
+                    scheduler_array[i].plan()
+                except Exception as e:
+                    log.error('Planning had an Exception: {}.'.format(
+                        repr(e)))
+                    traceback.print_exc(file=sys.stdout)
 
         # Let's update the total stats and add that info to message
         # Added exception handler as dict items change
@@ -725,6 +736,10 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
             api_check_time = check_forced_version(args, api_version,
                                                   api_check_time, pause_bit)
 
+        # Write out spawnpoint changes left by the last parsed scans.
+        spawnpoint_cache.flush(db_updates_queue)
+        sighting_summary_cache.flush(db_updates_queue)
+
         # Now we just give a little pause here.
         time.sleep(1)
 
@@ -1156,7 +1171,8 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
 
                     parsed = parse_map(args, response_dict, step_location,
                                        dbq, whq, key_scheduler, api, status,
-                                       scan_date, account, account_sets)
+                                       scan_date, account, account_sets,
+                                       scheduler)
                     del response_dict
                     scheduler.task_done(status, parsed)
                     if parsed['count'] > 0:
@@ -4,6 +4,7 @@
 import sys
 import configargparse
 import os
+import gzip
 import math
 import json
 import logging
@@ -14,7 +15,11 @@ import struct
 import zipfile
 import requests
 from uuid import uuid4
-from s2sphere import CellId, LatLng
+from bisect import bisect_left
+from collections import namedtuple
+from threading import Lock
+from cachetools import LRUCache, cached
+from s2sphere import CellId, LatLng, LatLngRect, RegionCoverer
 
 from . import config
 
@@ -280,6 +285,37 @@ def get_args():
                         action='store_true', default=False)
     parser.add_argument('-C', '--cors', help='Enable CORS on web server.',
                         action='store_true', default=False)
+    parser.add_argument('-srd', '--stream-raw-data',
+                        help=('Stream /raw_data responses row by row ' +
+                              'instead of building the whole JSON ' +
+                              'document in memory.'),
+                        action='store_true', default=False)
+    parser.add_argument('-li', '--live-index',
+                        help=('Answer map viewport queries from an ' +
+                              'in-memory index of active objects instead ' +
+                              'of the database. Only use it when this ' +
+                              'instance runs all searchers writing to the ' +
+                              'database.'),
+                        action='store_true', default=False)
+    parser.add_argument('-cls', '--change-log-size',
+                        help=('Number of written rows to keep in the ' +
+                              'change log, so map clients only fetch the ' +
+                              'rows written since their last update. Only ' +
+                              'use it when this instance runs all ' +
+                              'searchers writing to the database. ' +
+                              'Default: 0 (disabled).'),
+                        type=int, default=0)
+    parser.add_argument('-rdct', '--raw-data-cache-ttl',
+                        help=('Seconds to cache /raw_data responses for ' +
+                              'polls of the same area, widened to a grid ' +
+                              'of 0.001 degrees. Concurrent identical ' +
+                              'polls share one query. ' +
+                              'Default: 0 (disabled).'),
+                        type=float, default=0)
+    parser.add_argument('-rdcs', '--raw-data-cache-size',
+                        help=('Max. number of cached /raw_data responses. ' +
+                              'Default: 1000.'),
+                        type=int, default=1000)
     parser.add_argument('-D', '--db', help='Database filename for SQLite.',
                         default='pogom.db')
     parser.add_argument('-cd', '--clear-db',
@@ -327,6 +363,11 @@ def get_args():
                         help=('Clear Pokemon from database this many hours ' +
                               'after they disappear (0 to disable).'),
                         type=int, default=0)
+    parser.add_argument('-pdd', '--purge-detection-data',
+                        help=('Clear the detection data of spawnpoints ' +
+                              'with a confirmed TTH from database this many ' +
+                              'hours after they were seen (0 to disable).'),
+                        type=int, default=0)
     parser.add_argument('-px', '--proxy',
                         help='Proxy url (e.g. socks5://127.0.0.1:9050)',
                         action='append')
@@ -361,6 +402,13 @@ def get_args():
     parser.add_argument('--db-host', help='IP or hostname for the database.')
     parser.add_argument(
         '--db-port', help='Port for the database.', type=int, default=3306)
+    parser.add_argument('--db-replica-host',
+                        help=('IP or hostname of a MySQL read replica of ' +
+                              'the database. Reads of the web pages go to ' +
+                              'it, writes keep using --db-host.'))
+    parser.add_argument('--db-replica-port',
+                        help='Port for the read replica (default: --db-port).',
+                        type=int)
     parser.add_argument('--db-max_connections',
                         help='Max connections (per thread) for the database.',
                         type=int, default=5)
@@ -368,6 +416,30 @@ def get_args():
                         help=('Number of db threads; increase if the db ' +
                               'queue falls behind.'),
                         type=int, default=1)
+    parser.add_argument('--db-batch-window',
+                        help=('Max. seconds a db thread waits to collect ' +
+                              'more queued updates into a single batch.'),
+                        type=float, default=0.5)
+    parser.add_argument('--db-batch-size',
+                        help=('Max. number of rows a db thread collects ' +
+                              'before writing a batch.'),
+                        type=int, default=1000)
+    parser.add_argument('--db-queue-size',
+                        help=('Max. number of queued map data updates ' +
+                              'before scanning waits for the db threads. ' +
+                              '0 for no limit.'),
+                        type=int, default=0)
+    parser.add_argument('--db-telemetry-queue-size',
+                        help=('Max. number of queued worker status rows. ' +
+                              'The oldest rows are dropped when the db ' +
+                              'falls behind. 0 for no limit.'),
+                        type=int, default=5000)
+    parser.add_argument('--db-chunk-size',
+                        help=('Rows per upsert statement for a model, as ' +
+                              'MODEL=ROWS (e.g. Pokemon=500). Can be used ' +
+                              'multiple times. Defaults to 250 rows for ' +
+                              'MySQL and 50 rows for SQLite.'),
+                        action='append', default=[])
     parser.add_argument('-wh', '--webhook',
                         help='Define URL(s) to POST webhook information to.',
                         default=None, dest='webhooks', action='append')
@@ -487,6 +559,18 @@ def get_args():
 
     args = parser.parse_args()
 
+    # Per model chunk sizes for the database upserts.
+    args.db_chunk_sizes = {}
+    for chunk_size in args.db_chunk_size:
+        try:
+            model, rows = chunk_size.split('=')
+            args.db_chunk_sizes[model.strip()] = int(rows)
+        except ValueError:
+            print(sys.argv[0] +
+                  (": error: invalid --db-chunk-size '{}', expected " +
+                   "MODEL=ROWS.").format(chunk_size))
+            sys.exit(1)
+
     if args.only_server:
         if args.location is None:
             parser.print_usage()
@@ -779,6 +863,13 @@ def date_secs(d):
     return d.minute * 60 + d.second
 
 
+# Move secs, seconds after some hour, by whole hours to the value nearest to
+# near. Converts the seconds after the hour of a recent time to seconds
+# counted from an earlier hour.
+def secs_near(secs, near):
+    return secs + int(round((near - secs) / 3600.0)) * 3600
+
+
 # Checks to see if test is between start and end accounting for hour
 # wraparound.
 def clock_between(start, test, end):
@@ -786,11 +877,110 @@ def clock_between(start, test, end):
             (not (end <= test <= start) and start > end))
 
 
+# Union of clock ranges [start, end] of seconds after the hour, which wrap
+# around the hour when start > end. The result doesn't depend on the order
+# of the ranges: disjoint ranges sorted by start, with the one that wraps
+# around the hour, if any, last.
+def union_clock_ranges(ranges):
+    pieces = []
+    for start, end in ranges:
+        if start <= end:
+            pieces.append([start, end])
+        else:
+            pieces += [[start, 3600], [0, end]]
+    pieces.sort()
+
+    union = []
+    for start, end in pieces:
+        if union and start <= union[-1][1]:
+            union[-1][1] = max(union[-1][1], end)
+        else:
+            union.append([start, end])
+
+    # Join the ranges that meet at the hour again.
+    if len(union) > 1 and union[0][0] == 0 and union[-1][1] == 3600:
+        union[-1][1] = union.pop(0)[1]
+
+    return union
+
+
+# Return a copy of the sorted seconds after the hour a spawnpoint was seen at,
+# with secs added. spawn_kind() only tells repeated seconds apart by how many
+# sightings there are, up to 5, so repeats are dropped past that.
+def add_seen_secs(seen_secs, secs):
+    i = bisect_left(seen_secs, secs)
+    if len(seen_secs) >= 5 and i < len(seen_secs) and seen_secs[i] == secs:
+        return list(seen_secs)
+
+    return seen_secs[:i] + [secs] + seen_secs[i:]
+
+
+# Guess the kind of a spawnpoint ('hhhs' to 'ssss', or 'hshs' for double
+# spawns) from the sorted seconds after the hour it was seen at. Also return
+# the sighting just before the largest gap, the latest it is seen.
+def spawn_kind(seen_secs):
+    # Add the first seen_secs to the end as a clock wrap around.
+    seen_secs = seen_secs + seen_secs[:1]
+    seen_secs[-1] += 3600
+
+    # Make a list of gaps between sightings.
+    gap_list = [seen_secs[i + 1] - seen_secs[i]
+                for i in range(len(seen_secs) - 1)]
+
+    max_gap = max(gap_list)
+    latest_seen = seen_secs[gap_list.index(max_gap)]
+
+    # If the second largest gap is larger than 15 minutes, then there are
+    # two gaps greater than 15 minutes.  It must be a double spawn.
+    if len(gap_list) > 4 and sorted(gap_list)[-2] > 900:
+        return 'hshs', latest_seen
+
+    # An hour minus the largest gap in minutes gives us the duration the
+    # spawn was there.  Round up to the nearest 15 minute interval for our
+    # current best guess duration.
+    duration = (int((60 - max_gap / 60.0) / 15) + 1) * 15
+
+    # Convert the duration into a 'hhhs', 'hhss', 'hsss', 'ssss' string
+    # accordingly.  's' is for seen, 'h' is for hidden.
+    return ''.join(['s' if i > (3 - duration / 15) else 'h'
+                    for i in range(0, 4)]), latest_seen
+
+
 # Return the s2sphere cellid token from a location.
 def cellid(loc):
     return CellId.from_lat_lng(LatLng.from_degrees(loc[0], loc[1])).to_token()
 
 
+# s2 cell ids are unsigned 64 bit, the database columns are signed. The
+# conversion keeps the order of the ids within each cube face, so cell
+# ranges stay ranges.
+def s2_signed(id):
+    return id - (1 << 64) if id >= (1 << 63) else id
+
+
+# Return the leaf s2 cell id of a location, as stored in the s2_cell_id
+# columns.
+def s2_cell_id(lat, lng):
+    return s2_signed(CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).id())
+
+
+# Return the (min, max) s2_cell_id ranges of a few cells covering a
+# viewport. The cells cover a bit more than the viewport itself. Computing
+# a covering takes milliseconds and map clients poll with the same
+# viewport, so they're cached. The request threads share the cache.
+@cached(LRUCache(maxsize=1024), lock=Lock())
+def s2_cell_ranges(swLat, swLng, neLat, neLng, max_cells=8):
+    coverer = RegionCoverer()
+    coverer.max_cells = max_cells
+    rect = LatLngRect.from_point_pair(
+        LatLng.from_degrees(float(swLat), float(swLng)),
+        LatLng.from_degrees(float(neLat), float(neLng)))
+
+    return [(s2_signed(cell.range_min().id()),
+             s2_signed(cell.range_max().id()))
+            for cell in coverer.get_covering(rect)]
+
+
 # Return equirectangular approximation distance in km.
 def equi_rect_distance(loc1, loc2):
     R = 6371  # Radius of the earth in km.
@@ -807,6 +997,58 @@ def in_radius(loc1, loc2, distance):
     return equi_rect_distance(loc1, loc2) < distance
 
 
+# Assign each row of a cost matrix to a different column, with the lowest
+# total cost, using the Hungarian method in O(rows^2 * columns). There can't
+# be more rows than columns. Return the column of each row.
+def min_cost_assignment(costs):
+    n = len(costs)
+    m = len(costs[0]) if n else 0
+    u = [0] * (n + 1)
+    v = [0] * (m + 1)
+    # Row matched to each column, and the previous column on the
+    # augmenting path, both 1-based with 0 for none.
+    match = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for row in range(1, n + 1):
+        match[0] = row
+        j0 = 0
+        minv = [float('inf')] * (m + 1)
+        used = [False] * (m + 1)
+        while match[j0]:
+            used[j0] = True
+            i0 = match[j0]
+            delta = float('inf')
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = costs[i0 - 1][j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    columns = [None] * n
+    for j in range(1, m + 1):
+        if match[j]:
+            columns[match[j] - 1] = j - 1
+
+    return columns
+
+
 def i8ln(word):
     if config['LOCALE'] == "en":
         return word
@@ -870,6 +1112,31 @@ def get_pokemon_types(pokemon_id):
                pokemon_types)
 
 
+PokedexEntry = namedtuple('PokedexEntry', ['name', 'rarity', 'types'])
+
+
+# Localized name, rarity and types of every Pokemon in a list indexed by
+# pokedex id. Built once, for enriching large numbers of rows without
+# going through get_pokemon_data() and i8ln() for each of them. The types
+# are shared by all rows of a species, so they're kept in a tuple.
+def get_pokedex():
+    if not hasattr(get_pokedex, 'entries'):
+        if not hasattr(get_pokemon_data, 'pokemon'):
+            # initialize from file
+            get_pokemon_data(1)
+
+        pokemon_ids = map(int, get_pokemon_data.pokemon)
+        entries = [None] * (max(pokemon_ids) + 1)
+        for pokemon_id in pokemon_ids:
+            entries[pokemon_id] = PokedexEntry(
+                get_pokemon_name(pokemon_id),
+                get_pokemon_rarity(pokemon_id),
+                tuple(get_pokemon_types(pokemon_id)))
+        get_pokedex.entries = entries
+
+    return get_pokedex.entries
+
+
 def get_moves_data(move_id):
     if not hasattr(get_moves_data, 'moves'):
         file_path = os.path.join(
@@ -962,6 +1229,37 @@ def extract_sprites(root_path):
     zip.close()
 
 
+# Write a gzipped copy next to each minified bundle under path that doesn't
+# have an up to date one yet, for the web server to send as is. Bundles that
+# can't be compressed are left to be compressed per request.
+def compress_static_files(path, suffixes=('.min.js', '.min.css',
+                                          '.min.json')):
+    for root, __, files in os.walk(path):
+        for name in files:
+            if not name.endswith(suffixes):
+                continue
+
+            file_path = os.path.join(root, name)
+            gz_path = file_path + '.gz'
+            try:
+                if (os.path.isfile(gz_path) and os.path.getmtime(gz_path) >=
+                        os.path.getmtime(file_path)):
+                    continue
+
+                with open(file_path, 'rb') as f:
+                    data = f.read()
+                # Written aside and renamed, so the server never sends a
+                # partial file.
+                with open(gz_path + '.tmp', 'wb') as f:
+                    with gzip.GzipFile(name, 'wb', 9, f) as gz:
+                        gz.write(data)
+                if os.path.isfile(gz_path):
+                    os.remove(gz_path)
+                os.rename(gz_path + '.tmp', gz_path)
+            except (IOError, OSError) as e:
+                log.warning('Could not compress %s: %s', file_path, repr(e))
+
+
 def clear_dict_response(response, keep_inventory=False):
     if 'platform_returns' in response:
         del response['platform_returns']
@@ -3,6 +3,7 @@
 
 import os
 import sys
+import atexit
 import logging
 import time
 import re
@@ -19,13 +20,16 @@ from geopy.geocoders import GoogleV3
 
 from pogom import config
 from pogom.app import Pogom
-from pogom.utils import get_args, now, extract_sprites
+from pogom.utils import (get_args, now, extract_sprites,
+                         compress_static_files)
 from pogom.altitude import get_gmaps_altitude
 
 from pogom.search import search_overseer_thread
 from pogom.models import (init_database, create_tables, drop_tables,
-                          Pokemon, db_updater, clean_db_loop,
-                          verify_table_encoding, verify_database_schema)
+                          Pokemon, DbUpdateQueue, db_updater, clean_db_loop,
+                          verify_table_encoding, verify_database_schema,
+                          init_live_indexes, change_log,
+                          write_behind_caches_flush)
 from pogom.webhook import wh_updater
 
 from pogom.proxy import check_proxies, proxies_refresher
@@ -128,6 +132,9 @@ def main():
                 '"npm install && npm run build" before starting the server.')
             sys.exit()
 
+        # Gzip the bundles once, instead of per request.
+        compress_static_files(os.path.join(root_path, 'static/dist'))
+
         # You need custom image files now.
         if not os.path.isfile(
                 os.path.join(root_path, 'static/icons-sprite.png')):
@@ -250,9 +257,24 @@ def main():
     new_location_queue.put(position)
 
     # DB Updates
-    db_updates_queue = Queue()
+    db_updates_queue = DbUpdateQueue(args.db_queue_size,
+                                     args.db_telemetry_queue_size)
     app.set_db_updates_queue(db_updates_queue)
 
+    # The live index and change log are fed by the db updater threads of this
+    # process, so they only know about what our own searcher finds.
+    if args.live_index:
+        if args.only_server:
+            log.warning('Ignoring --live-index in server-only mode.')
+        else:
+            init_live_indexes()
+
+    if args.change_log_size > 0:
+        if args.only_server:
+            log.warning('Ignoring --change-log-size in server-only mode.')
+        else:
+            change_log.enable(args.change_log_size)
+
     # Thread(s) to process database updates.
     for i in range(args.db_threads):
         log.debug('Starting db-updater worker thread %d', i)
@@ -261,6 +283,10 @@ def main():
         t.daemon = True
         t.start()
 
+    # The db updater threads die with the process, so write out what the
+    # spawnpoint caches still hold ourselves.
+    atexit.register(write_behind_caches_flush, db)
+
     # db cleaner; really only need one ever.
     if not args.disable_clean:
         t = Thread(target=clean_db_loop, name='db-cleaner', args=(args,))
@@ -28,6 +28,7 @@ var languageLookupThreshold = 3
 var searchMarkerStyles
 
 var timestamp
+var seq
 var excludedPokemon = []
 var notifiedPokemon = []
 var notifiedRarity = []
@@ -1319,6 +1320,48 @@ function showInBoundsMarkers(markers, type) {
     })
 }
 
+// Rebuild the rows of a columnar raw_data section (see to_columns() in
+// pogom/app.py). Sections in the row format are returned as they are.
+function decodeColumns(section) {
+    if (!section || section.n === undefined) {
+        return section
+    }
+
+    var rows = []
+    var i
+    for (i = 0; i < section.n; i++) {
+        rows.push({})
+    }
+
+    $.each(section.nulls, function (idx, key) {
+        for (i = 0; i < section.n; i++) {
+            rows[i][key] = null
+        }
+    })
+    $.each(section.columns, function (key, values) {
+        for (i = 0; i < section.n; i++) {
+            rows[i][key] = values[i]
+        }
+    })
+    $.each(section.sparse, function (key, indexesValues) {
+        for (i = 0; i < section.n; i++) {
+            rows[i][key] = null
+        }
+        $.each(indexesValues[0], function (idx, index) {
+            rows[index][key] = indexesValues[1][idx]
+        })
+    })
+    $.each(section.deltas, function (key, deltas) {
+        var value = 0
+        for (i = 0; i < section.n; i++) {
+            value += deltas[i]
+            rows[i][key] = value / section.scale
+        }
+    })
+
+    return rows
+}
+
 function loadRawData() {
     var loadPokemon = Store.get('showPokemon')
     var loadGyms = Store.get('showGyms')
@@ -1335,33 +1378,41 @@ function loadRawData() {
     var neLat = nePoint.lat()
     var neLng = nePoint.lng()
 
+    var data = {
+        'timestamp': timestamp,
+        'seq': seq,
+        'pokemon': loadPokemon,
+        'lastpokemon': lastpokemon,
+        'pokestops': loadPokestops,
+        'lastpokestops': lastpokestops,
+        'luredonly': loadLuredOnly,
+        'gyms': loadGyms,
+        'lastgyms': lastgyms,
+        'scanned': loadScanned,
+        'lastslocs': lastslocs,
+        'spawnpoints': loadSpawnpoints,
+        'lastspawns': lastspawns,
+        'swLat': swLat,
+        'swLng': swLng,
+        'neLat': neLat,
+        'neLng': neLng,
+        'oSwLat': oSwLat,
+        'oSwLng': oSwLng,
+        'oNeLat': oNeLat,
+        'oNeLng': oNeLng,
+        'reids': String(isShowAllZoom() ? excludedPokemon :  reincludedPokemon),
+        'eids': String(getExcludedPokemon())
+    }
+    // The server builds columnar sections in memory, so it only offers them
+    // when it doesn't stream /raw_data.
+    if (columnarRawData) {
+        data['format'] = 'columnar'
+    }
+
     return $.ajax({
         url: 'raw_data',
         type: 'GET',
-        data: {
-            'timestamp': timestamp,
-            'pokemon': loadPokemon,
-            'lastpokemon': lastpokemon,
-            'pokestops': loadPokestops,
-            'lastpokestops': lastpokestops,
-            'luredonly': loadLuredOnly,
-            'gyms': loadGyms,
-            'lastgyms': lastgyms,
-            'scanned': loadScanned,
-            'lastslocs': lastslocs,
-            'spawnpoints': loadSpawnpoints,
-            'lastspawns': lastspawns,
-            'swLat': swLat,
-            'swLng': swLng,
-            'neLat': neLat,
-            'neLng': neLng,
-            'oSwLat': oSwLat,
-            'oSwLng': oSwLng,
-            'oNeLat': oNeLat,
-            'oNeLng': oNeLng,
-            'reids': String(isShowAllZoom() ? excludedPokemon :  reincludedPokemon),
-            'eids': String(getExcludedPokemon())
-        },
+        data: data,
         dataType: 'json',
         cache: false,
         beforeSend: function () {
@@ -1632,6 +1683,11 @@ function updateSpawnPoints() {
 
 function updateMap() {
     loadRawData().done(function (result) {
+        result.pokemons = decodeColumns(result.pokemons)
+        result.pokestops = decodeColumns(result.pokestops)
+        result.scanned = decodeColumns(result.scanned)
+        result.spawnpoints = decodeColumns(result.spawnpoints)
+
         $.each(result.pokemons, processPokemons)
         $.each(result.pokestops, processPokestops)
         $.each(result.gyms, processGyms)
@@ -1672,6 +1728,7 @@ function updateMap() {
             }, reincludedPokemon)
         }
         timestamp = result.timestamp
+        seq = result.seq
         lastUpdateTime = Date.now()
     })
 }
@@ -0,0 +1,13 @@
+import sys
+
+from pogom.utils import get_args
+
+# The models read their settings from the command line when they are
+# imported, so parse a minimal one before the tests import them.
+argv = sys.argv
+sys.argv = ['runserver.py', '-os', '-l', '0,0', '-k', 'key',
+            '--no-matplotlib']
+try:
+    get_args()
+finally:
+    sys.argv = argv
@@ -0,0 +1,113 @@
+import random
+import unittest
+from bisect import insort
+from datetime import datetime, timedelta
+
+from pogom import utils
+from pogom.models import (PokemonAppearanceSummary, SpawnpointDetectionData,
+                          SpawnpointDetectionSummary)
+
+
+class SpawnpointDetectionSummaryTest(unittest.TestCase):
+    def sightings(self, count):
+        scan_time = datetime(2017, 8, 1, 12, 0, 0)
+        encounter_id = 'e0'
+        sightings = []
+        for i in range(count):
+            scan_time += timedelta(seconds=random.randint(10, 2400))
+            if random.random() < 0.3:
+                encounter_id = 'e{}'.format(i)
+            sightings.append({
+                'encounter_id': encounter_id,
+                'scan_time': scan_time,
+                'tth_secs': (random.randint(0, 3599)
+                             if random.random() < 0.2 else None)})
+
+        return sightings
+
+    # What classify used to read from all the detection data of a
+    # spawnpoint: the seconds it was seen at, the latest TTH, and the union
+    # of the ranges between sightings where the encounter id was the same.
+    def scan(self, sightings):
+        seen_secs = sorted(utils.date_secs(s['scan_time'])
+                           for s in sightings)
+        tth_secs = None
+        for s in sightings:
+            if s['tth_secs'] is not None:
+                tth_secs = s['tth_secs']
+        ranges = []
+        for s, next_s in zip(sightings, sightings[1:]):
+            delta = next_s['scan_time'] - s['scan_time']
+            if delta >= timedelta(hours=1):
+                continue
+            if s['encounter_id'] == next_s['encounter_id']:
+                start = utils.date_secs(s['scan_time'])
+                ranges.append([start,
+                               (start + int(delta.total_seconds())) % 3600])
+            else:
+                ranges.append([utils.date_secs(next_s['scan_time']),
+                               utils.date_secs(s['scan_time'])])
+
+        return seen_secs, tth_secs, utils.union_clock_ranges(ranges)
+
+    def summarize(self, sightings):
+        summary = SpawnpointDetectionSummary.new_summary('sp')
+        for s in sightings:
+            SpawnpointDetectionData.add_sighting(summary, s)
+
+        return summary
+
+    def classify(self, summary):
+        sp = {'id': 'sp', 'kind': 'hhhs', 'links': 'hhh?', 'latest_seen': 0,
+              'earliest_unseen': 0}
+        SpawnpointDetectionData.classify(sp, {'done': True}, 0,
+                                         summaries={'sp': summary})
+
+        return sp
+
+    def test_summary_matches_detection_data(self):
+        random.seed(6)
+        for __ in range(300):
+            sightings = self.sightings(random.randint(1, 12))
+            # Parsed up to 10 minutes late, so out of order at times.
+            parsed = sorted(sightings, key=lambda s: (
+                s['scan_time'] + timedelta(seconds=random.randint(0, 600))))
+            summary = self.summarize(parsed)
+
+            seen_secs, tth_secs, ranges = self.scan(sightings)
+            self.assertEqual(tth_secs,
+                             SpawnpointDetectionData.summary_tth_secs(summary))
+            self.assertEqual(ranges, SpawnpointDetectionData
+                             .summary_same_ranges(summary))
+            summary_secs = list(summary['seen_secs'])
+            if tth_secs is not None:
+                insort(seen_secs, (tth_secs - 1) % 3600)
+                insort(summary_secs, (tth_secs - 1) % 3600)
+            self.assertEqual(utils.spawn_kind(seen_secs),
+                             utils.spawn_kind(summary_secs))
+
+            # So the order the sightings were parsed in doesn't change the
+            # classification.
+            self.assertEqual(self.classify(self.summarize(sightings)),
+                             self.classify(summary))
+
+
+class PokemonAppearanceSummaryTest(unittest.TestCase):
+    def test_trim_days(self):
+        summaries = {}
+        now_date = datetime(2017, 8, 1, 12, 0, 0)
+        for days in (0, 0, 300, 366, 367, 400, 800):
+            PokemonAppearanceSummary.add_count(
+                summaries, 1, 'sp', 0, 0, now_date - timedelta(days=days))
+        summary = summaries[(1, 'sp')]
+
+        PokemonAppearanceSummary.trim_days(summary, now_date)
+        self.assertEqual(summary['day_counts'], {
+            '2017-08-01': 2, '2016-10-05': 1, '2016-07-31': 1,
+            PokemonAppearanceSummary.older_days: 3})
+
+        PokemonAppearanceSummary.trim_days(
+            summary, now_date + timedelta(days=1))
+        self.assertEqual(summary['day_counts'], {
+            '2017-08-01': 2, '2016-10-05': 1,
+            PokemonAppearanceSummary.older_days: 4})
@@ -0,0 +1,328 @@
+import unittest
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from pogom.models import ScannedLocation
+from pogom.schedulers import QueueIndex, QueueShards, SpeedScan
+from pogom.utils import cellid, date_secs
+
+
+class Args(object):
+    kph = 36
+    scan_delay = 10
+    spawn_delay = 10
+    bad_scan_retry = 2
+    no_pokemon = False
+    step_limit = 1
+
+
+class QueueIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = [
+            {'loc': (40.001, -73.999), 'kind': 'spawn', 'start': 0,
+             'end': 100},
+            {'loc': (40.002, -73.998), 'kind': 'spawn', 'start': 0,
+             'end': 200},
+            {'loc': (40.001, -73.999), 'kind': 'band', 'start': 0,
+             'end': 300},
+            {'loc': (40.009, -73.991), 'kind': 'spawn', 'start': 50,
+             'end': 400},
+            {'loc': (40.001, -73.999), 'kind': 'spawn', 'start': 500,
+             'end': 600}]
+        self.index = QueueIndex(self.queue, (40.0, -74.0, 40.01, -73.99),
+                                cell_km=0.2)
+        for i in range(len(self.queue)):
+            self.index.push(i)
+
+    def nearest(self, kind, loc, eligible=lambda item, distance: True):
+        best = self.index.nearest(kind, loc, eligible)
+        return best and best[1]
+
+    def test_advance_activates_items_by_start(self):
+        self.index.advance(0, 0)
+        self.assertEqual(self.nearest('spawn', (40.009, -73.991)), 1)
+        self.index.advance(0, 50)
+        self.assertEqual(self.nearest('spawn', (40.009, -73.991)), 3)
+        self.assertEqual(self.nearest('band', (40.009, -73.991)), 2)
+
+    def test_nearest(self):
+        self.index.advance(0, 500)
+        self.assertEqual(self.nearest('spawn', (40.0021, -73.9979)), 1)
+        # The first in the queue wins a tie.
+        self.assertEqual(self.nearest('spawn', (40.001, -73.999)), 0)
+        self.assertEqual(
+            self.nearest('spawn', (40.001, -73.999),
+                         lambda item, distance: item['start'] != 0), 4)
+        self.assertEqual(
+            self.nearest('spawn', (40.001, -73.999),
+                         lambda item, distance: distance > 10), None)
+
+        self.queue[0]['done'] = 'Scanned'
+        self.assertEqual(self.nearest('spawn', (40.001, -73.999)), 4)
+
+    def test_nearest_from_outside_bounds(self):
+        self.index.advance(0, 500)
+        self.assertEqual(self.nearest('spawn', (40.02, -73.98)), 3)
+        self.assertEqual(self.nearest('spawn', (39.9, -74.1)), 0)
+
+    def test_advance_retires_missed_items(self):
+        self.index.advance(0, 500)
+        self.index.set_done(1, 30, final=True)
+
+        self.assertEqual(self.index.advance(250, 0), 1)
+        self.assertEqual(self.queue[0]['done'], 'Missed')
+        self.assertEqual(self.queue[1]['done'], 30)
+        self.assertEqual(self.nearest('spawn', (40.009, -73.991)), 3)
+        self.assertEqual(self.index.counts[('spawn', 'Missed')], 1)
+        self.assertEqual(self.index.counts[('spawn', 'Timed')], 1)
+
+        self.assertEqual(self.index.advance(1000, 0), 3)
+        self.assertEqual(self.nearest('spawn', (40.001, -73.999)), None)
+        self.assertEqual(self.index.counts[('spawn', 'Missed')], 3)
+        self.assertEqual(self.index.counts[('band', 'Missed')], 1)
+
+    def test_add_again_retires_once(self):
+        self.index.advance(0, 0)
+        # A bad scan puts the item back while it's still open.
+        self.index.set_done(0, 'Scanned')
+        self.index.discard(0)
+        self.index.set_done(0, None)
+        self.index.add(0)
+
+        self.assertEqual(len(self.index.ends), 3)
+        self.assertEqual(self.index.advance(150, 0), 1)
+        self.assertEqual(self.index.counts[('spawn', 'Missed')], 1)
+        self.assertEqual(self.index.counts[('spawn', 'Scanned')], 0)
+
+
+class QueueShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.now_date = datetime.utcnow()
+        self.scheduler = SpeedScan([], [], Args())
+        self.scheduler.ready = True
+
+        # Corners of a square about 4km a side, in 4 shards.
+        self.locs = [(40.0, -74.0), (40.036, -74.0), (40.0, -73.953),
+                     (40.036, -73.953)]
+        self.queue_shards = QueueShards(self.locs, 4, 1, self.now_date)
+        self.scheduler.queue_shards = self.queue_shards
+        self.ms = self.queue_shards.ms(self.now_date)
+
+    def extend(self, locs):
+        self.queue_shards.extend(
+            {'loc': loc, 'kind': 'spawn', 'step': step, 'sp': str(step),
+             'start': self.ms - 60, 'end': self.ms + 1200}
+            for step, loc in enumerate(locs, 1))
+
+    def status(self, loc):
+        return {'username': 'w1', 'latitude': loc[0], 'longitude': loc[1],
+                'last_scan_date': self.now_date - timedelta(hours=1)}
+
+    def next_step(self, loc):
+        return self.scheduler.next_item(self.status(loc))[0]
+
+    def test_shards(self):
+        self.extend(self.locs)
+        queue_shards = self.queue_shards
+
+        self.assertEqual(sorted(queue_shards.shards),
+                         [(0, 0), (0, 1), (1, 0), (1, 1)])
+        self.assertEqual([queue_shards.shard_key(loc) for loc in self.locs],
+                         [(0, 0), (1, 0), (0, 1), (1, 1)])
+        self.assertEqual(queue_shards.shard_key((39.9, -73.9)), (0, 1))
+        for i, loc in enumerate(self.locs):
+            self.assertIs(queue_shards.item_shards[i],
+                          queue_shards.shard(loc))
+        self.assertEqual(queue_shards.sp_items['2'], [1])
+        self.assertIs(queue_shards.by_distance(self.locs[3])[0],
+                      queue_shards.shards[(1, 1)])
+
+    def test_claim_from_own_shard_first(self):
+        # Nearer, but in the shard across the border.
+        self.extend([(40.0, -74.0), (40.019, -74.0)])
+
+        self.assertEqual(self.next_step((40.017, -74.0)), 1)
+        self.assertEqual(self.next_step((40.017, -74.0)), 2)
+        self.assertEqual(self.next_step((40.017, -74.0)), -1)
+
+    def test_steal_from_other_shards(self):
+        self.extend([(40.035, -73.954), (40.001, -73.954)])
+
+        self.assertEqual(self.next_step((40.0, -74.0)), 2)
+        self.assertEqual(self.next_step((40.0, -74.0)), 1)
+        self.assertEqual(self.queue_shards.queue[0]['done'], 'Scanned')
+
+    def test_count_final_outcomes(self):
+        self.extend([(40.0, -74.0), (40.036, -73.953)])
+        status = self.status((40.0, -74.0))
+        parsed = {'scan_secs': date_secs(datetime.utcnow()),
+                  'bad_scan': True, 'sp_id_list': []}
+
+        # Claimed items aren't counted until they're done.
+        self.assertEqual(self.scheduler.next_item(status)[0], 1)
+        self.assertEqual(self.queue_shards.take_counts(), {})
+        self.scheduler.task_done(status, parsed)
+        self.assertEqual(self.queue_shards.take_counts(), {})
+
+        self.assertEqual(self.scheduler.next_item(status)[0], 1)
+        parsed.update(bad_scan=False, sp_id_list=['1'])
+        self.scheduler.task_done(status, parsed)
+        counts = self.queue_shards.take_counts()
+        self.assertEqual(counts[('spawn', 'Timed')], 1)
+        self.assertEqual(self.queue_shards.take_counts(), {})
+
+        self.queue_shards.advance(self.ms + 1800)
+        self.assertEqual(self.queue_shards.take_counts(),
+                         {('spawn', 'Missed'): 1})
+
+
+class UpdateQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.now_date = datetime.utcnow()
+        self.scheduler = SpeedScan([], [], Args())
+        self.locs = [(40.0, -74.0), (40.001, -74.0)]
+        self.cells = [cellid(loc) for loc in self.locs]
+        self.scheduler.scans = {
+            cell: {'loc': loc, 'step': step}
+            for step, (cell, loc) in enumerate(zip(self.cells, self.locs))}
+        self.queue_shards = QueueShards(self.locs, 1, 1, self.now_date)
+        self.scheduler.queue_shards = self.queue_shards
+        self.q = self.queue_shards.queue
+
+    def update(self, cells, seconds=0):
+        self.scheduler.update_queue(
+            self.now_date + timedelta(seconds=seconds), cells)
+
+    def test_add_due_items_once(self):
+        self.update(self.cells + ['not in the hive'])
+        self.assertEqual([(item['kind'], item['step']) for item in self.q],
+                         [('band', 0), ('band', 1)])
+
+        self.q[0]['parked_name'] = 'w1'
+        self.update(self.cells, 10)
+        self.assertEqual(len(self.q), 2)
+        self.assertEqual(self.q[0]['parked_name'], 'w1')
+        self.assertNotIn('done', self.q[0])
+
+    def test_drop_items_not_due(self):
+        self.update(self.cells)
+        done = ScannedLocation.new_loc(self.locs[1])
+        done['done'] = True
+        self.scheduler.scanned_locations[self.cells[1]] = done
+
+        self.update(self.cells, 10)
+        self.assertEqual(len(self.q), 2)
+        self.assertNotIn('done', self.q[0])
+        self.assertEqual(self.q[1]['done'], 'Dropped')
+        shard = self.queue_shards.item_shards[1]
+        shard.advance(self.queue_shards.ms(self.now_date), 0)
+        self.assertEqual(shard.nearest('band', self.locs[1],
+                                       lambda item, distance: True)[1], 0)
+
+    def test_keep_done_items_done(self):
+        self.update(self.cells)
+        shard = self.queue_shards.item_shards[0]
+        shard.set_done(0, 'Scanned')
+        shard.set_done(1, 'Missed')
+
+        self.update(self.cells)
+        self.assertEqual(len(self.q), 2)
+        self.assertEqual([item['done'] for item in self.q],
+                         ['Scanned', 'Missed'])
+
+
+class PlanRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.now_date = datetime.utcnow()
+        self.scheduler = SpeedScan([], [], Args())
+        self.scheduler.ready = True
+
+        # Items every 50m east of the worker, open for the next 10 minutes,
+        # and one that opens in half an hour.
+        self.worker_loc = (40.0, -74.0)
+        locs = [(40.0, -74.0 + k * 0.0006) for k in range(1, 6)]
+        self.queue_shards = QueueShards(locs, 1, 1, self.now_date)
+        ms = self.queue_shards.ms(self.now_date)
+        items = [{'loc': loc, 'kind': 'spawn', 'step': step,
+                  'start': ms - 60, 'end': ms + 600}
+                 for step, loc in enumerate(locs, 1)]
+        items.append({'loc': locs[0], 'kind': 'spawn', 'step': 6,
+                      'start': ms + 1800, 'end': ms + 2000})
+        self.queue_shards.extend(items)
+        self.scheduler.queue_shards = self.queue_shards
+        self.q = self.queue_shards.queue
+
+    def see_worker(self, name, loc):
+        self.scheduler.worker_states[name] = {
+            'loc': loc, 'last_scan_date': self.now_date,
+            'seen': default_timer()}
+
+    def plan(self):
+        self.scheduler.plan_routes(self.queue_shards, self.now_date)
+        return self.scheduler.routes
+
+    def test_route_extends_to_open_items(self):
+        self.see_worker('w1', self.worker_loc)
+        routes = self.plan()
+
+        self.assertEqual(routes, {'w1': (0, 1, 2)})
+        for i in (0, 1, 2):
+            self.assertEqual(self.q[i]['parked_name'], 'w1')
+        for i in (3, 4, 5):
+            self.assertNotIn('parked_name', self.q[i])
+
+    def test_route_skips_items_parked_by_other_workers(self):
+        self.q[0]['parked_name'] = 'w2'
+        self.q[0]['parked_last_update'] = default_timer()
+        self.see_worker('w1', self.worker_loc)
+
+        self.assertEqual(self.plan(), {'w1': (1, 2, 3)})
+        self.assertEqual(self.q[0]['parked_name'], 'w2')
+
+    def test_route_skips_closed_windows(self):
+        ms = self.queue_shards.ms(self.now_date)
+        # Closes before the worker could scan it after the first item.
+        self.q[1]['end'] = ms + 12
+        self.see_worker('w1', self.worker_loc)
+
+        self.assertEqual(self.plan(), {'w1': (0, 2, 3)})
+        self.assertNotIn('parked_name', self.q[1])
+
+    def test_release_parking_of_old_routes(self):
+        self.see_worker('w1', self.worker_loc)
+        self.plan()
+
+        # The worker went somewhere it can't get back from in time.
+        self.see_worker('w1', (40.1, -74.0))
+        self.assertEqual(self.plan(), {})
+        for i in (0, 1, 2):
+            self.assertNotIn('parked_name', self.q[i])
+
+    def test_keep_parking_of_routes_for_an_old_queue(self):
+        self.q[2]['parked_name'] = 'w1'
+        self.q[2]['parked_last_update'] = default_timer()
+        self.scheduler.routes = {'w1': (2,)}
+        self.scheduler.routes_version = self.queue_shards.version - 1
+
+        self.assertEqual(self.plan(), {})
+        self.assertEqual(self.scheduler.routes_version,
+                         self.queue_shards.version)
+        self.assertEqual(self.q[2]['parked_name'], 'w1')
+
+    def test_next_item_follows_route(self):
+        self.scheduler.routes = {'w1': (2, 0)}
+        self.scheduler.routes_version = self.queue_shards.version
+        status = {'username': 'w1', 'latitude': self.worker_loc[0],
+                  'longitude': self.worker_loc[1],
+                  'last_scan_date': self.now_date - timedelta(minutes=1)}
+
+        step, loc = self.scheduler.next_item(status)[:2]
+        self.assertEqual((step, loc), (3, self.q[2]['loc']))
+        step = self.scheduler.next_item(status)[0]
+        self.assertEqual(step, 1)
+
+        # Routes planned for an old queue are ignored.
+        self.scheduler.routes = {'w1': (4,)}
+        self.scheduler.routes_version = self.queue_shards.version - 1
+        step = self.scheduler.next_item(status)[0]
+        self.assertEqual(step, 2)
@@ -1,3 +1,7 @@
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 from pogom import utils
 
@@ -16,3 +20,71 @@ class UtilsTest(unittest.TestCase):
 
         # Unknown ID raises KeyError
         self.assertRaises(KeyError, utils.get_pokemon_name, 12367)
+
+    def test_get_pokedex(self):
+        pokedex = utils.get_pokedex()
+        self.assertEqual(utils.get_pokemon_name(149), pokedex[149].name)
+        self.assertEqual(utils.get_pokemon_rarity(149), pokedex[149].rarity)
+        self.assertEqual(utils.get_pokemon_types(149),
+                         list(pokedex[149].types))
+
+    def test_secs_near(self):
+        # A queue built at 12:50 counts from 12:00. A scan at 13:00:05 is 5
+        # seconds after its hour, and 3605 in the queue.
+        self.assertEqual(3605, utils.secs_near(5, 3607))
+        # Scanned at 12:59:58, reported after the hour rolled over.
+        self.assertEqual(3598, utils.secs_near(3598, 3601))
+        self.assertEqual(1200, utils.secs_near(1200, 1210))
+        self.assertEqual(7230, utils.secs_near(30, 7260))
+
+    def test_min_cost_assignment(self):
+        # Greedy would give row 0 column 0, for a total of 11.
+        self.assertEqual([1, 0], utils.min_cost_assignment([[1, 2],
+                                                            [1, 10]]))
+        self.assertEqual([2, 0], utils.min_cost_assignment([[5, 9, 1, 7],
+                                                            [2, 4, 3, 8]]))
+        self.assertEqual([], utils.min_cost_assignment([]))
+
+    def test_spawn_kind(self):
+        # Seen at the same second three times: five sightings with two gaps
+        # over 15 minutes make a double spawn.
+        seen_secs = []
+        for secs in (0, 0, 1000, 0, 2000):
+            seen_secs = utils.add_seen_secs(seen_secs, secs)
+        self.assertEqual([0, 0, 0, 1000, 2000], seen_secs)
+        self.assertEqual(('hshs', 2000), utils.spawn_kind(seen_secs))
+
+        # Without the repeats, it's a 45 minute spawn.
+        self.assertEqual(('hsss', 2000), utils.spawn_kind([0, 1000, 2000]))
+        self.assertEqual(('hhhs', 600), utils.spawn_kind([300, 600]))
+
+        # Past 5 sightings, repeats no longer change the kind.
+        self.assertEqual([0, 0, 0, 1000, 2000],
+                         utils.add_seen_secs(seen_secs, 0))
+
+    def test_union_clock_ranges(self):
+        self.assertEqual([[100, 400]], utils.union_clock_ranges(
+            [[300, 400], [100, 300]]))
+        # Ranges inside others, and ranges that wrap around the hour.
+        self.assertEqual([[100, 400], [3500, 50]], utils.union_clock_ranges(
+            [[150, 200], [3500, 0], [0, 50], [100, 400], [3550, 20]]))
+        self.assertEqual(utils.union_clock_ranges([[10, 20], [5, 30]]),
+                         utils.union_clock_ranges([[5, 30], [10, 20]]))
+        self.assertEqual([[0, 3600]], utils.union_clock_ranges(
+            [[0, 2000], [1500, 0]]))
+        self.assertEqual([], utils.union_clock_ranges([]))
+
+    def test_compress_static_files(self):
+        path = tempfile.mkdtemp()
+        try:
+            for name in ('app.min.js', 'app.built.js'):
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write('var a = 1;')
+            utils.compress_static_files(path)
+
+            self.assertEqual(['app.built.js', 'app.min.js', 'app.min.js.gz'],
+                             sorted(os.listdir(path)))
+            with gzip.open(os.path.join(path, 'app.min.js.gz')) as f:
+                self.assertEqual('var a = 1;', f.read())
+        finally:
+            shutil.rmtree(path)